@@ -1,52 +1,256 @@
 """
     API of the Movi Web App
 """
-from flask import Blueprint, jsonify, request
-from datamanager.data_models import db, User, Movie, Review, Director, user_movie_association
+from flask import Blueprint, jsonify, request, current_app, url_for, Response, stream_with_context
+from datamanager.batch_add import parse_titles, MAX_BATCH_TITLES
+from datamanager.exporter import EXPORT_QUERIES
+from datamanager.importer import parse_records
 
 
 api = Blueprint('api', __name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def get_data_manager():
+    """ Returns the SQLiteDataManager of the app the blueprint is registered on """
+    return current_app.extensions['data_manager']
+
+
+@api.after_request
+def add_etag(response):
+    """
+        Adds an ETag to the JSON answers of the GET requests and answers 304 Not Modified
+        when the client sends the same ETag in If-None-Match
+    """
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed \
+            and response.mimetype == 'application/json':
+        response.add_etag()
+        response.make_conditional(request)
+    return response
 
-def add_director_return_record_id(director_name):
-        add_director_record = Director(
-            name=director_name
-        )
-        db.session.add(add_director_record)
-        db.session.commit()  # commits the session to the DB.
-        id_director = add_director_record.id
-        return id_director
 
 @api.route('/users', methods=['GET'])
 def get_users():
-    """ Gets all users registered in the database """
-    users = User.query.all()
+    """
+        Gets a page of the users registered in the database, sorted by id.
+        Query parameters: 'limit' users per page (max MAX_PAGE_SIZE) and 'after' the id of the last user already read.
+        The link to the next page is sent in the 'Link' header (rel="next").
+    """
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    users, next_after = get_data_manager().get_users_page(after, limit)
     user_list = [{"id": user.id, "name": user.name} for user in users]
-    print(user_list)
-    return jsonify(user_list)
+
+    response = jsonify(user_list)
+    if next_after is not None:
+        next_url = url_for('api.get_users', limit=limit, after=next_after)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+
+@api.route('/search', methods=['GET'])
+def search():
+    """
+        Full-text search of users or movies, best matches first.
+        Query parameters: 'q' the words to search (prefixes match), 'type' 'movies' (default) or 'users', 'limit'.
+    """
+    search_text = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    data_manager = get_data_manager()
+
+    if request.args.get('type') == 'users':
+        users = data_manager.search_users(search_text, limit)
+        return jsonify([{"id": user.id, "name": user.name} for user in users])
+
+    movies = data_manager.search_movies(search_text, limit)
+    return jsonify([{
+        "id": movie.id,
+        "title": movie.title,
+        "year": movie.year,
+        "genre": movie.genre,
+        "director": movie.director}
+        for movie in movies])
+
+
+@api.route('/export', methods=['GET'])
+def export_data():
+    """
+        Streams a bulk export of the database.
+        Query parameters: 'format' 'ndjson' (default) or 'csv' and 'entity' a comma separated list
+        of users, directors, movies, favorites, reviews (default all). CSV exports one entity.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    entities = [entity for entity in request.args.get('entity', ','.join(EXPORT_QUERIES)).split(',') if entity]
+    unknown = [entity for entity in entities if entity not in EXPORT_QUERIES]
+    if unknown or not entities:
+        return jsonify({"error": f"Unknown entity: {', '.join(unknown)}"}), 400
+
+    data_manager = get_data_manager()
+    if export_format == 'csv':
+        if len(entities) != 1:
+            return jsonify({"error": "CSV exports one entity at a time"}), 400
+        return Response(stream_with_context(data_manager.export_csv(entities[0])), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={entities[0]}.csv'})
+    if export_format == 'ndjson':
+        return Response(stream_with_context(data_manager.export_ndjson(entities)), mimetype='application/x-ndjson')
+    return jsonify({"error": f"Unknown format: {export_format}"}), 400
+
+
+@api.route('/import', methods=['POST'])
+def import_data():
+    """
+        Bulk import of movies and favorites in chunked transactions.
+        The body is a JSON array or NDJSON of movies: 'title' (required), 'genre', 'year', 'rating',
+        'poster', 'description', 'director' and 'user_id' or 'user_ids' to add the movie as favorite.
+        Directors are upserted and movies are de-duplicated by title and year.
+        Returns the counts and one result per record.
+    """
+    try:
+        records = parse_records(request.get_data(as_text=True))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid JSON or NDJSON: {e}"}), 400
+
+    results = get_data_manager().import_movies(records)
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('created', 'existing', 'error')}
+    return jsonify({**counts, "results": results}), 200
+
+
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """ Gets the hit/miss counters and hit rate of the OMDb and Gemini lookup caches """
+    return jsonify([cache.stats() for cache in current_app.extensions['lookup_caches']])
 
 
 @api.route('/users/<user_id>/movies', methods=['GET'])
 def get_user_favorite_movies(user_id):
     """ Gets the favorite movies of a user by user_id"""
-    user_movies = db.session.query(Movie).join(user_movie_association, Movie.id == user_movie_association.c.movie_id).filter(user_movie_association.c.user_id == user_id).all()
+    # Only the listed columns, the director name comes from the same query
+    user_movies = get_data_manager().get_user_movie_rows(user_id)
     movies_list = [{
         "id": movie.id,
         "title": movie.title,
         "genre": movie.genre,
         "year": movie.year,
-        "director": movie.director.name}
+        "director": movie.director}
         for movie in user_movies]
 
     return jsonify(movies_list)
 
 
+@api.route('/users/<int:user_id>/movies/batch', methods=['POST'])
+def add_movies_batch(user_id):
+    """
+        Adds many movies by title to the favorite movies list of a user.
+        The body is JSON {"titles": [...]} or a text with one title per line.
+        Returns the counts and the result of every title: 'status' 'added', 'already_in_list', 'not_found' or 'error'.
+    """
+    if get_data_manager().get_user(user_id) is None:
+        return jsonify({"error": "User not found"}), 404
+    if request.is_json:
+        body = request.get_json(silent=True)
+        titles = body.get('titles') if isinstance(body, dict) else None
+        if not isinstance(titles, list):
+            return jsonify({"error": "The body needs a 'titles' list"}), 400
+    else:
+        titles = request.get_data(as_text=True)
+    titles = parse_titles(titles)
+    if len(titles) > MAX_BATCH_TITLES:
+        return jsonify({"error": f"Too many titles, the maximum is {MAX_BATCH_TITLES}"}), 400
+
+    results = current_app.extensions['add_titles'](user_id, titles)
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('added', 'already_in_list', 'not_found', 'error')}
+    return jsonify({**counts, "results": results}), 200
+
+
+@api.route('/users/<int:user_id>/recommendations', methods=['GET'])
+def get_user_recommendations(user_id):
+    """ Gets the movies recommended to a user, best first. Query parameter: 'limit' (default 10) """
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify(get_data_manager().get_recommendations(user_id, limit))
+
+
+@api.route('/movies/<int:movie_id>/similar', methods=['GET'])
+def get_similar_movies(movie_id):
+    """ Users who saved this movie also saved: the similar movies, best first. Query parameter: 'limit' """
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify(get_data_manager().get_similar_movies(movie_id, limit))
+
+
+@api.route('/movies/top-rated', methods=['GET'])
+def get_top_rated_movies():
+    """ Gets the movies with the best average review rating. Query parameters: 'limit', 'min_ratings' (default 1) """
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PAGE_SIZE)
+    min_ratings = max(request.args.get('min_ratings', 1, type=int), 1)
+    return jsonify([leaderboard_row(movie) for movie in get_data_manager().get_top_rated(limit, min_ratings)])
+
+
+@api.route('/movies/most-favorited', methods=['GET'])
+def get_most_favorited_movies():
+    """ Gets the movies saved by most users. Query parameter: 'limit' """
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify([leaderboard_row(movie) for movie in get_data_manager().get_most_favorited(limit)])
+
+
+def leaderboard_row(movie):
+    """ JSON representation of a movie with its aggregates """
+    return {
+        "id": movie.id,
+        "title": movie.title,
+        "year": movie.year,
+        "poster": movie.poster,
+        "rating_avg": round(movie.rating_avg, 2) if movie.rating_avg is not None else None,
+        "ratings": movie.rated_count,
+        "favorites": movie.favorite_count
+    }
+
+
+@api.route('/genres', methods=['GET'])
+def get_genres():
+    """ Gets the genres with the number of their movies """
+    return jsonify([{"id": genre.id, "name": genre.name, "movies": genre.movies}
+                    for genre in get_data_manager().get_genres()])
+
+
+@api.route('/genres/<genre_name>/movies', methods=['GET'])
+def get_genre_movies(genre_name):
+    """
+        Gets a page of the movies of a genre, sorted by id.
+        Query parameters: 'genre' other genres the movies also have (repeatable), 'limit' and 'after'
+        the id of the last movie already read. The link to the next page is sent in the 'Link' header (rel="next").
+    """
+    data_manager = get_data_manager()
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    genre_names = [genre_name] + request.args.getlist('genre')
+    genres = [data_manager.get_genre(name) for name in genre_names]
+    if None in genres:
+        return jsonify({"error": f"Unknown genre: {genre_names[genres.index(None)]}"}), 404
+
+    movies, next_after = data_manager.get_genre_movies([genre.id for genre in genres], after, limit)
+    response = jsonify([{
+        "id": movie.id,
+        "title": movie.title,
+        "year": movie.year,
+        "genre": movie.genre,
+        "poster": movie.poster}
+        for movie in movies])
+    if next_after is not None:
+        next_url = url_for('api.get_genre_movies', genre_name=genre_name, genre=genre_names[1:], limit=limit,
+                           after=next_after)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+
 @api.route('/add_movie/<user_id>/movie', methods=['POST'])
 def add_movie_for_a_user(user_id):
     """ Add a movie to a favorite movies list of a user """
 
     if request.method == 'POST':
-        #return jsonify('HELLOW')
+        data_manager = get_data_manager()
         title = request.form.get('title')
         genre = request.form.get('genre')
         year = request.form.get('year')
@@ -56,10 +260,8 @@ def add_movie_for_a_user(user_id):
         director = request.form.get('director')
 
 
-        if director:
-            director_id = add_director_return_record_id(director)
-        else:
-            director_id = 'N/A'
+        # A movie without director gets its own unknown director (N/A)
+        director_id = data_manager.add_director(director)
         if not genre:
             genre = 'N/A'
         if not year:
@@ -72,15 +274,6 @@ def add_movie_for_a_user(user_id):
             description = 'N/A'
 
 
-        add_movie_record = Movie(
-            title=title,
-            genre=genre,
-            year=year,
-            rating=rating,
-            poster=poster,
-            director_id=director_id,
-            description=description
-        )
         movie_info = {
             'title': title,
             'genre': genre,
@@ -91,16 +284,42 @@ def add_movie_for_a_user(user_id):
             'description': description
         }
 
-        db.session.add(add_movie_record)
-        db.session.commit()  # commits the session to the DB.
-        id_new_movie = add_movie_record.id
-
-        user = User.query.get(user_id)
-        movie = Movie.query.get(id_new_movie)
+        id_new_movie = data_manager.add_movie(director_id, movie_info)
 
-        if user and movie:
-            user.movies.append(movie)
-            db.session.commit()
+        if data_manager.add_favorite(user_id, id_new_movie):
             return jsonify(movie_info)
         else:
             return False
+
+
+@api.route('/jobs', methods=['GET'])
+def get_jobs():
+    """ Status of the background enrichment: the number of jobs by kind and status and the last failed jobs """
+    data_manager = get_data_manager()
+    return jsonify({
+        "counts": data_manager.get_job_counts(),
+        "failed": [job_to_dict(job) for job in data_manager.get_failed_jobs()]
+    })
+
+
+@api.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """ Status of one enrichment job """
+    job = get_data_manager().get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_to_dict(job))
+
+
+def job_to_dict(job):
+    """ JSON representation of an enrichment job """
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "target_id": job.target_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "last_error": job.last_error,
+        "run_after": job.run_after,
+        "updated_at": job.updated_at
+    }
@@ -2,46 +2,144 @@
 Movi Web App allows to create users and set a list of favorite movies.
 It is possible to fetch information of the movie with artificial intelligent
 """
-from flask import Flask, render_template, request, redirect, jsonify
-from datamanager.data_models import db, User, Movie, Review, Director, user_movie_association
+from flask import Flask, render_template, request, redirect, jsonify, abort, Response, stream_with_context, \
+    send_file, url_for
+from markupsafe import Markup
+import json
 import os
 from dotenv import load_dotenv
-import requests
-from datamanager.gemini_ai import fetch_from_gemini
-from sqlalchemy import desc, delete
+import httpx
+from datamanager.http_client import http_client, CircuitOpenError, RateLimiter
+from datamanager.gemini_ai import (fetch_from_gemini, fetch_json_from_gemini, stream_from_gemini,
+                                   stream_json_from_gemini, gemini_cache, movie_description_prompt, director_prompt,
+                                   DIRECTOR_FIELDS)
+from datamanager.lookup_cache import LookupCache, normalize_key
+from datamanager.posters import PosterStore, poster_key, POSTER_HOSTS
+from datamanager.page_cache import create_page_cache
+from datamanager.metrics import metrics
+from datamanager.batch_add import parse_titles, resolve_titles, movie_record, title_status, MAX_BATCH_TITLES, \
+    BATCH_CONCURRENCY
+from datamanager.sqlite_data_manager import SQLiteDataManager
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from api import (api)  # Importing the API blueprint
+from datamanager.enrichment import EnrichmentWorker
+from commands import (compact_directors_command, backfill_genres_command, export_command, import_movies_command,
+                      run_worker_command)
 
 app = Flask(__name__)
 app.register_blueprint(api, url_prefix='/api')  # Registering the blueprint
-
-# data_folder is el Path to folder data
-data_folder = os.path.join(app.root_path, 'data')
+app.cli.add_command(compact_directors_command)
+app.cli.add_command(backfill_genres_command)
+app.cli.add_command(export_command)
+app.cli.add_command(import_movies_command)
+app.cli.add_command(run_worker_command)
+
+# data_folder is el Path to folder data, DATA_FOLDER points the app to another database and caches
+data_folder = os.getenv('DATA_FOLDER') or os.path.join(app.root_path, 'data')
+os.makedirs(data_folder, exist_ok=True)
 """ data_manager allows to interact with the data. """
 # Use the appropriate path to your Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(data_folder, 'sqlite.db')
-db.init_app(app)
+# A view keeps its pooled connection while it waits on OMDb or Gemini, the pool bounds the concurrent views
+data_manager = SQLiteDataManager(os.path.join(data_folder, 'sqlite.db'),
+                                 pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+                                 max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)))
+data_manager.init_app(app)
+# Request timings, SQL query counts and slow-query log, served on /metrics and in the Server-Timing headers
+with app.app_context():
+    metrics.init_app(app, data_manager.db.engine)
 
 #loads variables from the .env file into the environment
 load_dotenv()
 # os.getenv() to access the environment variables loaded from the .env file
 API_KEY = os.getenv('API_KEY')
+OMDB_API_URL = os.getenv('OMDB_API_URL', 'https://www.omdbapi.com/')
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') or os.urandom(24).hex()
+
+# All the OMDb calls of the process, also the concurrent ones of the batch add, share this rate limit
+omdb_rate_limiter = RateLimiter(float(os.getenv('OMDB_RATE_PER_SECOND', 20)), per=1)
+
+# Movies recommended on the page of the favorite movies of a user
+USER_RECOMMENDATIONS = 6
+
+# Signs the movie found by a search, so the confirmation doesn't fetch it again
+selection_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='movie-selection')
+SELECTION_MAX_AGE = 3600
+
+# Cache of the OMDb lookups keyed by the normalized movie title.
+# Misses ('Response': 'False') are cached separately with a shorter TTL.
+omdb_cache = LookupCache(
+    os.path.join(data_folder, 'cache.db'),
+    namespace='omdb',
+    ttl=int(os.getenv('OMDB_CACHE_TTL', 7 * 24 * 3600)),
+    negative_ttl=int(os.getenv('OMDB_CACHE_NEGATIVE_TTL', 3600)),
+    max_entries=int(os.getenv('OMDB_CACHE_MAX_ENTRIES', 5000))
+)
+# Rendered pages and fragments keyed by user and movie, invalidated by the write methods of the data_manager.
+# PAGE_CACHE_REDIS_URL shares it between processes through a Redis-compatible server.
+page_cache = create_page_cache(
+    redis_url=os.getenv('PAGE_CACHE_REDIS_URL'),
+    max_entries=int(os.getenv('PAGE_CACHE_MAX_ENTRIES', 1000)),
+    ttl=int(os.getenv('PAGE_CACHE_TTL', 300))
+)
+data_manager.page_cache = page_cache
+
+# The caches are listed for the monitoring endpoint of the API
+app.extensions['lookup_caches'] = [omdb_cache, gemini_cache, page_cache]
+
+# Local copies and thumbnails of the posters, served by /posters/<movie_id>
+# POSTER_HOSTS (comma-separated) replaces the OMDb image hosts the posters are downloaded from
+poster_store = PosterStore(os.path.join(data_folder, 'posters'), http_client,
+                           allowed_hosts=(os.getenv('POSTER_HOSTS') or ','.join(POSTER_HOSTS)).split(','))
+app.extensions['poster_store'] = poster_store
+# A front web server (nginx, Apache) sends the poster files itself with X-Sendfile
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE') == '1'
+POSTER_MAX_AGE = 365 * 24 * 3600
+
+# Background AI enrichment of the new movies and directors in this process,
+# when ENRICHMENT_WORKERS > 0. Otherwise run it apart with: flask --app app run-worker
+ENRICHMENT_WORKERS = int(os.getenv('ENRICHMENT_WORKERS', 0))
+if ENRICHMENT_WORKERS > 0:
+    enrichment_worker = EnrichmentWorker(
+        app,
+        workers=ENRICHMENT_WORKERS,
+        rate_per_minute=int(os.getenv('ENRICHMENT_RATE_PER_MINUTE', 15)),
+        max_attempts=int(os.getenv('ENRICHMENT_MAX_ATTEMPTS', 5))
+    )
+    enrichment_worker.start()
 
 
-def fetch_data(movie_title):
+@metrics.timed('omdb')
+async def fetch_data_async(movie_title):
     """ Receives a 'movie_title' from the user as an argument.
-        Gets the movie information from the API by request GET.
-        If the response is 'OK' returns the movie infos as json data,
+        Returns the cached movie information if the title was already looked up,
+        otherwise gets the movie information from the API by request GET.
+        If the response is 'OK' caches and returns the movie infos as json data,
         if not, prints an error in the terminal """
-    API_URL = f'https://www.omdbapi.com/?apikey={API_KEY}&t={movie_title}'
-    response = requests.get(API_URL)
-    if response.status_code == requests.codes.ok:
+    cache_key = normalize_key(movie_title)
+    cached_data = await omdb_cache.get_async(cache_key)
+    if cached_data is not None:
+        return cached_data
+
+    try:
+        await omdb_rate_limiter.acquire_async()
+        response = await http_client.get_async(OMDB_API_URL, params={'apikey': API_KEY, 't': movie_title})
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        print("Error:", e)
+        return False
+    if response.status_code == httpx.codes.OK:
         json_data = response.json()
+        await omdb_cache.set_async(cache_key, json_data, miss=json_data.get('Response') == 'False')
         return json_data
     else:
         print("Error:", response.status_code, response.text)
         return False
 
 
+def fetch_data(movie_title):
+    """ Waits for fetch_data_async on the event loop of the http_client """
+    return http_client.run(fetch_data_async(movie_title))
+
+
 def get_needed_data(data_movie):
     """ Filter the necessary data from the external IPA """
     if data_movie['Response'] == 'False':
@@ -80,117 +178,112 @@ def get_needed_data(data_movie):
     return data
 
 
-def add_director_return_record_id(director_name):
-    """ Get the director_name and insert a record in the director table. Return the id of this new record """
-    with app.app_context():
-        add_director_record = Director(
-            name=director_name
-        )
-        db.session.add(add_director_record)
-        db.session.commit()  # commits the session to the DB.
-        id_director = add_director_record.id
-        return id_director
+def get_catalog_data(movie):
+    """ Returns the data of a movie of the database in the format of get_needed_data """
+    return {
+        'poster': movie.poster,
+        'title': movie.title,
+        'year': movie.year,
+        'genre': movie.genre,
+        'director': movie.director.name if movie.director else '',
+        'rating': movie.rating,
+        'description': movie.description
+    }
 
 
-def add_movie_return_record_id(director_id, data):
-    """ Gets the director_id and the data of the new movie.
-        Insert the movie with all information in the table Movies.
-        Return the ID of the new movie table record.
+def add_titles(user_id, titles):
     """
-    with app.app_context():
-        add_movie_record = Movie(
-            title=data['title'],
-            genre=data['genre'],
-            year=data['year'],
-            rating=data['rating'],
-            poster=data['poster'],
-            director_id=director_id,
-            description=data['description']
-        )
-
-        db.session.add(add_movie_record)
-        db.session.commit()  # commits the session to the DB.
-        id_new_movie = add_movie_record.id
-        return id_new_movie
-
-
-def connect_user_movie(user_id, id_new_movie):
-    """ Insert a record in the association table user_monies_association connecting the user_id with the new movie id """
-    with app.app_context():
-        user = User.query.get(user_id)
-        movie = Movie.query.get(id_new_movie)
-
-        if user and movie:
-            user.movies.append(movie)
-            db.session.commit()
-            return True
+        Adds many movies by title to the favorite movies list of a user.
+        The local catalog is checked first, the other titles are looked up in OMDb concurrently
+        and all the movies are written in one transaction.
+        Returns one result per title: the 'title', its 'status' ('added', 'already_in_list', 'not_found'
+        or 'error'), the 'source' ('catalog' or 'omdb') and the 'movie_id' and 'movie_title' of the movie.
+    """
+    titles = parse_titles(titles)
+    results = {}
+    found = {}
+    missing = []
+    for title in titles:
+        movie_in_catalog = data_manager.find_catalog_movie(title)
+        if movie_in_catalog:
+            found[title] = (get_catalog_data(movie_in_catalog), 'catalog')
         else:
-            return False
+            missing.append(title)
+
+    # fetch_data_async only uses the OMDb cache and the http_client, it runs outside of the app context
+    resolved = http_client.run(resolve_titles(missing, fetch_data_async, BATCH_CONCURRENCY)) if missing else {}
+    for title, (json_data, error) in resolved.items():
+        if error is not None or not json_data:
+            results[title] = {'title': title, 'status': 'error', 'source': 'omdb',
+                              'error': str(error or "The OMDb lookup failed")}
+        elif json_data.get('Response') == 'False':
+            results[title] = {'title': title, 'status': 'not_found', 'source': 'omdb'}
+        else:
+            found[title] = (get_needed_data(json_data), 'omdb')
 
+    found_titles = list(found)
+    import_results = data_manager.add_favorite_movies(
+        user_id, [movie_record(int(user_id), found[title][0]) for title in found_titles])
+    for title, import_result in zip(found_titles, import_results):
+        data, source = found[title]
+        results[title] = {'title': title, 'status': title_status(import_result), 'source': source,
+                          'movie_id': import_result.get('movie_id'), 'movie_title': data['title']}
+        if import_result.get('error'):
+            results[title]['error'] = import_result['error']
+    return [results[title] for title in titles]
 
-def update_info(data, movie):
-    """
-        Get a movie and the new data to update.
-        Put the data content in a dictionary
-        Update the data to the movie and commit the changes
-    """
-    update_data = {}
-    for k, v in data.items():
-        update_data[k] = v
-
-    if update_data['description']:
-        movie.description = update_data['description']
-    if update_data['rating']:
-        movie.rating = update_data['rating']
-    if update_data['genre']:
-        movie.genre = update_data['genre']
-    if update_data['bio']:
-        movie.director.bio = update_data['bio']
-    if update_data['birth']:
-        movie.director.birth = update_data['birth']
-    if update_data['death']:
-        movie.director.death = update_data['death']
-    db.session.commit()
-
-
-def get_reviews_by_movie_id(movie_id):
-    """Gets the reviews for a specific movie_id."""
-    try:
-        reviews = db.session.query(Review).filter_by(movie_id=movie_id).order_by(desc(Review.review_id)).all()
-        return reviews
-    except Exception as e:
-        print(f"Error al obtener reseñas: {e}")
-        return []
 
+# The batch add of the API uses the OMDb lookups of the app
+app.extensions['add_titles'] = add_titles
 
-def movie_reviews(movie_id):
-    """Gets the reviews and usernames for a movie_id."""
-    # Gets review by movie_id
-    reviews = db.session.query(Review).filter_by(movie_id=movie_id).order_by(desc(Review.review_id)).all()
 
-    user_names = {}  # Dictionary for storing usernames
+def load_selected_movie(movie_token):
+    """ Returns the movie data signed in the movie_token by the search step.
+        Returns None if the token is missing, expired or was tampered with """
+    if not movie_token:
+        return None
+    try:
+        return selection_serializer.loads(movie_token, max_age=SELECTION_MAX_AGE)
+    except BadSignature:
+        return None
 
-    for review in reviews:
-        # Iterates User filtering by id taking the id from review_user_id
-        user = db.session.query(User).filter_by(id=review.user_id).first()
-        if user:
-            user_names[review.user_id] = user.name
-        else:
-            user_names[review.user_id] = "No user"
 
-    return user_names
+@app.template_global()
+def poster_url(movie_id, poster, size='thumb'):
+    """ URL of the local copy of a poster. The hash of the poster URL changes when the poster changes """
+    if not poster_store.is_allowed(poster):
+        return poster or ''
+    return url_for('poster', movie_id=movie_id, size=size, v=poster_key(poster)[:12])
 
 
-def delete_reviews_by_user_id(user_id):
-    """Deletes all reviews associated with a given user_id."""
-    try:
-        with db.session() as session:
-            session.execute(delete(Review).where(Review.user_id == user_id))
-            session.commit()
-        print(f"Reviews for user_id {user_id} deleted successfully.")
-    except Exception as e:
-        print(f"Error deleting reviews for user_id {user_id}: {e}")
-        db.session.rollback()
+@app.route('/posters/<int:movie_id>')
+def poster(movie_id):
+    """
+        Serves the poster of a movie from the disk cache, downloading it the first time.
+        '?size=thumb' (default) is a small WebP or JPEG thumbnail, '?size=full' the original image.
+    """
+    movie = data_manager.get_movie(movie_id) or abort(404)
+    if not poster_store.is_allowed(movie.poster):
+        abort(404)
+    size = 'full' if request.args.get('size') == 'full' else 'thumb'
+    accept_webp = 'image/webp' in request.headers.get('Accept', '')
+    file_path = poster_store.get(movie.poster, size, accept_webp)
+    if file_path is None:
+        abort(404)
+
+    response = send_file(file_path, mimetype=poster_mimetype(file_path), conditional=True, etag=True,
+                         max_age=POSTER_MAX_AGE)
+    if request.args.get('v'):
+        response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+
+def poster_mimetype(file_path):
+    """ Type of a poster file, the originals of OMDb are JPEG """
+    if file_path.endswith('.webp'):
+        return 'image/webp'
+    return 'image/jpeg'
 
 
 @app.route('/')
@@ -201,43 +294,44 @@ def home():
 
 @app.route('/users', methods=['GET', 'POST'])
 def list_users():
-    """ Presents a list of all users registered in the Movie Web App"""
+    """
+        Presents a list of the users registered in the Movie Web App.
+        The users are listed by pages, '?after=<user_id>' requests the page after that user.
+    """
+    after = request.args.get('after', type=int)
+    msg = "Select a user from the list. Or click Start."
+
     if request.method == 'POST':
         user_id_to_delete = request.form.get('user_id')
 
         if user_id_to_delete:
-            delete_reviews_by_user_id(user_id_to_delete)
-            user_to_delete = db.get_or_404(User, user_id_to_delete)
-            db.session.delete(user_to_delete)
-            db.session.commit()
-
-            msg = f'{user_id_to_delete} | {user_to_delete.name}" was deleted from the users list.'
-            users = User.query.all()
-            return render_template('users.html', users=users, msg=msg)
-
-    with app.app_context():
-        if request.method == 'POST':
-            search_name = request.form.get('search_name')
-
-            if search_name:
-                users = User.query.filter(User.name.like(f"%{search_name}%")).all()
-                msg = f"Select a user from the list. Or click Start."
-                if not users:
-                    msg = f"No user was found with the name {search_name}"
-                    users = User.query.all()
-            else:
-                # Get all records from the 'User' table
-                users = User.query.all()
-                msg = "Select a user from the list. Or click Start."
-            return render_template('users.html', users=users, msg=msg)
+            data_manager.get_user(user_id_to_delete) or abort(404)
+            user_to_delete = data_manager.delete_user(user_id_to_delete)
 
+            if user_to_delete is None:
+                msg = f"The user {user_id_to_delete} couldn't be deleted, please try again."
+            else:
+                msg = f'"{user_id_to_delete} | {user_to_delete.name}" was deleted from the users list.'
+            users, next_after = data_manager.get_users_page()
+            return render_template('users.html', users=users, msg=msg, next_after=next_after)
+
+    search_name = request.values.get('search_name')
+
+    def render():
+        nonlocal msg, search_name
+        if search_name:
+            users, next_after = data_manager.get_users_page(after, search_name=search_name)
+            if not users and after is None:
+                msg = f"No user was found with the name {search_name}"
+                search_name = None
+                users, next_after = data_manager.get_users_page()
+        else:
+            users, next_after = data_manager.get_users_page(after)
 
-    # Get all records from the 'User' table
-    users = User.query.all()
-    msg = "Select a user from the list. Or click Start."
+        return render_template('users.html', users=users, msg=msg, after=after, next_after=next_after,
+                               search_name=search_name)
 
-            # Access other attributes of the User object as needed
-    return render_template('users.html', users=users, msg=msg)
+    return page_cache.get_or_render('users', (after, search_name), ['users'], render)
 
 
 @app.route('/users/<user_id>')
@@ -246,19 +340,24 @@ def user_movies(user_id):
         Uses the <user_id> to fetch the appropriate user’s movies.
         Shows a specific user’s list of favorite movies.
     """
-    user = User.query.get(user_id)
-    # Sort user movies by user_movie_association ID
-    # The last movie added is the first one listed
-    movies = (
-        db.session.query(Movie)
-        .join(user_movie_association, Movie.id == user_movie_association.c.movie_id)
-        .filter(user_movie_association.c.user_id == user_id)
-        .order_by(user_movie_association.c.id.desc())  # Added .desc() here
-        .all()
-    )
-    count_user_movies = len(movies)
+    return render_user_movies(user_id)
+
 
-    return render_template('user_movies.html', user=user, movies=movies, count_user_movies=count_user_movies)
+def render_user_movies(user_id, msg=''):
+    """
+        Renders the favorite movies page of a user.
+        The list of the favorite movies is a cached fragment, the recommendations are read every time.
+    """
+    def render_favorites():
+        user = data_manager.get_user(user_id)
+        # The last movie added is the first one listed
+        movies = data_manager.get_user_movies(user_id)
+        return render_template('user_movies_list.html', user=user, movies=movies, count_user_movies=len(movies))
+
+    favorites_html = page_cache.get_or_render('user_movies', (user_id,), [f'user:{user_id}'], render_favorites)
+    recommendations = data_manager.get_recommendations(user_id, USER_RECOMMENDATIONS)
+    return render_template('user_movies.html', user_id=user_id, favorites_html=Markup(favorites_html), msg=msg,
+                           recommendations=recommendations)
 
 
 @app.route('/add_user', methods=['GET', 'POST'])
@@ -266,11 +365,8 @@ def add_user():
     """ Presents a form that enables the addition of a new user to the Movie Web App """
     if request.method == 'POST':
         new_user_name = request.form.get('user_name')
-        new_user = User(name = new_user_name)
         if new_user_name:
-            with app.app_context():
-                db.session.add(new_user)
-                db.session.commit()  # commits the session to the DB.
+            data_manager.add_user(new_user_name)
             return redirect('/users')
 
     return render_template('add_user.html')
@@ -289,34 +385,43 @@ def add_movie(user_id):
         The function does not add the movie to the user's movie list if the movie already exists.
     """
     msg = ''
-    user = User.query.get(user_id)
+    user = data_manager.get_user(user_id)
     data = {}
 
     if request.method == 'POST':
         movie_title = request.form.get('movie_title')
         add_this_movie = request.form.get('add_this_movie')
-        from_ipa_fetched_data = fetch_data(movie_title)
-        data = get_needed_data(from_ipa_fetched_data)
-
 
         if not movie_title is None:
-            data = get_needed_data(from_ipa_fetched_data)
+            # The local catalog is checked before calling the external API
+            movie_in_catalog = data_manager.find_catalog_movie(movie_title)
+            if movie_in_catalog:
+                from_ipa_fetched_data = {'Response': 'True'}
+                data = get_catalog_data(movie_in_catalog)
+            else:
+                from_ipa_fetched_data = fetch_data(movie_title) or {'Response': 'False'}
+                data = get_needed_data(from_ipa_fetched_data)
+            movie_token = ''
             if from_ipa_fetched_data['Response'] == 'False':
                 msg = {'text': f'No movie with the search entry "{movie_title}" was found.',
                        'color': 'red'}
             else:
                 msg = {'text': f'Here is the movie found with the search entry "{movie_title}"',
                        'color': '#56ABB3'}
+                # The found movie is carried over to the confirmation in a signed token
+                movie_token = selection_serializer.dumps(data)
 
-            return render_template('add_movie.html', user_id=user_id, user=user, movie=data, msg=msg)
+            return render_template('add_movie.html', user_id=user_id, user=user, movie=data, msg=msg,
+                                   movie_token=movie_token)
 
         elif add_this_movie:
-            from_ipa_fetched_data = fetch_data(add_this_movie)
-            data = get_needed_data(from_ipa_fetched_data)
+            data = load_selected_movie(request.form.get('movie_token'))
+            if data is None:
+                from_ipa_fetched_data = fetch_data(add_this_movie) or {'Response': 'False'}
+                data = get_needed_data(from_ipa_fetched_data)
             title_in_db = data['title']
-            movie_in_db = db.session.query(Movie).filter(Movie.title == title_in_db).first()
-            title_in_user_movies = [movie.title for movie in user.movies]
-            if title_in_db in title_in_user_movies:
+            movie_in_db = data_manager.get_movie_by_title(title_in_db)
+            if data_manager.user_has_movie_title(user_id, title_in_db):
                 print("ALREADY IN THE LIST")
                 msg = {'text': f"The movie {title_in_db} is already in your favorite movies list",
                        'color': "orange"
@@ -326,48 +431,56 @@ def add_movie(user_id):
 
             elif movie_in_db:
                 id_movie_in_db = movie_in_db.id
-                connect_user_movie(user_id, id_movie_in_db)
+                data_manager.add_favorite(user_id, id_movie_in_db)
 
             else:
                 msg = f'"{add_this_movie}" was added to your movie list!'
 
-                # External function
-                id_director = add_director_return_record_id(data['director'])
+                id_director = data_manager.add_director(data['director'])
 
-                # External function
-                id_new_movie = add_movie_return_record_id(id_director, data)
+                id_new_movie = data_manager.add_movie(id_director, data)
 
                 # Adds the movie in the association list user.movies
-                connect_user_movie(user_id, id_new_movie)
+                data_manager.add_favorite(user_id, id_new_movie)
 
-            # sort movies descending
-            movies = (
-                db.session.query(Movie)
-                .join(user_movie_association, Movie.id == user_movie_association.c.movie_id)
-                .filter(user_movie_association.c.user_id == user_id)
-                .order_by(user_movie_association.c.id.desc())  # Added .desc() here
-                .all()
-            )
-            count_user_movies = len(movies)
-
-            return render_template("user_movies.html", user_id=user_id, user=user, movies=movies, msg=msg, count_user_movies=count_user_movies)
+            return render_user_movies(user_id, msg)
 
     return render_template('add_movie.html', user_id=user_id, user=user, movie=data, msg=msg)
 
 
+@app.route('/users/<user_id>/add_movies', methods=['GET', 'POST'])
+def add_movies(user_id):
+    """
+        Presents a form to add many movies at once, one title per line.
+        By POST request it adds the movies and shows the result of every title.
+    """
+    user = data_manager.get_user(user_id) or abort(404)
+    msg = {'text': f"Enter up to {MAX_BATCH_TITLES} movie titles, one per line.", 'color': '#56ABB3'}
+    results = []
+
+    if request.method == 'POST':
+        titles = parse_titles(request.form.get('movie_titles', ''))
+        if len(titles) > MAX_BATCH_TITLES:
+            msg = {'text': f"Too many titles, the maximum is {MAX_BATCH_TITLES}.", 'color': 'red'}
+        elif titles:
+            results = add_titles(user_id, titles)
+            added = sum(1 for result in results if result['status'] == 'added')
+            msg = {'text': f"{added} of {len(results)} movies were added to your movie list.", 'color': 'green'}
+
+    return render_template('add_movies.html', user=user, msg=msg, results=results)
+
+
 @app.route('/users/<user_id>/delete_movie/<movie_id>', methods=['GET', 'POST'])
 def delete_movie(user_id, movie_id):
     """ Upon visiting this route, a specific movie will be removed from a user’s favorite movie list """
-    user = db.session.query(User).get(user_id)
-    movie = db.session.query(Movie).get(movie_id)
+    user = data_manager.get_user(user_id)
+    movie = data_manager.get_movie(movie_id)
     movie_to_delete = request.form.get('delete')
     msg = f'Are you sure you want to delete this movie from your favourite movies.'
 
 
     if movie_to_delete == 'delete':
-        if user and movie:
-            user.movies.remove(movie)  # Remove the movie from the users movie list.
-            db.session.commit()
+        if data_manager.delete_movie(user_id, movie_id):
             msg = f'The film " {movie.title} " was deleted from your favorite movies list.'
             return render_template('delete_movie.html', movie=movie, user=user, msg=msg, display='none')
         else:
@@ -379,9 +492,9 @@ def delete_movie(user_id, movie_id):
 @app.route('/users/<user_id>/update_movie/<movie_id>', methods=['GET', 'POST'])
 def update_movie(user_id, movie_id):
     """ displays a form allowing for the updating of details of a specific movie in a user’s list """
-    movie = db.get_or_404(Movie, movie_id)
-    user = db.get_or_404(User, user_id)
-    bio = movie.director.bio
+    movie = data_manager.get_movie(movie_id) or abort(404)
+    user = data_manager.get_user(user_id) or abort(404)
+    bio = movie.director.bio if not movie.director.is_unknown else None
     msg = "Click Submit to save the new data"
 
 
@@ -390,25 +503,28 @@ def update_movie(user_id, movie_id):
         prompt = data.get('prompt')  # Access the 'prompt' value
 
         if not prompt:
-            update_info(data, movie)
+            data_manager.update_movie(movie, data)
             print("SE ACTUALIZÒ")
             return jsonify({'response': "FINE"}), 200
 
-        if prompt == 'bio':
-            prompt = f"Get a short text about the biography of the director of the movie '{movie.title}', '{movie.director.name}'."
-            birth = f"Get only the birthday data without extra text in the format day/month/year of the director of the movie '{movie.title}', '{movie.director.name}'."
-            death = f"Get only the death day data without any extra text in the format day/month/year of the director of the movie '{movie.title}', '{movie.director.name}'."
+        if prompt == 'bio' and movie.director.bio and not movie.director.is_unknown:
+            # Precomputed by the background enrichment, no model call
+            return jsonify({"response": movie.director.bio, "birth": movie.director.birth or '',
+                            "death": movie.director.death or ''})
+
+        elif prompt == 'bio':
+            # One structured prompt for the bio, birth and death day instead of three model calls
+            prompt = director_prompt(movie.title, movie.director.name)
             try:
-                response = fetch_from_gemini(prompt)
-                birthday = fetch_from_gemini(birth)
-                death_day = fetch_from_gemini(death)
-                return jsonify({"response": response.text, "birth": birthday.text, "death": death_day.text})
+                director_data = fetch_json_from_gemini(prompt, DIRECTOR_FIELDS)
+                return jsonify({"response": director_data['bio'], "birth": director_data['birth'],
+                                "death": director_data['death']})
             except Exception as e:
                 print(f"Error calling Gemini API: {e}")
                 return jsonify({"error": "Failed to generate text"}), 500
 
         elif prompt == 'description':
-            prompt = f"Get a short text about the movie '{movie.title}' of the director '{movie.director.name}'."
+            prompt = movie_description_prompt(movie.title, movie.director.name)
             try:
                 response = fetch_from_gemini(prompt)
                 return jsonify({"response": response.text})
@@ -420,15 +536,63 @@ def update_movie(user_id, movie_id):
     return render_template('update_movie.html', user=user, movie=movie, bio=bio, msg=msg)
 
 
+def sse_event(data, event=None):
+    """ Formats a server-sent event with JSON data """
+    lines = f'event: {event}\n' if event else ''
+    return lines + f'data: {json.dumps(data)}\n\n'
+
+
+@app.route('/users/<user_id>/update_movie/<movie_id>/stream')
+def stream_update_movie(user_id, movie_id):
+    """
+        Streams the text generated by Gemini for the update page as server-sent events.
+        '?prompt=description' streams the description of the movie, '?prompt=bio' the bio, birth and death day
+        of the director. Every event has the 'field' and the 'text' added to it, then a 'done' or 'error' event.
+    """
+    movie = data_manager.get_movie(movie_id) or abort(404)
+    data_manager.get_user(user_id) or abort(404)
+    prompt = request.args.get('prompt')
+    director = movie.director
+
+    if prompt == 'bio' and director.bio and not director.is_unknown:
+        # Precomputed by the background enrichment, no model call
+        chunks = ((field, getattr(director, field)) for field in DIRECTOR_FIELDS if getattr(director, field))
+    elif prompt == 'bio':
+        chunks = stream_json_from_gemini(director_prompt(movie.title, director.name), DIRECTOR_FIELDS)
+    elif prompt == 'description':
+        chunks = (('description', text) for text in
+                  stream_from_gemini(movie_description_prompt(movie.title, director.name)))
+    else:
+        abort(400)
+
+    def generate():
+        try:
+            for field, text in chunks:
+                yield sse_event({'field': field, 'text': text})
+        except Exception as e:
+            print(f"Error calling Gemini API: {e}")
+            yield sse_event({'error': "Failed to generate text"}, 'error')
+            return
+        yield sse_event({}, 'done')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/info/movie/<movie_id>/user/<user_id>', methods=['GET', 'POST'])
 def info_movie(movie_id, user_id):
     """ Retrieves the movie data and shows the information """
-    movie = db.get_or_404(Movie, movie_id)
-    user = db.get_or_404(User, user_id)
-    reviews = get_reviews_by_movie_id(movie_id)
-    dict_review_usernames = movie_reviews(movie_id)
+    before = request.args.get('before', type=int)
+
+    def render():
+        movie = data_manager.get_movie(movie_id) or abort(404)
+        user = data_manager.get_user(user_id) or abort(404)
+        reviews, next_before = data_manager.get_reviews(movie_id, before)
+        return render_template('info_movie.html', movie=movie, user=user, reviews=reviews, before=before,
+                               next_before=next_before)
 
-    return render_template('info_movie.html', movie=movie, user=user, reviews=reviews, dict_review_usernames=dict_review_usernames)
+    return page_cache.get_or_render('info_movie', (movie_id, user_id, before), [f'movie:{movie_id}', f'user:{user_id}'],
+                                    render)
 
 
 @app.route('/review/user/<user_id>/movie/<movie_id>/', methods=['GET', 'POST'])
@@ -437,22 +601,14 @@ def add_review(movie_id, user_id):
         Add the user's rating and review in the review table
         The reviews are shown in the movie's INFO section.
     """
-    movie = db.get_or_404(Movie, movie_id)
-    user = db.get_or_404(User, user_id)
+    movie = data_manager.get_movie(movie_id) or abort(404)
+    user = data_manager.get_user(user_id) or abort(404)
 
     if request.method == 'POST':
         new_review = request.form.get('new_review')
         user_rating = request.form.get('user_rating')
 
-        new_review = Review(
-            user_id=user_id,
-            movie_id=movie_id,
-            rating=user_rating,
-            text=new_review
-        )
-        with app.app_context():
-            db.session.add(new_review)
-            db.session.commit()  # commits the session to the DB.
+        data_manager.add_review(user_id, movie_id, user_rating, new_review)
         return redirect(f'/info/movie/{movie_id}/user/{user_id}')
 
 
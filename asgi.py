@@ -0,0 +1,47 @@
+"""
+ASGI entry point of the Movi Web App, for a production server instead of the debug server of app.py:
+    pip install uvicorn a2wsgi
+    uvicorn asgi:asgi_app --host 0.0.0.0 --port 5002
+Run one worker process: the page cache in memory, the recommendation index and a random
+SECRET_KEY exist once per process. Several workers are started with WEB_CONCURRENCY, which uvicorn
+reads as the default of --workers:
+    WEB_CONCURRENCY=4 uvicorn asgi:asgi_app --host 0.0.0.0 --port 5002
+They refuse to start without SECRET_KEY and PAGE_CACHE_REDIS_URL, which share the signed selections
+and the page cache invalidations. The recommendations of a worker can still lag the favorites added
+through the others until its index is rebuilt (every 600 seconds).
+The Flask views are synchronous and run in a pool of ASGI_THREADS threads of the adapter, which
+bounds the concurrent requests. Their OMDb and Gemini calls wait on the event loop of the http_client,
+which reads and writes the lookup caches in worker threads so a busy cache file never blocks it, and the
+batch add resolves its titles without a thread per title. But a waiting view keeps its thread, and its
+database connection once it has read from the database.
+A server-sent event stream keeps its thread until Gemini finished the answer, a poster its thread
+until the first download of the image is done, then it is served from the disk.
+Size ASGI_THREADS by Little's law: peak requests per second x seconds a request keeps its thread.
+The default 40 serves the OMDb rate limit (OMDB_RATE_PER_SECOND=20) of searches taking about
+one second plus as many streams and pages at the same time; the pages served from the database
+and the caches take milliseconds. Raise it with the rate limit or for more concurrent streams.
+The connection pool (DB_POOL_SIZE + DB_MAX_OVERFLOW) is sized to ASGI_THREADS unless they are set,
+one connection per thread, otherwise it caps the concurrent views below the thread count.
+"""
+import os
+from a2wsgi import WSGIMiddleware
+from dotenv import load_dotenv
+
+#loads variables from the .env file into the environment
+load_dotenv()
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 40))
+# Read by app.py when it creates the data manager
+os.environ.setdefault('DB_POOL_SIZE', str(ASGI_THREADS))
+os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+
+from app import app, page_cache
+from datamanager.page_cache import RedisBackend
+
+# uvicorn --workers N doesn't tell the app, the worker count is declared with WEB_CONCURRENCY
+if int(os.getenv('WEB_CONCURRENCY') or 1) > 1:
+    if not os.getenv('SECRET_KEY'):
+        raise RuntimeError("SECRET_KEY has to be set to run several worker processes")
+    if not isinstance(page_cache.backend, RedisBackend):
+        raise RuntimeError("PAGE_CACHE_REDIS_URL and the redis package are needed to run several worker processes")
+
+asgi_app = WSGIMiddleware(app, workers=ASGI_THREADS)
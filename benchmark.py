@@ -0,0 +1,422 @@
+"""
+Benchmark and load test of the Movi Web App.
+Seeds a synthetic database in a temporary data folder, starts local stand-ins of OMDb, the poster
+host and Gemini that answer after a configurable latency, serves the app on a local port and drives
+its pages, /api routes, poster route and server-sent event streams with concurrent requests.
+Reports the p50/p95/p99 latency, the throughput and the SQL queries per request of every
+route (from the Server-Timing headers, sent before the body: the queries of a streamed export or
+event stream aren't counted), saves them as a JSON baseline and fails with exit code 1 when a route
+got slower or makes more queries than the baseline allows.
+
+    python benchmark.py --save-baseline            # writes benchmark_baseline.json
+    python benchmark.py                            # compares with benchmark_baseline.json
+    python benchmark.py --users 2000 --movies 20000 --requests 500 --concurrency 16
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+
+GENRES = ['Action', 'Adventure', 'Animation', 'Comedy', 'Crime', 'Drama', 'Fantasy', 'Horror', 'Mystery',
+          'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western']
+# Titles of the OMDb stand-in that aren't in the seeded catalog, 'Missing' titles are not found
+REMOTE_TITLES = 1000
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# Poster served by the stand-in for every /posters/ path, a 30x44 JPEG
+POSTER_JPEG = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1x'
+    'eXBkeFxlZ2P/2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2P/wAAR'
+    'CAAsAB4DASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEG'
+    'E1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWG'
+    'h4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEB'
+    'AQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYk'
+    'NOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0'
+    'tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDn6KKKxPTCiiigAooooAKKKKACiiigAooo'
+    'oA//2Q=='
+)
+# Movies of the poster route, their posters are downloaded once and then served from the disk cache
+POSTER_MOVIES = 100
+
+
+class FakeServices(BaseHTTPRequestHandler):
+    """ OMDb (GET), poster host (GET /posters/) and Gemini (POST generateContent, streamGenerateContent) stand-ins """
+    omdb_latency = 0.05
+    gemini_latency = 0.3
+
+    def do_GET(self):
+        time.sleep(self.omdb_latency)
+        if self.path.startswith('/posters/'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(POSTER_JPEG)))
+            self.end_headers()
+            self.wfile.write(POSTER_JPEG)
+            return
+        title = parse_qs(urlparse(self.path).query).get('t', [''])[0]
+        if title.startswith('Missing'):
+            data = {'Response': 'False', 'Error': 'Movie not found!'}
+        else:
+            data = {'Response': 'True', 'Title': title, 'Year': '1999', 'Genre': 'Drama, Sci-Fi',
+                    'Director': f"Remote Director {len(title) % 50}", 'Plot': f"The plot of {title}.",
+                    'Poster': 'N/A', 'Ratings': [{'Source': 'Internet Movie Database', 'Value': '7.4/10'}]}
+        self.send_json(data)
+
+    def do_POST(self):
+        time.sleep(self.gemini_latency)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        config = body.get('generationConfig') or {}
+        if config.get('responseMimeType') == 'application/json':
+            text = json.dumps({'bio': "A synthetic director bio.", 'birth': '1 January 1950', 'death': ''})
+        else:
+            text = "A synthetic movie description generated for the benchmark."
+        if ':streamGenerateContent' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for start in range(0, len(text), 16):
+                self.wfile.write(f"data: {json.dumps(gemini_answer(text[start:start + 16]))}\r\n\r\n".encode())
+                self.wfile.flush()
+        else:
+            self.send_json(gemini_answer(text))
+
+    def send_json(self, data):
+        content = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServicesServer(ThreadingHTTPServer):
+    # Hundreds of concurrent lookups connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def gemini_answer(text):
+    return {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP'}]}
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def configure_environment(args, data_folder, services_url):
+    """ Points the app to the temporary data folder and the stand-ins. Runs before the app is imported """
+    os.environ['DATA_FOLDER'] = data_folder
+    os.environ['OMDB_API_URL'] = services_url + '/'
+    os.environ['GEMINI_BASE_URL'] = services_url
+    # The seeded posters are on the stand-in
+    os.environ['POSTER_HOSTS'] = urlparse(services_url).hostname
+    os.environ.setdefault('API_KEY', 'benchmark')
+    os.environ.setdefault('API_KEY_GEMINI', 'benchmark')
+    os.environ['ENRICHMENT_WORKERS'] = '0'
+    # The benchmark measures the app, not the rate limit of the OMDb plan
+    os.environ.setdefault('OMDB_RATE_PER_SECOND', '100000')
+    # Outside the temporary data folder, which is removed at the end
+    os.environ['SLOW_QUERY_LOG'] = os.path.abspath(args.slow_query_log)
+    if os.path.exists(args.slow_query_log):
+        os.remove(args.slow_query_log)
+
+
+def seed_database(args, db_file, services_url):
+    """
+        Creates the schema and inserts the synthetic users, directors, movies, genres, reviews and favorites.
+        Returns the favorites, {'user_id', 'movie_id'} dictionaries.
+    """
+    from flask import Flask
+    from datamanager.data_models import db, User, Movie, Director, Review, user_movie_association
+    from datamanager.migrations import upgrade_database
+    from datamanager.genres import set_movie_genres
+
+    rng = random.Random(args.seed)
+    seed_app = Flask(__name__)
+    seed_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_file
+    db.init_app(seed_app)
+    with seed_app.app_context():
+        db.create_all()
+        upgrade_database(db.engine)
+
+        directors = [Director(name=f"Director {number}", name_key=f"director {number}")
+                     for number in range(max(1, args.movies // 5))]
+        db.session.add_all(directors)
+        db.session.flush()
+        movies = [Movie(title=f"Benchmark Movie {number}", genre=', '.join(rng.sample(GENRES, rng.randint(1, 3))),
+                        year=str(rng.randint(1950, 2024)), rating=round(rng.uniform(1, 10), 1),
+                        poster=f"{services_url}/posters/{number}.jpg",
+                        description=f"Synthetic movie number {number}.", director_id=rng.choice(directors).id)
+                  for number in range(args.movies)]
+        db.session.add_all(movies)
+        users = [User(name=f"Benchmark User {number}") for number in range(args.users)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        movie_ids = [movie.id for movie in movies]
+        set_movie_genres(db.session.connection(), {movie.id: movie.genre for movie in movies})
+        favorites = [{'user_id': user.id, 'movie_id': movie_id} for user in users
+                     for movie_id in rng.sample(movie_ids, min(args.favorites, len(movie_ids)))]
+        db.session.execute(user_movie_association.insert(), favorites)
+        db.session.add_all(Review(user_id=user.id, movie_id=movie_id, rating=rng.randint(1, 10),
+                                  text="Synthetic review.")
+                           for user in users for movie_id in rng.sample(movie_ids, min(args.reviews, len(movie_ids))))
+        db.session.commit()
+        db.engine.dispose()
+    print(f"Seeded {args.users} users, {len(directors)} directors, {args.movies} movies, "
+          f"{len(favorites)} favorites and {args.users * min(args.reviews, len(movie_ids))} reviews.")
+    return favorites
+
+
+def scenarios(args, favorites):
+    """
+        (name, function(rng) -> (method, path, request options)) of the driven routes, the writes last.
+        delete_movie removes seeded favorites, each once, and delete_user the users created by add_user.
+    """
+    def user_id(rng):
+        return rng.randint(1, args.users)
+
+    def movie_id(rng):
+        return rng.randint(1, args.movies)
+
+    def remote_title(rng):
+        return f"Remote Movie {rng.randrange(REMOTE_TITLES)}"
+
+    deleted_favorites = iter(random.Random(args.seed).sample(favorites, len(favorites)))
+    deleted_users = itertools.count(args.users + 1)
+
+    def delete_favorite(rng):
+        # Once the seeded favorites are used up, the repeated deletes fail and are counted as errors
+        favorite = next(deleted_favorites, favorites[0])
+        path = f"/users/{favorite['user_id']}/delete_movie/{favorite['movie_id']}"
+        return 'POST', path, {'data': {'delete': 'delete'}}
+
+    def import_body(rng):
+        """ NDJSON of remote movies added as favorites of a user """
+        return '\n'.join(json.dumps({'title': remote_title(rng), 'year': '1999', 'genre': 'Drama',
+                                     'director': 'Remote Director 1', 'user_id': user_id(rng)}) for _ in range(5))
+
+    return [
+        ('home', lambda rng: ('GET', '/', {})),
+        ('list_users', lambda rng: ('GET', '/users', {})),
+        ('search_users', lambda rng: ('POST', '/users', {'data': {'search_name': f"User {user_id(rng)}"}})),
+        ('add_user_form', lambda rng: ('GET', '/add_user', {})),
+        ('user_movies', lambda rng: ('GET', f'/users/{user_id(rng)}', {})),
+        ('info_movie', lambda rng: ('GET', f'/info/movie/{movie_id(rng)}/user/{user_id(rng)}', {})),
+        ('add_movie_form', lambda rng: ('GET', f'/users/{user_id(rng)}/add_movie', {})),
+        ('add_movies_form', lambda rng: ('GET', f'/users/{user_id(rng)}/add_movies', {})),
+        ('update_movie_form', lambda rng: ('GET', f'/users/{user_id(rng)}/update_movie/{movie_id(rng)}', {})),
+        ('delete_movie_form', lambda rng: ('GET', f'/users/{user_id(rng)}/delete_movie/{movie_id(rng)}', {})),
+        ('add_review_form', lambda rng: ('GET', f'/review/user/{user_id(rng)}/movie/{movie_id(rng)}/', {})),
+        ('add_movie_search_catalog', lambda rng: ('POST', f'/users/{user_id(rng)}/add_movie',
+                                                  {'data': {'movie_title': f"Benchmark Movie {movie_id(rng) - 1}"}})),
+        ('add_movie_search_omdb', lambda rng: ('POST', f'/users/{user_id(rng)}/add_movie',
+                                               {'data': {'movie_title': remote_title(rng)}})),
+        ('update_movie_description', lambda rng: ('POST', f'/users/{user_id(rng)}/update_movie/{movie_id(rng)}',
+                                                  {'json': {'prompt': 'description'}})),
+        ('update_movie_bio', lambda rng: ('POST', f'/users/{user_id(rng)}/update_movie/{movie_id(rng)}',
+                                          {'json': {'prompt': 'bio'}})),
+        ('stream_movie_description', lambda rng: ('GET', f'/users/{user_id(rng)}/update_movie/{movie_id(rng)}/stream',
+                                                  {'params': {'prompt': 'description'}})),
+        ('stream_movie_bio', lambda rng: ('GET', f'/users/{user_id(rng)}/update_movie/{movie_id(rng)}/stream',
+                                          {'params': {'prompt': 'bio'}})),
+        ('poster', lambda rng: ('GET', f'/posters/{rng.randint(1, min(POSTER_MOVIES, args.movies))}', {})),
+        ('api_users', lambda rng: ('GET', '/api/users', {})),
+        ('api_search', lambda rng: ('GET', '/api/search', {'params': {'q': f"movie {rng.randrange(args.movies)}"}})),
+        ('api_user_movies', lambda rng: ('GET', f'/api/users/{user_id(rng)}/movies', {})),
+        ('api_recommendations', lambda rng: ('GET', f'/api/users/{user_id(rng)}/recommendations', {})),
+        ('api_similar', lambda rng: ('GET', f'/api/movies/{movie_id(rng)}/similar', {})),
+        ('api_top_rated', lambda rng: ('GET', '/api/movies/top-rated', {})),
+        ('api_most_favorited', lambda rng: ('GET', '/api/movies/most-favorited', {})),
+        ('api_genres', lambda rng: ('GET', '/api/genres', {})),
+        ('api_genre_movies', lambda rng: ('GET', f'/api/genres/{rng.choice(GENRES)}/movies', {})),
+        ('api_export', lambda rng: ('GET', '/api/export', {})),
+        ('api_export_csv', lambda rng: ('GET', '/api/export', {'params': {'format': 'csv', 'entity': 'movies'}})),
+        ('api_jobs', lambda rng: ('GET', '/api/jobs', {})),
+        ('api_cache_stats', lambda rng: ('GET', '/api/cache/stats', {})),
+        ('metrics', lambda rng: ('GET', '/metrics', {})),
+        ('add_movie_confirm', lambda rng: ('POST', f'/users/{user_id(rng)}/add_movie',
+                                           {'data': {'add_this_movie': remote_title(rng)}})),
+        ('api_add_movie', lambda rng: ('POST', f'/api/add_movie/{user_id(rng)}/movie',
+                                       {'data': {'title': remote_title(rng), 'genre': 'Drama',
+                                                 'director': 'Remote Director 1'}})),
+        ('api_add_movies_batch', lambda rng: ('POST', f'/api/users/{user_id(rng)}/movies/batch',
+                                              {'json': {'titles': [remote_title(rng) for _ in range(5)]}})),
+        ('add_movies', lambda rng: ('POST', f'/users/{user_id(rng)}/add_movies',
+                                    {'data': {'movie_titles': '\n'.join(remote_title(rng) for _ in range(5))}})),
+        # The jobs queued by the movies added above, or 404
+        ('api_job', lambda rng: ('GET', f'/api/jobs/{rng.randint(1, 100)}', {})),
+        ('add_review', lambda rng: ('POST', f'/review/user/{user_id(rng)}/movie/{movie_id(rng)}/',
+                                    {'data': {'new_review': "Benchmark review.",
+                                              'user_rating': str(rng.randint(1, 10))}})),
+        ('add_user', lambda rng: ('POST', '/add_user', {'data': {'user_name': f"Added User {rng.random()}"}})),
+        ('delete_movie', delete_favorite),
+        ('delete_user', lambda rng: ('POST', '/users', {'data': {'user_id': str(next(deleted_users))}})),
+        # Last, an import makes the recommendation index and every cached page stale
+        ('api_import', lambda rng: ('POST', '/api/import', {'data': import_body(rng).encode(),
+                                                            'headers': {'Content-Type': 'application/x-ndjson'}})),
+    ]
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of the sorted values """
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def run_scenario(base_url, build_request, args, seed):
+    """ Sends args.requests requests of a route with args.concurrency concurrent clients """
+    sessions = threading.local()
+    rngs = [random.Random(f'{seed}:{number}') for number in range(args.requests + args.warmup)]
+
+    def send(rng):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        method, path, options = build_request(rng)
+        start = time.perf_counter()
+        response = sessions.session.request(method, base_url + path, allow_redirects=False, timeout=60, **options)
+        latency = time.perf_counter() - start
+        queries = re.search(r'desc="(\d+) queries"', response.headers.get('Server-Timing', ''))
+        return latency, int(queries.group(1)) if queries else 0, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, rngs[:args.warmup]))
+        start = time.perf_counter()
+        results = list(executor.map(send, rngs[args.warmup:]))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _, _ in results)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, _, status in results if status >= 500),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'queries_per_request': round(statistics.mean(queries for _, queries, _ in results), 2),
+    }
+
+
+def find_regressions(results, baseline, threshold, min_delta_ms):
+    """ Returns the descriptions of the routes slower (p95) or with more queries than the baseline allows """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('routes', {}).get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold) and \
+                result['p95_ms'] - before['p95_ms'] > min_delta_ms:
+            regressions.append(f"{name}: p95 {before['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result['queries_per_request'] > before['queries_per_request'] * (1 + threshold) + 0.5:
+            regressions.append(f"{name}: queries per request {before['queries_per_request']} -> "
+                               f"{result['queries_per_request']}")
+        if result['errors'] > before['errors']:
+            regressions.append(f"{name}: {result['errors']} server errors")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark and load test of the Movi Web App")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--favorites', type=int, default=20, help="Favorite movies per user")
+    parser.add_argument('--reviews', type=int, default=5, help="Reviews per user")
+    parser.add_argument('--requests', type=int, default=200, help="Measured requests per route")
+    parser.add_argument('--warmup', type=int, default=10, help="Requests per route before the measure")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--omdb-latency', type=float, default=50, help="Milliseconds of the OMDb stand-in")
+    parser.add_argument('--gemini-latency', type=float, default=300, help="Milliseconds of the Gemini stand-in")
+    parser.add_argument('--route', action='append', help="Route to drive, can be repeated. Default all")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="Saves the results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed slowdown of the p95, 0.25 = 25%%")
+    parser.add_argument('--min-delta-ms', type=float, default=2, help="Smaller p95 slowdowns are noise")
+    parser.add_argument('--output', help="Writes the results to this JSON file")
+    parser.add_argument('--slow-query-log', default='benchmark_slow_queries.log')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    with tempfile.TemporaryDirectory(prefix='moviweb-benchmark-', ignore_cleanup_errors=True) as data_folder:
+        return run_benchmark(args, data_folder)
+
+
+def run_benchmark(args, data_folder):
+    """ Seeds the data folder, serves the app and drives the routes. Returns the exit code """
+    FakeServices.omdb_latency = args.omdb_latency / 1000
+    FakeServices.gemini_latency = args.gemini_latency / 1000
+    services_url = start_server(FakeServicesServer(('127.0.0.1', 0), FakeServices))
+    configure_environment(args, data_folder, services_url)
+    favorites = seed_database(args, os.path.join(data_folder, 'sqlite.db'), services_url)
+
+    # The app reads its configuration from the environment when it is imported
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app import app
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    base_url = start_server(make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler))
+
+    results = {}
+    for name, build_request in scenarios(args, favorites):
+        if args.route and name not in args.route:
+            continue
+        results[name] = result = run_scenario(base_url, build_request, args, f'{args.seed}:{name}')
+        print(f"{name:<28} p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+              f"p99 {result['p99_ms']:>8.2f} ms  {result['throughput_rps']:>8.1f} req/s  "
+              f"{result['queries_per_request']:>6.2f} queries  {result['errors']} errors")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': {name: getattr(args, name) for name in ('users', 'movies', 'favorites', 'reviews', 'requests',
+                                                            'concurrency', 'omdb_latency', 'gemini_latency', 'seed')},
+        'routes': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+    print(f"Slow queries are logged in {os.environ['SLOW_QUERY_LOG']}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline {args.baseline}, run with --save-baseline to create it.")
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('settings') != report['settings']:
+        print("The settings differ from the baseline, the comparison isn't reliable.")
+    regressions = find_regressions(results, baseline, args.threshold, args.min_delta_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regression beyond {args.threshold:.0%} of the baseline.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
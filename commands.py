@@ -0,0 +1,92 @@
+"""
+Command line commands of the Movi Web App.
+Run them with: flask --app app <command>
+"""
+import json
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from datamanager.data_models import db
+from datamanager.migrations import compact_directors
+from datamanager.exporter import EXPORT_QUERIES
+from datamanager.importer import parse_records
+from datamanager.enrichment import EnrichmentWorker
+from datamanager.jobs import job_counts
+from datamanager.genres import backfill_genres
+
+
+@click.command('compact-directors')
+@with_appcontext
+def compact_directors_command():
+    """ Merges the duplicated directors and repoints their movies """
+    with db.engine.begin() as connection:
+        removed = compact_directors(connection)
+    print(f"{removed} duplicated directors were merged.")
+
+
+@click.command('backfill-genres')
+@with_appcontext
+def backfill_genres_command():
+    """ Links every movie to the genre rows of its comma-joined genre text """
+    with db.engine.begin() as connection:
+        count = backfill_genres(connection)
+    print(f"The genres of {count} movies were linked.")
+
+
+@click.command('export')
+@click.option('--format', 'export_format', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--entity', 'entities', multiple=True, type=click.Choice(list(EXPORT_QUERIES)),
+              help="Entity to export, can be repeated. Default all (ndjson).")
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help="Output file, default stdout.")
+@with_appcontext
+def export_command(export_format, entities, output):
+    """ Streams users, directors, movies, favorites and reviews as NDJSON or CSV """
+    entities = list(entities) or list(EXPORT_QUERIES)
+    if export_format == 'csv':
+        if len(entities) != 1:
+            raise click.UsageError("CSV exports one --entity at a time")
+        chunks = current_app.extensions['data_manager'].export_csv(entities[0])
+    else:
+        chunks = current_app.extensions['data_manager'].export_ndjson(entities)
+    for chunk in chunks:
+        output.write(chunk)
+
+
+@click.command('import-movies')
+@click.argument('input_file', type=click.File('r', encoding='utf-8'))
+@click.option('--results', type=click.File('w', encoding='utf-8'), help="Writes the result of every record as NDJSON.")
+@with_appcontext
+def import_movies_command(input_file, results):
+    """ Imports a JSON array or NDJSON file of movies and favorites in chunked transactions """
+    start = time.perf_counter()
+    records = parse_records(input_file.read())
+    import_results = current_app.extensions['data_manager'].import_movies(records)
+    elapsed = time.perf_counter() - start
+
+    if results:
+        for result in import_results:
+            results.write(json.dumps(result) + '\n')
+    counts = {status: sum(1 for result in import_results if result['status'] == status)
+              for status in ('created', 'existing', 'error')}
+    print(f"{len(records)} records in {elapsed:.2f} seconds ({len(records) / elapsed if elapsed else 0:.0f}/s): "
+          f"{counts['created']} created, {counts['existing']} existing, {counts['error']} errors.")
+
+
+@click.command('run-worker')
+@click.option('--workers', type=int, default=2, show_default=True, help="Number of worker threads.")
+@click.option('--rate', type=int, default=15, show_default=True, help="Gemini calls per minute.")
+@click.option('--max-attempts', type=int, default=5, show_default=True)
+@with_appcontext
+def run_worker_command(workers, rate, max_attempts):
+    """ Runs the background AI enrichment of movies and directors until Ctrl+C """
+    worker = EnrichmentWorker(current_app._get_current_object(), workers=workers, rate_per_minute=rate,
+                              max_attempts=max_attempts)
+    worker.start()
+    print(f"{workers} enrichment workers started: {job_counts(db.session)}")
+    try:
+        while any(thread.is_alive() for thread in worker.threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping the workers after their current job...")
+        worker.stop()
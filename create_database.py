@@ -1,13 +1,17 @@
-""" This script create the tables (models) in a database """
+""" This script create the tables (models) in a database and migrates an existing database to the last version """
 import os
+from dotenv import load_dotenv
 from flask import Flask
 """ db and models imported from data_models.py """
 from datamanager.data_models import db
+from datamanager.migrations import upgrade_database
 
+#loads variables from the .env file into the environment
+load_dotenv()
 app = Flask(__name__)
 
-# data_folder is el Path to folder data
-data_folder = os.path.join(app.root_path, 'data')
+# data_folder is el Path to folder data, DATA_FOLDER points to another database like for app.py
+data_folder = os.getenv('DATA_FOLDER') or os.path.join(app.root_path, 'data')
 if not os.path.exists(data_folder):
     os.makedirs(data_folder)
 
@@ -16,4 +20,7 @@ db.init_app(app)
 
 with app.app_context():
     db.create_all()
-print(f"Tables created in the database.")
\ No newline at end of file
+    print(f"Tables created in the database.")
+
+    if not upgrade_database(db.engine):
+        print("The database is up to date.")
@@ -0,0 +1,64 @@
+"""
+Batch add of movies by title to the favorite movies list of a user.
+The titles found in the local catalog don't call OMDb, the others are looked up
+concurrently as coroutines on the event loop of the http_client, at most 'concurrency'
+at a time (the OMDb calls share a rate limiter).
+All the movies are then written in one transaction with the bulk import.
+"""
+import asyncio
+import os
+from dotenv import load_dotenv
+from datamanager.lookup_cache import normalize_key
+
+#loads variables from the .env file into the environment
+load_dotenv()
+
+MAX_BATCH_TITLES = 500
+# Concurrent OMDb lookups of a batch add
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 50))
+
+
+def parse_titles(titles):
+    """ Returns the titles of a list or of a text with one title per line, without empty or repeated titles """
+    if isinstance(titles, str):
+        titles = titles.splitlines()
+    unique_titles = {}
+    for title in titles:
+        title = ' '.join(str(title).split())
+        if title:
+            unique_titles.setdefault(normalize_key(title), title)
+    return list(unique_titles.values())
+
+
+async def resolve_titles(titles, lookup, concurrency=BATCH_CONCURRENCY):
+    """
+        Awaits lookup(title) for every title with at most 'concurrency' lookups at a time.
+        Returns {title: (result, error)}, 'error' is the exception raised by the lookup or None.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(title):
+        async with semaphore:
+            try:
+                return title, (await lookup(title), None)
+            except Exception as e:
+                return title, (None, e)
+
+    return dict(await asyncio.gather(*(resolve(title) for title in titles)))
+
+
+def movie_record(user_id, data):
+    """ Bulk import record of the movie data (the dictionary of get_needed_data) for the favorites of a user """
+    record = {field: data.get(field) for field in ('title', 'genre', 'year', 'rating', 'poster', 'description',
+                                                   'director')}
+    record['user_id'] = user_id
+    return record
+
+
+def title_status(import_result):
+    """ Status of a title from the result of its import record """
+    if import_result['status'] == 'error':
+        return 'error'
+    if import_result.get('favorites_added'):
+        return 'added'
+    return 'already_in_list'
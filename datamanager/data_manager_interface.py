@@ -10,6 +10,18 @@ class DataManagerInterface(ABC):
         pass
 
 
+    @abstractmethod
+    def search_users(self, search_name, limit=20):
+        """ Returns the users whose name matches the search. """
+        pass
+
+
+    @abstractmethod
+    def get_user(self, user_id):
+        """ Returns a user by id or None if it doesn't exist. """
+        pass
+
+
     @abstractmethod
     def get_user_movies(self, user_id):
         """ Returns a list of all movies of a specific user. """
@@ -17,24 +29,144 @@ class DataManagerInterface(ABC):
 
 
     @abstractmethod
-    def add_user(self):
+    def add_user(self, name):
         """ Adds a new user to the database. """
         pass
 
 
     @abstractmethod
-    def add_movie(self):
+    def delete_user(self, user_id):
+        """ Deletes a user with the reviews and the favorite movies list of the user. """
+        pass
+
+
+    @abstractmethod
+    def get_movie(self, movie_id):
+        """ Returns a movie by id or None if it doesn't exist. """
+        pass
+
+
+    @abstractmethod
+    def search_movies(self, search_text, limit=20, column=None):
+        """ Returns the movies that match the search. """
+        pass
+
+
+    @abstractmethod
+    def add_director(self, director_name):
+        """ Adds a director if it doesn't exist yet and returns the id of the director. """
+        pass
+
+
+    @abstractmethod
+    def add_movie(self, director_id, data):
         """ Adds a new movie to the database """
         pass
 
 
     @abstractmethod
-    def update_movie(self):
+    def add_favorite(self, user_id, movie_id):
+        """ Adds a movie to the favorite movies list of a user. """
+        pass
+
+
+    @abstractmethod
+    def add_favorite_movies(self, user_id, records):
+        """ Adds several movies to the favorite movies list of a user in one transaction. """
+        pass
+
+
+    @abstractmethod
+    def import_movies(self, records):
+        """ Imports movies and favorites in bulk. """
+        pass
+
+
+    @abstractmethod
+    def export_ndjson(self, entities):
+        """ Exports the rows of the entities as NDJSON. """
+        pass
+
+
+    @abstractmethod
+    def export_csv(self, entity):
+        """ Exports the rows of one entity as CSV. """
+        pass
+
+
+    @abstractmethod
+    def update_movie(self, movie, data):
         """ Updates the details of a specific movie in the database """
         pass
 
 
     @abstractmethod
-    def delete_movie(self):
-        """ Deletes a specific movie from the database. """
-        pass
\ No newline at end of file
+    def delete_movie(self, user_id, movie_id):
+        """ Deletes a specific movie from the favorite movies list of a user. """
+        pass
+
+
+    @abstractmethod
+    def get_recommendations(self, user_id, limit=10):
+        """ Returns the movies recommended to a user. """
+        pass
+
+
+    @abstractmethod
+    def get_similar_movies(self, movie_id, limit=10):
+        """ Returns the movies also saved by the users who saved a movie. """
+        pass
+
+
+    @abstractmethod
+    def get_top_rated(self, limit=10, min_ratings=1):
+        """ Returns the movies with the best average review rating. """
+        pass
+
+
+    @abstractmethod
+    def get_most_favorited(self, limit=10):
+        """ Returns the movies saved by most users. """
+        pass
+
+
+    @abstractmethod
+    def get_genres(self):
+        """ Returns the genres with the number of their movies. """
+        pass
+
+
+    @abstractmethod
+    def get_genre_movies(self, genre_ids, after=None, limit=50):
+        """ Returns a page of the movies that have all the genres. """
+        pass
+
+
+    @abstractmethod
+    def get_reviews(self, movie_id, before=None, limit=None):
+        """ Returns a page of the reviews of a movie. """
+        pass
+
+
+    @abstractmethod
+    def add_review(self, user_id, movie_id, rating, text):
+        """ Adds the review of a user for a movie. """
+        pass
+
+
+    @abstractmethod
+    def get_job_counts(self):
+        """ Returns the number of background enrichment jobs by kind and status. """
+        pass
+
+
+    @abstractmethod
+    def get_failed_jobs(self, limit=20):
+        """ Returns the last enrichment jobs that failed. """
+        pass
+
+
+    @abstractmethod
+    def get_job(self, job_id):
+        """ Returns a specific enrichment job. """
+        pass
@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship, Mapped, mapped_column
-from sqlalchemy import Table, Column, Integer, ForeignKey
+from sqlalchemy import Table, Column, Integer, ForeignKey, Index, func
+from sqlalchemy.dialects.sqlite import insert
+import time
 
 
 """ SQLAlchemy() creates a db object. 
@@ -12,7 +14,9 @@ movie_genre_association = Table(
     'movie_genre_association',
     db.metadata,
     Column('movie_id', Integer, ForeignKey('movie.id'), primary_key=True),
-    Column('genre_id', Integer, ForeignKey('genre.id'), primary_key=True)
+    Column('genre_id', Integer, ForeignKey('genre.id'), primary_key=True),
+    # The movies of a genre sorted by id, for the genre browsing
+    Index('ix_movie_genre_association_genre_id_movie_id', 'genre_id', 'movie_id')
 )
 
 
@@ -22,12 +26,17 @@ user_movie_association = Table(
     db.metadata,
     Column('id', Integer, primary_key=True),
     Column('user_id', Integer, ForeignKey('user.id')),
-    Column('movie_id', Integer, ForeignKey('movie.id'))
+    Column('movie_id', Integer, ForeignKey('movie.id')),
+    Index('uq_user_movie_association_user_movie', 'user_id', 'movie_id', unique=True),
+    # Filters by user_id and gives the ORDER BY user_movie_association.id DESC for free
+    Index('ix_user_movie_association_user_id_id', 'user_id', 'id'),
+    Index('ix_user_movie_association_movie_id', 'movie_id')
 )
 
 
 class User(db.Model):
     """  Each instance of mapped_column() generate a Column object """
+    __table_args__ = (Index('ix_user_name', 'name'),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(nullable=False)
     reviews: Mapped[list["Review"]] = relationship(back_populates="user")
@@ -42,6 +51,7 @@ class User(db.Model):
 
 class Movie(db.Model):
     """  Each instance of mapped_column() generate a Column object """
+    __table_args__ = (Index('ix_movie_title', 'title'),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     title: Mapped[str] = mapped_column(nullable=False)
     genre: Mapped[str] = mapped_column(nullable=True)
@@ -54,6 +64,7 @@ class Movie(db.Model):
     director: Mapped["Director"] = relationship(back_populates="movies")
     genres: Mapped[list["Genre"]] = relationship(secondary=movie_genre_association, back_populates="movies")
     users: Mapped[list["User"]] = relationship(secondary=user_movie_association, back_populates="movies")
+    stats: Mapped["MovieStats"] = relationship(viewonly=True)
 
     def __repr__(self):
         return f"Object Type Movie"
@@ -62,8 +73,47 @@ class Movie(db.Model):
         return f"movie title: {self.title}\n"
 
 
+# Finds a movie by title ignoring the case, with its year (de-duplication of the imports)
+Index('ix_movie_title_lower_year', func.lower(Movie.title), Movie.year)
+
+
+def sqlite_lower(text):
+    """ Lowercases like the SQLite lower() function of the expression indexes, which only changes ASCII letters """
+    return ''.join(char.lower() if char.isascii() else char for char in text)
+
+
+class MovieStats(db.Model):
+    """
+        Review and favorite aggregates of a movie.
+        The rows are maintained by triggers on review and user_movie_association (migration 6),
+        in the same transaction as the write, so they are never recomputed by the reads.
+    """
+    __tablename__ = 'movie_stats'
+    __table_args__ = (
+        Index('ix_movie_stats_rating_avg', 'rating_avg', 'rated_count'),
+        Index('ix_movie_stats_favorite_count', 'favorite_count'),
+    )
+    movie_id: Mapped[int] = mapped_column(ForeignKey('movie.id'), primary_key=True)
+    review_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    # Reviews with a numeric rating
+    rated_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    rating_sum: Mapped[float] = mapped_column(nullable=False, default=0)
+    rating_avg: Mapped[float] = mapped_column(nullable=True)
+    favorite_count: Mapped[int] = mapped_column(nullable=False, default=0)
+
+    def __repr__(self):
+        return f"Object Type: MovieStats"
+
+    def __str__(self):
+        return f"movie stats: {self.movie_id} {self.rating_avg} {self.favorite_count}\n"
+
+
 class Review(db.Model):
     """  Each instance of mapped_column() generate a Column object """
+    __table_args__ = (
+        Index('ix_review_movie_id_review_id', 'movie_id', 'review_id'),
+        Index('ix_review_user_id', 'user_id'),
+    )
     review_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), nullable=False)
     movie_id: Mapped[int] = mapped_column(ForeignKey('movie.id'), nullable=False)
@@ -79,10 +129,23 @@ class Review(db.Model):
         return f"review user: {self.user}\n review movie: {self.movie.title}"
 
 
+# Director of the movies whose director is unknown, OMDb answers 'N/A'.
+# It is not de-duplicated, every such movie has its own director row.
+MISSING_DIRECTOR = 'N/A'
+
+
+def director_name(name):
+    """ Returns the director name with collapsed whitespaces, MISSING_DIRECTOR for an empty or blank name """
+    return ' '.join(str(name or '').split()) or MISSING_DIRECTOR
+
+
 class Director(db.Model):
     """  Each instance of mapped_column() generate a Column object """
+    __table_args__ = (Index('uq_director_name_key', 'name_key', unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(nullable=True)
+    # Normalized name, a director is stored only once
+    name_key: Mapped[str] = mapped_column(nullable=True)
     birth: Mapped[str] = mapped_column(nullable=True)
     death: Mapped[str] = mapped_column(nullable=True)
     bio: Mapped[str] = mapped_column(nullable=True)
@@ -94,6 +157,45 @@ class Director(db.Model):
     def __str__(self):
         return f"director name: {self.name}\n"
 
+    @staticmethod
+    def normalize_name(name):
+        """
+            Returns the name case-insensitive and with collapsed whitespaces,
+            None for an empty name or MISSING_DIRECTOR, which are never de-duplicated
+        """
+        if not name or not name.strip():
+            return None
+        name_key = ' '.join(name.split()).casefold()
+        if name_key == MISSING_DIRECTOR.casefold():
+            return None
+        return name_key
+
+    @property
+    def is_unknown(self):
+        """ The director of a movie whose director is unknown, its bio can't be looked up """
+        return Director.normalize_name(self.name) is None
+
+    @classmethod
+    def get_or_create(cls, name):
+        """
+            Returns the id of the director with the normalized name, inserting it if it doesn't exist.
+            The insert relies on the unique name_key index, so concurrent calls don't create duplicates.
+            An empty name or MISSING_DIRECTOR always inserts a new director.
+            The caller commits the session.
+        """
+        name = director_name(name)
+        name_key = cls.normalize_name(name)
+        if name_key is None:
+            director = cls(name=name)
+            db.session.add(director)
+            db.session.flush()
+            return director.id
+        db.session.execute(
+            insert(cls).values(name=name, name_key=name_key)
+            .on_conflict_do_nothing(index_elements=['name_key'])
+        )
+        return db.session.query(cls.id).filter_by(name_key=name_key).scalar()
+
 
 class Genre(db.Model):
     """  Each instance of mapped_column() generate a Column object """
@@ -106,4 +208,33 @@ class Genre(db.Model):
         return f"Object Type: Genre"
 
     def __str__(self):
-        return f"genre: {self.name}\n"
\ No newline at end of file
+        return f"genre: {self.name}\n"
+
+
+# A genre is stored once, whatever the case of its name
+Index('uq_genre_name_lower', func.lower(Genre.name), unique=True)
+
+
+class EnrichmentJob(db.Model):
+    """ Background AI enrichment of a movie description ('movie_description') or a director bio ('director_bio') """
+    __table_args__ = (
+        Index('uq_enrichment_job_kind_target', 'kind', 'target_id', unique=True),
+        Index('ix_enrichment_job_status_run_after', 'status', 'run_after'),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(nullable=False)
+    target_id: Mapped[int] = mapped_column(nullable=False)
+    # pending, running, done or failed
+    status: Mapped[str] = mapped_column(nullable=False, default='pending')
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    last_error: Mapped[str] = mapped_column(nullable=True)
+    # Epoch seconds, a retried job waits for its backoff
+    run_after: Mapped[float] = mapped_column(nullable=False, default=0)
+    created_at: Mapped[float] = mapped_column(nullable=False, default=time.time)
+    updated_at: Mapped[float] = mapped_column(nullable=False, default=time.time)
+
+    def __repr__(self):
+        return f"Object Type: EnrichmentJob"
+
+    def __str__(self):
+        return f"job: {self.kind} {self.target_id} {self.status}\n"
@@ -0,0 +1,147 @@
+"""
+Background workers of the AI enrichment of movies and directors.
+The workers take the jobs of the enrichment_job queue (datamanager/jobs.py), ask Gemini
+for the description of a movie or the bio, birth and death day of a director and store
+them, so the pages read precomputed fields instead of waiting on the model.
+They also download the posters of the new movies to the poster store of the app.
+The Gemini calls of all the threads share one rate limiter, failed jobs are retried
+with exponential backoff and marked failed after 'max_attempts'.
+"""
+import threading
+from flask import current_app
+from sqlalchemy import select
+from datamanager.data_models import db, Movie, Director
+from datamanager.gemini_ai import fetch_from_gemini, fetch_json_from_gemini, movie_description_prompt, \
+    director_prompt, DIRECTOR_FIELDS
+from datamanager.http_client import RateLimiter
+from datamanager.jobs import claim_job, finish_job, fail_job, requeue_stale_jobs
+
+
+def is_missing(value):
+    """ OMDb answers 'N/A' for the fields it doesn't have """
+    return not value or value.strip() in ('', 'N/A')
+
+
+def enrich_movie_description(movie_id):
+    """
+        Generates the AI description of a movie. The answer is kept in the Gemini cache,
+        so the description button of the update page doesn't call the model again,
+        and it is stored as the description of the movie if it has none.
+    """
+    movie = db.session.get(Movie, movie_id)
+    if movie is None:
+        return
+    director_name = movie.director.name if movie.director else ''
+    response = fetch_from_gemini(movie_description_prompt(movie.title, director_name))
+    if response.text and is_missing(movie.description):
+        movie.description = response.text
+        db.session.commit()
+        current_app.extensions['data_manager'].invalidate_pages(f'movie:{movie_id}')
+
+
+def enrich_director_bio(director_id):
+    """ Generates the bio, birth and death day of a director and stores the fields that are empty """
+    director = db.session.get(Director, director_id)
+    if director is None:
+        return
+    # The prompt names a movie of the director, it tells apart directors with the same name
+    movie_title = db.session.execute(
+        select(Movie.title).where(Movie.director_id == director_id).order_by(Movie.id).limit(1)
+    ).scalar() or ''
+    director_data = fetch_json_from_gemini(director_prompt(movie_title, director.name), DIRECTOR_FIELDS)
+    if not director_data['bio']:
+        raise ValueError("Gemini answered without a bio")
+    for field in DIRECTOR_FIELDS:
+        if director_data[field] and is_missing(getattr(director, field)):
+            setattr(director, field, director_data[field])
+    db.session.commit()
+    # The info pages of the movies of the director show the bio
+    data_manager = current_app.extensions['data_manager']
+    data_manager.invalidate_pages(*data_manager.movie_page_tags(
+        db.session.scalars(select(Movie.id).where(Movie.director_id == director_id))))
+
+
+def prewarm_poster(movie_id):
+    """ Downloads the poster of a movie and makes its thumbnails before its first page view """
+    movie = db.session.get(Movie, movie_id)
+    if movie is None:
+        return
+    if not current_app.extensions['poster_store'].prewarm(movie.poster):
+        raise ValueError(f"The poster {movie.poster} couldn't be downloaded")
+
+
+JOB_HANDLERS = {
+    'movie_description': enrich_movie_description,
+    'director_bio': enrich_director_bio,
+    'poster': prewarm_poster,
+}
+# Jobs that call Gemini and share its rate limit
+GEMINI_JOB_KINDS = ('movie_description', 'director_bio')
+
+
+class EnrichmentWorker:
+    """ Pool of threads that run the enrichment jobs inside the app context of the Flask app """
+
+    def __init__(self, app, workers=2, rate_per_minute=15, max_attempts=5, poll_interval=5,
+                 retry_base=30, retry_max=3600):
+        self.app = app
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate_per_minute, per=60)
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        """ Requeues the jobs of a stopped worker and starts the threads """
+        with self.app.app_context():
+            requeued = requeue_stale_jobs(db.session)
+        if requeued:
+            print(f"{requeued} enrichment jobs were requeued.")
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f'enrichment-worker-{number}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Asks the threads to stop after their current job and waits for them """
+        self._stop.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def run(self):
+        """ Loop of a worker thread: claims a job, runs it, waits when the queue is empty """
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    job = claim_job(db.session)
+                except Exception as e:
+                    print(f"Error claiming an enrichment job: {e}")
+                    db.session.rollback()
+                    job = None
+                if job is not None:
+                    self.run_job(job)
+            if job is None:
+                self._stop.wait(self.poll_interval)
+
+    def run_job(self, job):
+        """ Runs a claimed job and records its result """
+        try:
+            if job.kind in GEMINI_JOB_KINDS:
+                self.rate_limiter.acquire()
+            JOB_HANDLERS[job.kind](job.target_id)
+        except Exception as e:
+            db.session.rollback()
+            if job.attempts >= self.max_attempts:
+                print(f"Enrichment job {job.id} ({job.kind} {job.target_id}) failed: {e}")
+                fail_job(db.session, job.id, e)
+            else:
+                fail_job(db.session, job.id, e, retry_in=self.retry_delay(job.attempts))
+            return
+        finish_job(db.session, job.id)
+
+    def retry_delay(self, attempts):
+        """ Seconds to wait before the next attempt, doubled after every failure """
+        return min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
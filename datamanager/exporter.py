@@ -0,0 +1,62 @@
+"""
+Streaming bulk export of the data of the Movi Web App as NDJSON or CSV.
+The rows are read with server-side cursor batching (yield_per) and written
+as they come, so the memory stays constant with any number of rows.
+"""
+import csv
+import io
+import json
+from sqlalchemy import select
+from datamanager.data_models import User, Movie, Review, Director, user_movie_association
+
+
+EXPORT_BATCH_SIZE = 1000
+
+# Query of every exportable entity, sorted by primary key
+EXPORT_QUERIES = {
+    'users': select(User.id, User.name).order_by(User.id),
+    'directors': select(Director.id, Director.name, Director.birth, Director.death, Director.bio)
+    .order_by(Director.id),
+    'movies': select(Movie.id, Movie.title, Movie.genre, Movie.year, Movie.rating, Movie.poster,
+                     Movie.description, Movie.director_id).order_by(Movie.id),
+    'favorites': select(user_movie_association.c.id, user_movie_association.c.user_id,
+                        user_movie_association.c.movie_id).order_by(user_movie_association.c.id),
+    'reviews': select(Review.review_id, Review.user_id, Review.movie_id, Review.rating, Review.text)
+    .order_by(Review.review_id),
+}
+
+
+def iter_rows(session, entity, batch_size=EXPORT_BATCH_SIZE):
+    """ Yields the rows of an entity as dictionaries, fetched from the cursor batch_size rows at a time """
+    result = session.execute(EXPORT_QUERIES[entity].execution_options(yield_per=batch_size))
+    for row in result:
+        yield row._asdict()
+
+
+def export_ndjson(session, entities, batch_size=EXPORT_BATCH_SIZE):
+    """ Yields the rows of the entities as NDJSON, one object with its 'type' per line, in chunks of a batch """
+    for entity in entities:
+        lines = []
+        for row in iter_rows(session, entity, batch_size):
+            lines.append(json.dumps({'type': entity, **row}, ensure_ascii=False))
+            if len(lines) >= batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+
+def export_csv(session, entity, batch_size=EXPORT_BATCH_SIZE):
+    """ Yields the rows of one entity as CSV with a header line, in chunks of a batch """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in EXPORT_QUERIES[entity].selected_columns])
+    count = 0
+    for row in iter_rows(session, entity, batch_size):
+        writer.writerow(row.values())
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
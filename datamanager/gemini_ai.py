@@ -1,19 +1,243 @@
 from google import genai
+from google.genai import errors, types
+import hashlib
+import httpx
+import itertools
+import json
 import os
+import re
 from dotenv import load_dotenv
+from datamanager.http_client import http_client
+from datamanager.lookup_cache import LookupCache
+from datamanager.metrics import metrics
 
 
 #loads variables from the .env file into the environment
 load_dotenv()
 # os.getenv() to access the environment variables loaded from the .env file
 API_KEY = os.getenv('API_KEY_GEMINI')
+GEMINI_HOST = 'generativelanguage.googleapis.com'
+GEMINI_MODEL = "gemini-2.0-flash"
+DIRECTOR_FIELDS = ('bio', 'birth', 'death')
 
-client = genai.Client(api_key=API_KEY)
+# The SDK sends its requests with the pooled httpx clients of the shared http_client,
+# the client.aio calls with its httpx.AsyncClient on the event loop of http_client.run()
+client = genai.Client(
+    api_key=API_KEY,
+    http_options=types.HttpOptions(
+        base_url=os.getenv('GEMINI_BASE_URL'),
+        timeout=int(http_client.read_timeout * 1000),
+        httpx_client=http_client.httpx_client(),
+        httpx_async_client=http_client.httpx_async_client()
+    )
+)
 
+DATA_FOLDER = os.getenv('DATA_FOLDER') or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+# Cache of the Gemini answers keyed by the hash of the prompt, one namespace per model
+gemini_cache = LookupCache(
+    os.path.join(DATA_FOLDER, 'cache.db'),
+    namespace=f'gemini:{GEMINI_MODEL}',
+    ttl=int(os.getenv('GEMINI_CACHE_TTL', 30 * 24 * 3600)),
+    max_entries=int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', 2000))
+)
 
-def fetch_from_gemini(prompt):
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents={prompt}
+
+class CachedResponse:
+    """ Answer of Gemini served from the cache, it has the 'text' of the original response """
+    def __init__(self, text):
+        self.text = text
+
+
+def prompt_key(prompt, *options):
+    """ Returns the content hash of a prompt and the options that change its answer """
+    return hashlib.sha256('\x00'.join((prompt,) + options).encode('utf-8')).hexdigest()
+
+
+def movie_description_prompt(movie_title, director_name):
+    """ Prompt of the short description of a movie """
+    return f"Get a short text about the movie '{movie_title}' of the director '{director_name}'."
+
+
+def director_prompt(movie_title, director_name):
+    """ Structured prompt of the bio, birth and death day (DIRECTOR_FIELDS) of the director of a movie """
+    return (f"Get information about the director of the movie '{movie_title}', '{director_name}'. "
+            "Answer with the keys: 'bio' a short text about the biography of the director, "
+            "'birth' only the birthday data without extra text in the format day/month/year, "
+            "'death' only the death day data without extra text in the format day/month/year "
+            "or an empty text if the director is alive.")
+
+
+def json_config(fields):
+    """ Asks for a JSON object with the text 'fields', in that order """
+    return types.GenerateContentConfig(
+        response_mime_type='application/json',
+        response_schema={
+            'type': 'OBJECT',
+            'properties': {field: {'type': 'STRING'} for field in fields},
+            'property_ordering': list(fields)
+        }
     )
+
+
+def is_retryable_gemini_error(error, response):
+    """ Rate limits, server errors and transport errors of the Gemini API are worth a retry """
+    if error is None:
+        return False
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+@metrics.timed('gemini')
+async def fetch_from_gemini_async(prompt):
+    """ Returns the cached answer of the prompt, or sends the prompt to Gemini
+        through the circuit breaker and retries of the http_client and caches the answer """
+    cache_key = prompt_key(prompt)
+    cached_text = await gemini_cache.get_async(cache_key)
+    if cached_text is not None:
+        return CachedResponse(cached_text)
+
+    response = await http_client.call_async(
+        GEMINI_HOST,
+        lambda: client.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents={prompt}
+        ),
+        is_retryable_gemini_error
+    )
+    if response.text:
+        await gemini_cache.set_async(cache_key, response.text)
     return response
+
+
+def fetch_from_gemini(prompt):
+    """ Waits for fetch_from_gemini_async on the event loop of the http_client """
+    return http_client.run(fetch_from_gemini_async(prompt))
+
+
+@metrics.timed('gemini')
+async def fetch_json_from_gemini_async(prompt, fields):
+    """
+        Sends a structured prompt that asks for several text fields in one model call.
+        Gemini answers with a JSON object with the keys in 'fields'.
+        Returns a dictionary with all the fields, the missing ones are empty strings.
+    """
+    cache_key = prompt_key(prompt, 'json', *fields)
+    text = await gemini_cache.get_async(cache_key)
+    from_cache = text is not None
+    if not from_cache:
+        response = await http_client.call_async(
+            GEMINI_HOST,
+            lambda: client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents={prompt},
+                config=json_config(fields)
+            ),
+            is_retryable_gemini_error
+        )
+        text = response.text
+
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError) as e:
+        print(f"Gemini answered invalid JSON: {e}")
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    elif not from_cache:
+        await gemini_cache.set_async(cache_key, text)
+    return {field: str(data.get(field) or '') for field in fields}
+
+
+def fetch_json_from_gemini(prompt, fields):
+    """ Waits for fetch_json_from_gemini_async on the event loop of the http_client """
+    return http_client.run(fetch_json_from_gemini_async(prompt, fields))
+
+
+def partial_json_string(text, field):
+    """
+        Returns the value decoded so far of the string 'field' of a JSON object that is still
+        being received, or None if the value hasn't started yet
+    """
+    start = re.search(r'"%s"\s*:\s*"' % re.escape(field), text)
+    if start is None:
+        return None
+    raw = text[start.end():]
+    index = 0
+    while index < len(raw) and raw[index] != '"':
+        index += 2 if raw[index] == '\\' else 1
+    raw = raw[:index]
+    # An escape sequence cut by the end of a chunk is decoded with the next chunk
+    for cut in range(min(len(raw), 6) + 1):
+        try:
+            return json.loads('"' + raw[:len(raw) - cut] + '"')
+        except ValueError:
+            continue
+    return ''
+
+
+@metrics.timed('gemini_first_chunk')
+def open_stream(prompt, config=None):
+    """ Starts a streamed answer and waits for its first chunk, so failures before any text can be retried """
+    chunks = iter(client.models.generate_content_stream(model=GEMINI_MODEL, contents={prompt}, config=config))
+    return next(chunks, None), chunks
+
+
+def stream_from_gemini(prompt):
+    """
+        Yields the text of the answer of the prompt as Gemini generates it.
+        A cached answer is yielded at once, a complete answer is cached like in fetch_from_gemini.
+    """
+    cache_key = prompt_key(prompt)
+    cached_text = gemini_cache.get(cache_key)
+    if cached_text is not None:
+        yield cached_text
+        return
+
+    first_chunk, chunks = http_client.call(GEMINI_HOST, lambda: open_stream(prompt), is_retryable_gemini_error)
+    parts = []
+    for chunk in itertools.chain([first_chunk] if first_chunk else [], chunks):
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+    if parts:
+        gemini_cache.set(cache_key, ''.join(parts))
+
+
+def stream_json_from_gemini(prompt, fields):
+    """
+        Streams the structured answer of fetch_json_from_gemini.
+        Yields (field, text) pairs, the text is what was added to the field since the previous pair.
+        The complete answer is cached with the same key as fetch_json_from_gemini.
+    """
+    cache_key = prompt_key(prompt, 'json', *fields)
+    cached_text = gemini_cache.get(cache_key)
+    if cached_text is not None:
+        try:
+            data = json.loads(cached_text)
+        except ValueError:
+            data = {}
+        for field in fields:
+            if isinstance(data, dict) and data.get(field):
+                yield field, str(data[field])
+        return
+
+    first_chunk, chunks = http_client.call(GEMINI_HOST, lambda: open_stream(prompt, json_config(fields)),
+                                           is_retryable_gemini_error)
+    text = ''
+    sent = {field: '' for field in fields}
+    for chunk in itertools.chain([first_chunk] if first_chunk else [], chunks):
+        if not chunk.text:
+            continue
+        text += chunk.text
+        for field in fields:
+            value = partial_json_string(text, field)
+            if value and len(value) > len(sent[field]) and value.startswith(sent[field]):
+                yield field, value[len(sent[field]):]
+                sent[field] = value
+
+    try:
+        if isinstance(json.loads(text), dict):
+            gemini_cache.set(cache_key, text)
+    except ValueError as e:
+        print(f"Gemini answered invalid JSON: {e}")
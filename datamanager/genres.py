@@ -0,0 +1,70 @@
+"""
+Genres of the movies as rows of the genre table linked by movie_genre_association.
+OMDb sends the genres of a movie as one comma-joined text ("Action, Drama"), which is
+kept in Movie.genre for display. The same genres are stored once in the genre table
+(unique case-insensitive name) so a genre filter is an index lookup instead of a LIKE scan.
+"""
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from datamanager.data_models import Genre, Movie, movie_genre_association, sqlite_lower
+
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def split_genres(genre_text):
+    """ Returns the genre names of a comma-joined text without repetitions, empty or 'N/A' names """
+    names = {}
+    for name in (genre_text or '').split(','):
+        name = ' '.join(name.split())
+        if name and name.upper() != 'N/A':
+            names.setdefault(sqlite_lower(name), name)
+    return list(names.values())
+
+
+def genre_ids(connection, names):
+    """
+        Returns {lower name: genre id} of the genre names, inserting the missing genres.
+        The names are matched ignoring the case with the unique lower(name) index.
+        'connection' is a session or a connection, the caller commits.
+    """
+    if not names:
+        return {}
+    connection.execute(insert(Genre).on_conflict_do_nothing(), [{'name': name} for name in names])
+    rows = connection.execute(
+        select(func.lower(Genre.name), Genre.id)
+        .where(func.lower(Genre.name).in_([sqlite_lower(name) for name in names]))
+    ).all()
+    return dict(rows)
+
+
+def set_movie_genres(connection, movie_genres):
+    """
+        Links the movies to the genres of their genre text, {movie_id: genre text},
+        replacing their previous genres. The caller commits.
+    """
+    if not movie_genres:
+        return
+    names = {sqlite_lower(name): name for genre_text in movie_genres.values() for name in split_genres(genre_text)}
+    ids = genre_ids(connection, list(names.values()))
+    connection.execute(delete(movie_genre_association)
+                       .where(movie_genre_association.c.movie_id.in_(list(movie_genres))))
+    links = [{'movie_id': movie_id, 'genre_id': ids[sqlite_lower(name)]}
+             for movie_id, genre_text in movie_genres.items() for name in split_genres(genre_text)]
+    if links:
+        connection.execute(insert(movie_genre_association).on_conflict_do_nothing(), links)
+
+
+def backfill_genres(connection, batch_size=BACKFILL_BATCH_SIZE):
+    """ Links all the movies to the genres of their genre text, batch_size movies at a time. Returns the count """
+    count = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(Movie.id, Movie.genre).where(Movie.id > last_id).order_by(Movie.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return count
+        set_movie_genres(connection, {row.id: row.genre for row in rows})
+        count += len(rows)
+        last_id = rows[-1].id
@@ -0,0 +1,292 @@
+"""
+Shared client for the outbound HTTP calls to the external APIs (OMDb, Gemini).
+Keeps pooled keep-alive connections, applies connect/read timeouts to every call,
+retries transient failures with jittered exponential backoff and stops calling
+a host that keeps failing until its circuit breaker lets a trial call through.
+The async calls (httpx.AsyncClient) of all the threads run on one event loop in a
+daemon thread, so many lookups wait on the network without holding a thread each.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+
+#loads variables from the .env file into the environment
+load_dotenv()
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """ Raised when a call is refused because the circuit of the host is open """
+
+
+class CircuitBreaker:
+    """
+        Counts the consecutive failures of a host.
+        After 'failure_threshold' failures the circuit opens and calls are refused
+        for 'reset_timeout' seconds, then one trial call is let through (half-open).
+        A success closes the circuit again, a failure opens it for another period.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """ Raises CircuitOpenError if the circuit doesn't allow a call now """
+        with self._lock:
+            state = self.state
+            if state == 'open':
+                raise CircuitOpenError(f"Circuit open, retry in {self.reset_timeout} seconds")
+            if state == 'half-open':
+                # Only one trial call, the next callers wait for a new period
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """ Token bucket shared by threads: 'rate' calls every 'per' seconds, with bursts up to 'burst' calls """
+
+    def __init__(self, rate, per=60.0, burst=None):
+        self.rate = rate
+        self.per = per
+        self.burst = burst or rate
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """ Takes a token if there is one. Returns 0, or the seconds to wait for the next token """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate / self.per)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * self.per / self.rate
+
+    def acquire(self):
+        """ Waits until a call is allowed """
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def acquire_async(self):
+        """ Waits until a call is allowed without blocking the event loop """
+        wait = self._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+
+class HttpClient:
+    """ Pooled HTTP client with timeouts, bounded retries and a circuit breaker per host """
+
+    def __init__(self, pool_connections=10, pool_maxsize=20, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff_factor=0.5, backoff_max=8, failure_threshold=5, reset_timeout=30,
+                 async_pool_maxsize=200):
+        self.pool_maxsize = pool_maxsize
+        self.async_pool_maxsize = async_pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._httpx_client = None
+        self._httpx_async_client = None
+        self._loop = None
+
+        self.session = requests.Session()
+        # Retries are done by the client itself, so the adapter doesn't retry
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def breaker(self, host):
+        """ Returns the circuit breaker of a host """
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[host]
+
+    def backoff(self, attempt):
+        """ Returns the seconds to wait before the retry 'attempt' (full jitter) """
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
+
+    def call(self, host, function, is_retryable):
+        """
+            Calls 'function' through the circuit breaker of 'host'.
+            Exceptions and results for which is_retryable(exception, result) is True
+            are retried up to 'retries' times with backoff.
+            Returns the result of the last attempt or raises its exception.
+        """
+        breaker = self.breaker(host)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            result, error = None, None
+            try:
+                result = function()
+            except Exception as e:
+                error = e
+
+            if not is_retryable(error, result):
+                breaker.record_success()
+                if error is not None:
+                    raise error
+                return result
+
+            breaker.record_failure()
+            if attempt >= self.retries or breaker.state == 'open':
+                if error is not None:
+                    raise error
+                return result
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def call_async(self, host, function, is_retryable):
+        """ Like call(), 'function' returns an awaitable and the backoff doesn't block the event loop """
+        breaker = self.breaker(host)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            result, error = None, None
+            try:
+                result = await function()
+            except Exception as e:
+                error = e
+
+            if not is_retryable(error, result):
+                breaker.record_success()
+                if error is not None:
+                    raise error
+                return result
+
+            breaker.record_failure()
+            if attempt >= self.retries or breaker.state == 'open':
+                if error is not None:
+                    raise error
+                return result
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """ Sends a request with the pooled session. 'timeout' defaults to (connect, read) """
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        return self.call(
+            urlparse(url).netloc,
+            lambda: self.session.request(method, url, timeout=timeout, **kwargs),
+            _is_retryable_response
+        )
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    async def request_async(self, method, url, **kwargs):
+        """ Sends a request with the pooled httpx.AsyncClient, on the event loop of run() """
+        client = self.httpx_async_client()
+        return await self.call_async(
+            urlparse(url).netloc,
+            lambda: client.request(method, url, **kwargs),
+            _is_retryable_httpx_response
+        )
+
+    async def get_async(self, url, **kwargs):
+        return await self.request_async('GET', url, **kwargs)
+
+    def run(self, coroutine, timeout=None):
+        """
+            Runs a coroutine on the event loop of the client and waits for its result.
+            The loop runs in a daemon thread started on the first call, the async calls
+            of all the threads share it and the connections of httpx_async_client().
+            The coroutine runs with the context variables of the caller (the Flask request).
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='http-client-loop', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def httpx_async_client(self):
+        """ Returns the shared pooled httpx.AsyncClient, used only on the event loop of run() """
+        with self._lock:
+            if self._httpx_async_client is None:
+                self._httpx_async_client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    limits=httpx.Limits(max_connections=self.async_pool_maxsize,
+                                        max_keepalive_connections=self.pool_maxsize)
+                )
+            return self._httpx_async_client
+
+    def httpx_client(self):
+        """ Returns a shared pooled httpx client, for the SDKs built on httpx (google-genai) """
+        with self._lock:
+            if self._httpx_client is None:
+                self._httpx_client = httpx.Client(
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    limits=httpx.Limits(max_connections=self.pool_maxsize,
+                                        max_keepalive_connections=self.pool_maxsize)
+                )
+            return self._httpx_client
+
+
+def _is_retryable_response(error, response):
+    """ Connection errors, timeouts and 429/5xx answers are worth a retry """
+    if error is not None:
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return response.status_code in RETRY_STATUS_CODES
+
+
+def _is_retryable_httpx_response(error, response):
+    """ Transport errors (connection, timeout) and 429/5xx answers of httpx are worth a retry """
+    if error is not None:
+        return isinstance(error, httpx.TransportError)
+    return response.status_code in RETRY_STATUS_CODES
+
+
+http_client = HttpClient(
+    pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', 20)),
+    async_pool_maxsize=int(os.getenv('HTTP_ASYNC_POOL_MAXSIZE', 200)),
+    connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', 10)),
+    retries=int(os.getenv('HTTP_RETRIES', 2)),
+    failure_threshold=int(os.getenv('HTTP_CIRCUIT_FAILURES', 5)),
+    reset_timeout=float(os.getenv('HTTP_CIRCUIT_RESET', 30))
+)
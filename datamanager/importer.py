@@ -0,0 +1,166 @@
+"""
+Bulk import of movies and favorites.
+The records are written in chunks, each chunk in one transaction with bulk inserts:
+directors are upserted by normalized name, movies are de-duplicated by title and year
+and the favorites of the users are inserted ignoring the ones that already exist.
+"""
+import json
+from sqlalchemy import select, func
+from sqlalchemy.dialects.sqlite import insert
+from datamanager.data_models import User, Movie, Director, user_movie_association, MISSING_DIRECTOR, \
+    director_name, sqlite_lower
+from datamanager.genres import set_movie_genres
+from datamanager.jobs import enqueue_movie_enrichment
+
+
+IMPORT_CHUNK_SIZE = 500
+MOVIE_FIELDS = ('title', 'genre', 'year', 'rating', 'poster', 'description')
+
+
+def parse_records(body):
+    """ Parses a JSON array or NDJSON text into a list of records. Raises ValueError on invalid input """
+    body = body.strip()
+    if not body:
+        return []
+    if body.startswith('['):
+        records = json.loads(body)
+    else:
+        records = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError("Every record has to be a JSON object")
+    return records
+
+
+def movie_key(title, year):
+    """ De-duplication key of a movie: the normalized title and the year """
+    return ' '.join(str(title).split()).casefold(), str(year or '').strip()
+
+
+def record_user_ids(record):
+    """ Returns the ids of the users a record adds the movie to """
+    user_ids = record.get('user_ids') or []
+    if record.get('user_id') is not None:
+        user_ids = list(user_ids) + [record['user_id']]
+    return [int(user_id) for user_id in user_ids]
+
+
+def import_records(session, records, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+        Imports the records, a record is a movie with 'title' (required), 'genre', 'year', 'rating',
+        'poster', 'description', 'director' and the 'user_id' or 'user_ids' to add it as favorite.
+        Returns one result per record: its index, 'status' ('created', 'existing' or 'error'),
+        the movie_id and the number of favorites added, or the 'error'.
+    """
+    results = []
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        try:
+            results.extend(_import_chunk(session, chunk, start))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"Error importing records {start} to {start + len(chunk) - 1}: {e}")
+            results.extend({'index': start + offset, 'status': 'error', 'error': str(e)}
+                           for offset in range(len(chunk)))
+    return results
+
+
+def _import_chunk(session, chunk, start):
+    """ Writes one chunk of records with bulk statements, the caller commits """
+    results = []
+    valid = []
+    for offset, record in enumerate(chunk):
+        try:
+            if not str(record.get('title') or '').strip():
+                raise ValueError("The title is required")
+            valid.append((start + offset, record, movie_key(record['title'], record.get('year')),
+                          record_user_ids(record)))
+        except (TypeError, ValueError) as e:
+            results.append({'index': start + offset, 'status': 'error', 'error': str(e)})
+
+    # Directors: insert the missing ones, then read the ids of all of them
+    director_names = {}
+    for _, record, _, _ in valid:
+        # Like the movies added from OMDb, a movie without director gets the 'N/A' director
+        name = director_name(record.get('director'))
+        name_key = Director.normalize_name(name)
+        if name_key is not None:
+            director_names.setdefault(name_key, name)
+    if director_names:
+        session.execute(
+            insert(Director).on_conflict_do_nothing(index_elements=['name_key']),
+            [{'name': name, 'name_key': name_key} for name_key, name in director_names.items()]
+        )
+    director_ids = dict(session.execute(
+        select(Director.name_key, Director.id).where(Director.name_key.in_(list(director_names)))
+    ).all())
+
+    # Movies: the ones with the same title and year are reused
+    movie_ids = _existing_movie_ids(session, {key: record['title'] for _, record, key, _ in valid})
+    new_movies = {}
+    for _, record, key, _ in valid:
+        if key not in movie_ids and key not in new_movies:
+            new_movie = {field: record.get(field) for field in MOVIE_FIELDS}
+            new_movie['title'] = ' '.join(str(record['title']).split())
+            new_movie['year'] = key[1] or None
+            new_movie['director_id'] = director_ids.get(Director.normalize_name(director_name(record.get('director'))))
+            new_movies[key] = new_movie
+    # Every new movie without director gets its own unknown director
+    unknown = [movie for movie in new_movies.values() if movie['director_id'] is None]
+    if unknown:
+        unknown_ids = session.scalars(insert(Director).returning(Director.id, sort_by_parameter_order=True),
+                                      [{'name': MISSING_DIRECTOR}] * len(unknown)).all()
+        for movie, director_id in zip(unknown, unknown_ids):
+            movie['director_id'] = director_id
+    if new_movies:
+        session.execute(insert(Movie), list(new_movies.values()))
+        movie_ids.update(_existing_movie_ids(session, {key: movie['title'] for key, movie in new_movies.items()}))
+        set_movie_genres(session, {movie_ids[key]: movie['genre'] for key, movie in new_movies.items()})
+        # The new movies are enriched in the background by the enrichment workers
+        enqueue_movie_enrichment(session, [movie_ids[key] for key in new_movies])
+
+    # Favorites of the existing users, the unique (user_id, movie_id) index skips the repeated ones
+    all_user_ids = {user_id for _, _, _, user_ids in valid for user_id in user_ids}
+    known_users = set(session.execute(select(User.id).where(User.id.in_(all_user_ids))).scalars()) \
+        if all_user_ids else set()
+    for index, record, key, user_ids in valid:
+        favorites = [{'user_id': user_id, 'movie_id': movie_ids[key]}
+                     for user_id in user_ids if user_id in known_users]
+        added = 0
+        if favorites:
+            added = session.execute(insert(user_movie_association).on_conflict_do_nothing(), favorites).rowcount
+        result = {
+            'index': index,
+            # A movie repeated in the chunk is created by its first record only
+            'status': 'created' if new_movies.pop(key, None) else 'existing',
+            'movie_id': movie_ids[key],
+            'favorites_added': max(added, 0)
+        }
+        unknown_users = [user_id for user_id in user_ids if user_id not in known_users]
+        if unknown_users:
+            result['unknown_user_ids'] = unknown_users
+        results.append(result)
+
+    results.sort(key=lambda result: result['index'])
+    return results
+
+
+def _existing_movie_ids(session, titles):
+    """
+        Returns {(title key, year): movie id} of the stored movies with the keys of 'titles',
+        a dictionary {(title key, year): title}. The lookup uses the lower(title), year index.
+    """
+    if not titles:
+        return {}
+    lower_titles = {sqlite_lower(' '.join(str(title).split())) for title in titles.values()}
+    rows = session.execute(
+        select(Movie.id, Movie.title, Movie.year)
+        .where(func.lower(Movie.title).in_(lower_titles))
+        .order_by(Movie.id)
+    ).all()
+    movie_ids = {}
+    for row in rows:
+        key = movie_key(row.title, row.year)
+        if key in titles and key not in movie_ids:
+            movie_ids[key] = row.id
+    return movie_ids
@@ -0,0 +1,108 @@
+"""
+SQLite-backed queue of the background enrichment jobs.
+A job is a row of the enrichment_job table, one per kind and target: 'movie_description'
+and 'poster' for a movie id and 'director_bio' for a director id. Workers claim the pending jobs
+with one atomic UPDATE, so several threads or processes never run the same job.
+"""
+import time
+from sqlalchemy import select, func, or_, text
+from sqlalchemy.dialects.sqlite import insert
+from datamanager.data_models import Movie, Director, EnrichmentJob
+
+
+JOB_KINDS = ('movie_description', 'director_bio', 'poster')
+JOB_STATUSES = ('pending', 'running', 'done', 'failed')
+# A job 'running' longer than this belongs to a worker that was stopped
+STALE_JOB_SECONDS = 15 * 60
+
+
+def enqueue_jobs(session, kind, target_ids):
+    """ Adds a pending job of the kind for every target that doesn't have one yet. The caller commits """
+    target_ids = sorted(set(target_ids))
+    if not target_ids:
+        return
+    now = time.time()
+    session.execute(
+        insert(EnrichmentJob).on_conflict_do_nothing(index_elements=['kind', 'target_id']),
+        [{'kind': kind, 'target_id': target_id, 'status': 'pending', 'attempts': 0, 'run_after': 0,
+          'created_at': now, 'updated_at': now} for target_id in target_ids]
+    )
+
+
+def enqueue_movie_enrichment(session, movie_ids):
+    """
+        Queues the AI description of the new movies without one (empty or 'N/A'), their poster
+        download and the bio of their directors that don't have one yet. The caller commits.
+    """
+    movie_ids = list(movie_ids)
+    if not movie_ids:
+        return
+    enqueue_jobs(session, 'movie_description', session.execute(
+        select(Movie.id).where(Movie.id.in_(movie_ids),
+                               or_(Movie.description.is_(None), func.trim(Movie.description).in_(('', 'N/A'))))
+    ).scalars().all())
+    enqueue_jobs(session, 'poster', session.execute(
+        select(Movie.id).where(Movie.id.in_(movie_ids), Movie.poster.like('http%'))
+    ).scalars().all())
+    director_ids = session.execute(
+        select(Director.id).distinct()
+        .join(Movie, Movie.director_id == Director.id)
+        .where(Movie.id.in_(movie_ids),
+               or_(Director.bio.is_(None), Director.bio == ''),
+               Director.name_key.is_not(None))
+    ).scalars().all()
+    enqueue_jobs(session, 'director_bio', director_ids)
+
+
+def claim_job(session):
+    """ Marks the next pending job that is due as running and returns it (id, kind, target_id, attempts) or None """
+    now = time.time()
+    job = session.execute(text(
+        "UPDATE enrichment_job SET status = 'running', attempts = attempts + 1, updated_at = :now "
+        "WHERE id = (SELECT id FROM enrichment_job WHERE status = 'pending' AND run_after <= :now "
+        "ORDER BY run_after, id LIMIT 1) "
+        "RETURNING id, kind, target_id, attempts"
+    ), {'now': now}).first()
+    session.commit()
+    return job
+
+
+def finish_job(session, job_id):
+    """ Marks a job as done """
+    session.execute(text(
+        "UPDATE enrichment_job SET status = 'done', last_error = NULL, updated_at = :now WHERE id = :id"
+    ), {'now': time.time(), 'id': job_id})
+    session.commit()
+
+
+def fail_job(session, job_id, error, retry_in=None):
+    """ Records the error of a job. It runs again in 'retry_in' seconds, or is marked failed if retry_in is None """
+    now = time.time()
+    session.execute(text(
+        "UPDATE enrichment_job SET status = :status, last_error = :error, run_after = :run_after, "
+        "updated_at = :now WHERE id = :id"
+    ), {'status': 'failed' if retry_in is None else 'pending', 'error': str(error)[:500],
+        'run_after': now + (retry_in or 0), 'now': now, 'id': job_id})
+    session.commit()
+
+
+def requeue_stale_jobs(session, stale_after=STALE_JOB_SECONDS):
+    """ Puts back in the queue the jobs left running by a worker that was stopped. Returns their number """
+    result = session.execute(text(
+        "UPDATE enrichment_job SET status = 'pending', updated_at = :now "
+        "WHERE status = 'running' AND updated_at < :stale"
+    ), {'now': time.time(), 'stale': time.time() - stale_after})
+    session.commit()
+    return result.rowcount
+
+
+def job_counts(session):
+    """ Returns the number of jobs by kind and status: {kind: {status: count}} """
+    counts = {kind: {status: 0 for status in JOB_STATUSES} for kind in JOB_KINDS}
+    rows = session.execute(
+        select(EnrichmentJob.kind, EnrichmentJob.status, func.count())
+        .group_by(EnrichmentJob.kind, EnrichmentJob.status)
+    ).all()
+    for kind, status, count in rows:
+        counts.setdefault(kind, {})[status] = count
+    return counts
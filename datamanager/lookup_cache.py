@@ -0,0 +1,133 @@
+"""
+Persistent cache for the lookups made against external APIs.
+Entries are stored in a SQLite file next to the application database,
+expire after a TTL and the least recently used entries are evicted once the
+cache grows over its maximum size.
+Misses (e.g. OMDb answering 'Response: False') are stored as negative entries
+with their own, usually shorter, TTL.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LookupCache:
+    """ SQLite backed key/value cache with TTL, LRU eviction and negative entries """
+
+    def __init__(self, db_path, namespace, ttl=7 * 24 * 3600, negative_ttl=3600, max_entries=5000):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._create_table()
+
+    def _connection(self):
+        """ Returns the SQLite connection of the current thread """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_table(self):
+        """ Creates the cache table and its LRU index if they don't exist """
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS lookup_cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                is_miss INTEGER NOT NULL DEFAULT 0,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_lookup_cache_lru ON lookup_cache (namespace, last_access)")
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """ Returns the cached value of the key or None if it is missing or expired """
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            "SELECT value, is_miss, expires_at FROM lookup_cache WHERE namespace = ? AND key = ?",
+            (self.namespace, key)).fetchone()
+
+        if row is None or row[2] < now:
+            if row is not None:
+                connection.execute("DELETE FROM lookup_cache WHERE namespace = ? AND key = ?",
+                                   (self.namespace, key))
+            self._count('misses')
+            return None
+
+        connection.execute("UPDATE lookup_cache SET last_access = ? WHERE namespace = ? AND key = ?",
+                           (now, self.namespace, key))
+        self._count('negative_hits' if row[1] else 'hits')
+        return json.loads(row[0])
+
+    def set(self, key, value, miss=False):
+        """ Stores a value. Misses are stored as negative entries with the negative TTL """
+        connection = self._connection()
+        now = time.time()
+        ttl = self.negative_ttl if miss else self.ttl
+        connection.execute(
+            "INSERT OR REPLACE INTO lookup_cache (namespace, key, value, is_miss, expires_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), int(miss), now + ttl, now))
+        self._evict()
+
+    def _evict(self):
+        """ Deletes the least recently used entries over the maximum size of the namespace """
+        connection = self._connection()
+        connection.execute("""
+            DELETE FROM lookup_cache WHERE namespace = ? AND key IN (
+                SELECT key FROM lookup_cache WHERE namespace = ?
+                ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )""", (self.namespace, self.namespace, self.max_entries))
+
+    def clear(self):
+        """ Deletes all the entries of the namespace """
+        self._connection().execute("DELETE FROM lookup_cache WHERE namespace = ?", (self.namespace,))
+
+    async def get_async(self, key):
+        """ Like get(), in a worker thread: a busy SQLite file doesn't block the event loop """
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key, value, miss=False):
+        """ Like set(), in a worker thread """
+        await asyncio.to_thread(self.set, key, value, miss)
+
+    def stats(self):
+        """ Returns the hit/miss counters of this process and the number of stored entries """
+        entries = self._connection().execute(
+            "SELECT COUNT(*) FROM lookup_cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'entries': entries,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+def normalize_key(text):
+    """ Normalizes a lookup text: case-insensitive and with collapsed whitespaces """
+    return ' '.join(str(text).split()).casefold()
@@ -0,0 +1,198 @@
+"""
+Performance instrumentation of the Movi Web App.
+Records the wall time of every request by endpoint, the number and time of the SQL
+queries (SQLAlchemy engine events) and the latency of the external lookups (OMDb, Gemini).
+Queries slower than SLOW_QUERY_MS are written to the slow-query log.
+The totals are served in the Prometheus text format on /metrics and the numbers of
+each request are sent in its Server-Timing header.
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from flask import current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+
+
+#loads variables from the .env file into the environment
+load_dotenv()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """ Count, sum and cumulative buckets of the observed durations of one series """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+
+class Metrics:
+    """ Histograms of durations by name and labels, shared by all the threads of the process """
+
+    def __init__(self, slow_query_ms=100, slow_query_log=None):
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        self.histograms = {}
+        self.descriptions = {
+            'moviweb_request_seconds': "Wall time of the requests by endpoint",
+            'moviweb_request_queries': "SQL queries per request by endpoint",
+            'moviweb_db_query_seconds': "Duration of the SQL queries",
+            'moviweb_external_call_seconds': "Latency of the external lookups (OMDb, Gemini)",
+        }
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """ Adds a duration to the histogram of the name and labels """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(
+                    (1, 2, 5, 10, 20, 50, 100) if name == 'moviweb_request_queries' else DEFAULT_BUCKETS)
+            histogram.observe(value)
+
+    def timed(self, call):
+        """
+            Decorator that records the latency of a function or coroutine function as an external call named 'call'.
+            The coroutines run by http_client.run() keep the request context of the caller.
+        """
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        self.record_external(call, time.perf_counter() - start)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record_external(call, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def record_external(self, call, duration):
+        self.observe('moviweb_external_call_seconds', duration, call=call)
+        if has_request_context():
+            external = g.setdefault('metrics_external', {})
+            external[call] = external.get(call, 0) + duration
+
+    def init_app(self, app, engine):
+        """ Adds the request hooks, the SQL query events of the engine and the /metrics endpoint to the app """
+        event.listen(engine, 'before_cursor_execute', self._before_query)
+        event.listen(engine, 'after_cursor_execute', self._after_query)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        app.extensions['metrics'] = self
+
+    @staticmethod
+    def _before_query(connection, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context of the statement, which is dropped with it when the query fails
+        context.metrics_query_start = time.perf_counter()
+
+    def _after_query(self, connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context.metrics_query_start
+        self.observe('moviweb_db_query_seconds', duration)
+        if has_request_context():
+            g.metrics_queries = g.get('metrics_queries', 0) + 1
+            g.metrics_query_time = g.get('metrics_query_time', 0) + duration
+        if duration * 1000 >= self.slow_query_ms:
+            self.log_slow_query(duration, statement, parameters)
+
+    def log_slow_query(self, duration, statement, parameters):
+        """ Writes a slow query to the slow-query log file, or prints it """
+        endpoint = request.endpoint if has_request_context() else '-'
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S')} slow query {duration * 1000:.1f} ms [{endpoint}] " \
+               f"{' '.join(statement.split())} {parameters!r}"
+        if self.slow_query_log:
+            with self._lock, open(self.slow_query_log, 'a', encoding='utf-8') as log_file:
+                log_file.write(line + '\n')
+        else:
+            print(line)
+
+    @staticmethod
+    def _before_request():
+        g.metrics_start = time.perf_counter()
+
+    def _after_request(self, response):
+        """ Records the request and sends its timings in the Server-Timing header """
+        if 'metrics_start' not in g or request.endpoint == 'metrics':
+            return response
+        duration = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+        self.observe('moviweb_request_seconds', duration, endpoint=endpoint, method=request.method,
+                     status=str(response.status_code))
+        queries = g.get('metrics_queries', 0)
+        self.observe('moviweb_request_queries', queries, endpoint=endpoint)
+
+        timings = [f'app;dur={duration * 1000:.1f}',
+                   f'db;dur={g.get("metrics_query_time", 0) * 1000:.1f};desc="{queries} queries"']
+        timings.extend(f'{call};dur={call_time * 1000:.1f}' for call, call_time in g.get('metrics_external', {}).items())
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def render(self, caches=()):
+        """ Returns the metrics in the Prometheus text format """
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            for name in sorted({name for (name, _), _ in histograms}):
+                lines.append(f'# HELP {name} {self.descriptions.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for (series_name, labels), histogram in histograms:
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        if caches:
+            for counter in ('hits', 'misses'):
+                lines.append(f'# HELP moviweb_cache_{counter}_total Cache {counter} of this process')
+                lines.append(f'# TYPE moviweb_cache_{counter}_total counter')
+                for stats in (cache.stats() for cache in caches):
+                    lines.append(f'moviweb_cache_{counter}_total{format_labels((("namespace", stats["namespace"]),))} '
+                                 f'{stats[counter]}')
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        """ Prometheus scrape endpoint """
+        return Response(self.render(current_app.extensions.get('lookup_caches', ())),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def format_labels(labels):
+    """ Formats the labels of a series: {name="value",...} """
+    if not labels:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+metrics = Metrics(
+    slow_query_ms=float(os.getenv('SLOW_QUERY_MS', 100)),
+    slow_query_log=os.getenv('SLOW_QUERY_LOG')
+)
@@ -0,0 +1,298 @@
+"""
+Versioned migrations of the SQLite database.
+The version of a database is stored in 'PRAGMA user_version'.
+Every migration runs once, in order, and is written so that running it on a
+database created by db.create_all() with the current models is harmless.
+"""
+import time
+from sqlalchemy import text
+from datamanager.data_models import Director, EnrichmentJob, MovieStats, MISSING_DIRECTOR
+from datamanager.genres import backfill_genres
+
+
+MIGRATIONS = []
+
+# Queries of the routes that run on every request, used to compare their query plans
+HOT_QUERIES = {
+    'user movies': "SELECT movie.id FROM movie JOIN user_movie_association "
+                   "ON movie.id = user_movie_association.movie_id "
+                   "WHERE user_movie_association.user_id = 1 ORDER BY user_movie_association.id DESC",
+    'movie reviews': "SELECT review.review_id FROM review WHERE review.movie_id = 1 "
+                     "ORDER BY review.review_id DESC LIMIT 21",
+    'user reviews': "SELECT review.review_id FROM review WHERE review.user_id = 1",
+    'movie by title': "SELECT movie.id FROM movie WHERE movie.title = 'Alien'",
+    'user by name': "SELECT user.id FROM user WHERE user.name = 'Alice'",
+    'top rated': "SELECT movie_id FROM movie_stats WHERE rated_count >= 1 ORDER BY rating_avg DESC LIMIT 10",
+    'most favorited': "SELECT movie_id FROM movie_stats ORDER BY favorite_count DESC LIMIT 10",
+    'genre movies': "SELECT movie_id FROM movie_genre_association WHERE genre_id = 1 AND movie_id > 0 "
+                    "ORDER BY movie_id LIMIT 51",
+}
+
+# Numeric value of a review rating, the form can send an empty rating
+RATING_VALUE = "CASE WHEN typeof({row}.rating) IN ('integer', 'real') THEN {row}.rating END"
+
+
+def stats_change(row, sign, counts):
+    """
+        Statements of a trigger that adds (sign '+') or removes (sign '-') the review or favorite
+        'row' ('new' or 'old') to the movie_stats row of its movie
+    """
+    changes = ', '.join(f"{column} = {column} {sign} ({value})" for column, value in counts.items())
+    return (
+        f"INSERT OR IGNORE INTO movie_stats (movie_id, review_count, rated_count, rating_sum, favorite_count) "
+        f"VALUES ({row}.movie_id, 0, 0, 0, 0); "
+        f"UPDATE movie_stats SET {changes} WHERE movie_id = {row}.movie_id; "
+        f"UPDATE movie_stats SET rating_avg = rating_sum * 1.0 / NULLIF(rated_count, 0) "
+        f"WHERE movie_id = {row}.movie_id; "
+    )
+
+
+def review_counts(row):
+    rating = RATING_VALUE.format(row=row)
+    return {'review_count': "1", 'rated_count': f"{rating} IS NOT NULL", 'rating_sum': f"IFNULL({rating}, 0)"}
+
+
+def migration(version, description):
+    """ Registers the decorated function as the migration to 'version' """
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return register
+
+
+def get_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+@migration(1, "indexes on the hot lookup columns and unique favorites")
+def add_lookup_indexes(connection):
+    """ Removes duplicated favorites, then adds the unique and lookup indexes """
+    connection.execute(text(
+        "DELETE FROM user_movie_association WHERE id NOT IN ("
+        "SELECT MIN(id) FROM user_movie_association GROUP BY user_id, movie_id)"))
+    for statement in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_user_movie_association_user_movie "
+        "ON user_movie_association (user_id, movie_id)",
+        # Filters by user_id and gives the ORDER BY user_movie_association.id DESC for free
+        "CREATE INDEX IF NOT EXISTS ix_user_movie_association_user_id_id ON user_movie_association (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_movie_association_movie_id ON user_movie_association (movie_id)",
+        "CREATE INDEX IF NOT EXISTS ix_review_movie_id_review_id ON review (movie_id, review_id)",
+        "CREATE INDEX IF NOT EXISTS ix_review_user_id ON review (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_movie_title ON movie (title)",
+        "CREATE INDEX IF NOT EXISTS ix_user_name ON user (name)",
+    ):
+        connection.execute(text(statement))
+
+
+@migration(2, "director de-duplication by normalized name")
+def add_director_name_key(connection):
+    """ Adds the normalized director name, merges the duplicates and makes the name unique """
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(director)"))]
+    if 'name_key' not in columns:
+        connection.execute(text("ALTER TABLE director ADD COLUMN name_key VARCHAR"))
+    compact_directors(connection)
+
+
+def compact_directors(connection):
+    """
+        Merges the directors with the same normalized name into the oldest one.
+        The movies of the duplicates are repointed to it and its missing bio, birth
+        and death are taken from the duplicates. Then the unique name_key index is created.
+        The unknown directors (MISSING_DIRECTOR) are left apart, one per movie.
+        Returns the number of removed duplicates.
+    """
+    groups = {}
+    removed = 0
+    rows = connection.execute(text("SELECT id, name, name_key, bio, birth, death FROM director ORDER BY id")).all()
+    for row in rows:
+        name_key = Director.normalize_name(row.name)
+        if name_key is not None:
+            groups.setdefault(name_key, []).append(row)
+
+    for name_key, (keeper, *duplicates) in groups.items():
+        for row in duplicates:
+            connection.execute(text("UPDATE movie SET director_id = :keeper_id WHERE director_id = :id"),
+                               {'keeper_id': keeper.id, 'id': row.id})
+            connection.execute(text(
+                "UPDATE director SET bio = COALESCE(NULLIF(bio, ''), :bio), "
+                "birth = COALESCE(NULLIF(birth, ''), :birth), death = COALESCE(NULLIF(death, ''), :death) "
+                "WHERE id = :keeper_id"),
+                {'bio': row.bio, 'birth': row.birth, 'death': row.death, 'keeper_id': keeper.id})
+            connection.execute(text("DELETE FROM director WHERE id = :id"), {'id': row.id})
+            removed += 1
+        # Set after deleting the duplicates, one of them may already have the name_key
+        if keeper.name_key != name_key:
+            connection.execute(text("UPDATE director SET name_key = :name_key WHERE id = :id"),
+                               {'name_key': name_key, 'id': keeper.id})
+
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_director_name_key ON director (name_key)"))
+    return removed
+
+
+@migration(3, "full-text search indexes of users and movies")
+def add_search_indexes(connection):
+    """
+        Creates the FTS5 indexes of the user names and of the movie title, genre, description
+        and director name. Triggers keep them in sync with the tables.
+    """
+    for statement in (
+        # External content table, the names are read from the user table
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+        "name, content='user', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON user BEGIN "
+        "INSERT INTO user_fts (rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON user BEGIN "
+        "INSERT INTO user_fts (user_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF name ON user BEGIN "
+        "INSERT INTO user_fts (user_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO user_fts (rowid, name) VALUES (new.id, new.name); END",
+        "INSERT INTO user_fts (user_fts) VALUES ('rebuild')",
+
+        # The director name is copied in the index, the movie rowid is the movie id
+        "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+        "title, genre, description, director, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_insert AFTER INSERT ON movie BEGIN "
+        "INSERT INTO movie_fts (rowid, title, genre, description, director) VALUES (new.id, new.title, "
+        "new.genre, new.description, (SELECT name FROM director WHERE id = new.director_id)); END",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_delete AFTER DELETE ON movie BEGIN "
+        "DELETE FROM movie_fts WHERE rowid = old.id; END",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_update AFTER UPDATE ON movie BEGIN "
+        "DELETE FROM movie_fts WHERE rowid = old.id; "
+        "INSERT INTO movie_fts (rowid, title, genre, description, director) VALUES (new.id, new.title, "
+        "new.genre, new.description, (SELECT name FROM director WHERE id = new.director_id)); END",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_director_update AFTER UPDATE OF name ON director BEGIN "
+        "UPDATE movie_fts SET director = new.name "
+        "WHERE rowid IN (SELECT id FROM movie WHERE director_id = new.id); END",
+        "DELETE FROM movie_fts",
+        "INSERT INTO movie_fts (rowid, title, genre, description, director) "
+        "SELECT movie.id, movie.title, movie.genre, movie.description, director.name "
+        "FROM movie LEFT JOIN director ON director.id = movie.director_id",
+    ):
+        connection.execute(text(statement))
+
+
+@migration(4, "case-insensitive title and year index of the movies")
+def add_movie_title_year_index(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_movie_title_lower_year ON movie (lower(title), year)"))
+
+
+@migration(5, "background enrichment jobs")
+def add_enrichment_jobs(connection):
+    """ Creates the job table and queues the enrichment of the movies and directors without description/bio """
+    EnrichmentJob.__table__.create(connection, checkfirst=True)
+    now = time.time()
+    connection.execute(text(
+        "INSERT OR IGNORE INTO enrichment_job (kind, target_id, status, attempts, run_after, created_at, updated_at) "
+        "SELECT 'movie_description', id, 'pending', 0, 0, :now, :now FROM movie "
+        "WHERE description IS NULL OR description IN ('', 'N/A')"), {'now': now})
+    connection.execute(text(
+        "INSERT OR IGNORE INTO enrichment_job (kind, target_id, status, attempts, run_after, created_at, updated_at) "
+        "SELECT 'director_bio', id, 'pending', 0, 0, :now, :now FROM director "
+        "WHERE (bio IS NULL OR bio = '') AND name_key IS NOT NULL AND name_key != 'n/a'"), {'now': now})
+
+
+@migration(6, "review and favorite aggregates of the movies")
+def add_movie_stats(connection):
+    """
+        Creates the movie_stats table with its triggers and computes it from the existing
+        reviews and favorites. Every insert, update or delete of a review or a favorite,
+        from any code path, updates the aggregates of its movie in the same transaction.
+    """
+    MovieStats.__table__.create(connection, checkfirst=True)
+    for statement in (
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_review_insert AFTER INSERT ON review BEGIN "
+        + stats_change('new', '+', review_counts('new')) + "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_review_delete AFTER DELETE ON review BEGIN "
+        + stats_change('old', '-', review_counts('old')) + "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_review_update AFTER UPDATE OF rating, movie_id ON review BEGIN "
+        + stats_change('old', '-', review_counts('old')) + stats_change('new', '+', review_counts('new')) + "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_favorite_insert AFTER INSERT ON user_movie_association BEGIN "
+        + stats_change('new', '+', {'favorite_count': "1"}) + "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_favorite_delete AFTER DELETE ON user_movie_association BEGIN "
+        + stats_change('old', '-', {'favorite_count': "1"}) + "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_stats_movie_delete AFTER DELETE ON movie BEGIN "
+        "DELETE FROM movie_stats WHERE movie_id = old.id; END",
+        "DELETE FROM movie_stats",
+        "INSERT INTO movie_stats (movie_id, review_count, rated_count, rating_sum, rating_avg, favorite_count) "
+        "SELECT movie.id, "
+        "(SELECT count(*) FROM review WHERE review.movie_id = movie.id), "
+        f"(SELECT count({RATING_VALUE.format(row='review')}) FROM review WHERE review.movie_id = movie.id), "
+        f"(SELECT IFNULL(sum({RATING_VALUE.format(row='review')}), 0) FROM review WHERE review.movie_id = movie.id), "
+        f"(SELECT avg({RATING_VALUE.format(row='review')}) FROM review WHERE review.movie_id = movie.id), "
+        "(SELECT count(*) FROM user_movie_association WHERE user_movie_association.movie_id = movie.id) "
+        "FROM movie",
+    ):
+        connection.execute(text(statement))
+
+
+@migration(7, "genres of the movies in the genre table")
+def add_movie_genres(connection):
+    """
+        Indexes the genres by case-insensitive name and the movies of a genre,
+        then links every movie to the genres of its comma-joined genre text
+    """
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_genre_name_lower ON genre (lower(name))"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_movie_genre_association_genre_id_movie_id "
+                            "ON movie_genre_association (genre_id, movie_id)"))
+    backfill_genres(connection)
+
+
+@migration(8, "poster downloads of the existing movies")
+def add_poster_jobs(connection):
+    """ Queues the download of the posters of the existing movies for the background workers """
+    now = time.time()
+    connection.execute(text(
+        "INSERT OR IGNORE INTO enrichment_job (kind, target_id, status, attempts, run_after, created_at, updated_at) "
+        "SELECT 'poster', id, 'pending', 0, 0, :now, :now FROM movie WHERE poster LIKE 'http%'"), {'now': now})
+
+
+@migration(9, "one unknown director per movie")
+def split_missing_directors(connection):
+    """
+        Gives every movie of the shared 'N/A' director its own director row, so a bio written
+        for one of them isn't shown on all the movies without director.
+        The bio, birth and death of the shared row belonged to no director and are cleared.
+    """
+    missing_key = MISSING_DIRECTOR.casefold()
+    shared_ids = connection.execute(text("SELECT id FROM director WHERE name_key = :key"),
+                                    {'key': missing_key}).scalars().all()
+    for director_id in shared_ids:
+        connection.execute(text("UPDATE director SET name_key = NULL, bio = NULL, birth = NULL, death = NULL "
+                                "WHERE id = :id"), {'id': director_id})
+        movie_ids = connection.execute(text("SELECT id FROM movie WHERE director_id = :id ORDER BY id"),
+                                       {'id': director_id}).scalars().all()
+        for movie_id in movie_ids[1:]:
+            new_id = connection.execute(text("INSERT INTO director (name) VALUES (:name) RETURNING id"),
+                                        {'name': MISSING_DIRECTOR}).scalar()
+            connection.execute(text("UPDATE movie SET director_id = :director_id WHERE id = :id"),
+                               {'director_id': new_id, 'id': movie_id})
+    if shared_ids:
+        connection.execute(text("DELETE FROM enrichment_job WHERE kind = 'director_bio' AND target_id IN "
+                                "(SELECT id FROM director WHERE name_key IS NULL)"))
+
+
+def upgrade_database(engine):
+    """ Runs the pending migrations. Returns the list of the applied versions """
+    applied = []
+    with engine.begin() as connection:
+        current_version = get_version(connection)
+    for version, description, function in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with engine.begin() as connection:
+            function(connection)
+            connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+        print(f"Database migrated to version {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def query_plans(engine):
+    """ Returns the 'EXPLAIN QUERY PLAN' details of the HOT_QUERIES """
+    plans = {}
+    with engine.connect() as connection:
+        for name, query in HOT_QUERIES.items():
+            rows = connection.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+            plans[name] = [row[-1] for row in rows]
+    return plans
@@ -0,0 +1,156 @@
+"""
+Cache of the rendered pages and page fragments of the Movi Web App.
+Every cached entry is tagged with what it shows ('user:2', 'movie:5', 'users').
+A tag has a version number that is part of the cache key of its entries, so the write
+paths invalidate a tag by incrementing its version and the old entries are never read
+again (they age out of the LRU or expire in Redis).
+The entries are kept in an in-process LRU, or in a Redis-compatible server when
+PAGE_CACHE_REDIS_URL is set and the redis package is installed (pip install redis),
+which shares the cache and the invalidations between processes.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    """ In-process LRU with a TTL, shared by the threads of one process """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_versions(self, tags):
+        with self._lock:
+            return [self.versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+
+class RedisBackend:
+    """ Entries and tag versions in a Redis-compatible server """
+
+    def __init__(self, url, prefix='moviweb:page:'):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=int(ttl))
+
+    def get_versions(self, tags):
+        values = self.client.mget([self.prefix + 'tag:' + tag for tag in tags])
+        return [int(value or 0) for value in values]
+
+    def bump(self, tags):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.incr(self.prefix + 'tag:' + tag)
+        pipeline.execute()
+
+
+class PageCache:
+    """ Tag-invalidated cache of rendered HTML """
+
+    def __init__(self, backend, ttl=300, namespace='page_cache'):
+        self.backend = backend
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def key(self, name, args, tags):
+        """ Cache key of an entry: its name, arguments and the current versions of its tags and of 'all' """
+        versions = self.backend.get_versions(list(tags) + ['all'])
+        return f"{name}:{':'.join(str(arg) for arg in args)}|{'.'.join(str(version) for version in versions)}"
+
+    def get_or_render(self, name, args, tags, render):
+        """ Returns the cached text of the entry, or calls render() and caches its result """
+        try:
+            key = self.key(name, args, tags)
+            value = self.backend.get(key)
+        except Exception as e:
+            # A cache server that is down only makes the pages slower
+            print(f"Error reading the page cache: {e}")
+            self.errors += 1
+            return render()
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = render()
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"Error writing the page cache: {e}")
+            self.errors += 1
+        return value
+
+    def invalidate(self, *tags):
+        """ Makes the entries with any of the tags stale """
+        if not tags:
+            return
+        try:
+            self.backend.bump(tags)
+        except Exception as e:
+            print(f"Error invalidating the page cache: {e}")
+            self.errors += 1
+
+    def clear(self):
+        """ Makes every entry stale, after bulk writes """
+        self.invalidate('all')
+
+    def stats(self):
+        """ Returns the counters of the cache """
+        lookups = self.hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def create_page_cache(redis_url=None, max_entries=1000, ttl=300):
+    """ Returns a PageCache on Redis if redis_url is set and the redis package is installed, else in memory """
+    if redis_url:
+        if redis is not None:
+            return PageCache(RedisBackend(redis_url), ttl)
+        print("The redis package is not installed, the page cache is kept in memory.")
+    return PageCache(MemoryBackend(max_entries), ttl)
@@ -0,0 +1,151 @@
+"""
+Local copies of the OMDb posters.
+Every poster is downloaded once with the shared http_client and stored on disk under the
+hash of its URL, next to its thumbnails. Only the posters of the OMDb image hosts are
+downloaded, the poster URLs of the API and the import come from the users. The thumbnails are generated with Pillow when it
+is installed (pip install Pillow), as WebP and JPEG, otherwise the original is served.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+from urllib.parse import urlparse
+
+import requests
+from datamanager.http_client import CircuitOpenError
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Width and height of the thumbnails of the favorite movies page
+THUMBNAIL_SIZE = (300, 450)
+MAX_POSTER_BYTES = 5 * 1024 * 1024
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+# Hosts of the posters of OMDb, the server downloads no other URL
+POSTER_HOSTS = ('m.media-amazon.com', 'ia.media-imdb.com', 'images-na.ssl-images-amazon.com', 'img.omdbapi.com')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def is_remote_poster(poster):
+    """ OMDb answers 'N/A' for the movies without poster """
+    return bool(poster) and poster.startswith(('http://', 'https://'))
+
+
+def poster_key(poster):
+    """ Returns the content hash of the poster URL, the name of its files on disk """
+    return hashlib.sha256(poster.encode('utf-8')).hexdigest()
+
+
+class PosterStore:
+    """ Disk cache of the posters and their thumbnails """
+
+    def __init__(self, cache_dir, http_client, thumbnail_size=THUMBNAIL_SIZE, quality=80, allowed_hosts=POSTER_HOSTS):
+        self.cache_dir = cache_dir
+        self.http_client = http_client
+        self.allowed_hosts = {host.strip().lower() for host in allowed_hosts if host.strip()}
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def is_allowed(self, poster):
+        """ Only the remote posters of the allowed hosts are downloaded and served """
+        return is_remote_poster(poster) and (urlparse(poster).hostname or '').lower() in self.allowed_hosts
+
+    def path(self, poster, name):
+        """ Path of a file of the poster: 'original', 'thumb.webp' or 'thumb.jpg' """
+        key = poster_key(poster)
+        return os.path.join(self.cache_dir, key[:2], f'{key}-{name}')
+
+    def _key_lock(self, poster):
+        """ One lock per poster, so concurrent requests download it only once """
+        with self._lock:
+            return self._locks.setdefault(poster_key(poster), threading.Lock())
+
+    def get(self, poster, size='thumb', accept_webp=False):
+        """
+            Returns the path of the poster file to serve, downloading the poster the first time.
+            'size' is 'thumb' or 'full'. Returns None if the poster can't be downloaded.
+        """
+        if size == 'thumb' and Image is not None:
+            name = 'thumb.webp' if accept_webp else 'thumb.jpg'
+        else:
+            name = 'original'
+        file_path = self.path(poster, name)
+        if os.path.exists(file_path):
+            return file_path
+        with self._key_lock(poster):
+            if not os.path.exists(file_path) and not self.download(poster):
+                return None
+        return file_path if os.path.exists(file_path) else self.path(poster, 'original')
+
+    def download(self, poster):
+        """ Downloads the poster and writes it with its thumbnails. Returns False on error """
+        if not self.is_allowed(poster):
+            print(f"The poster {poster} isn't on an allowed host")
+            return False
+        try:
+            content = self._fetch(poster)
+        except (requests.RequestException, CircuitOpenError) as e:
+            print(f"Error downloading the poster {poster}: {e}")
+            return False
+        if content is None:
+            return False
+
+        self._write(self.path(poster, 'original'), content)
+        if Image is not None:
+            try:
+                self._write_thumbnails(poster, content)
+            except (OSError, ValueError) as e:
+                print(f"Error making the thumbnails of {poster}: {e}")
+        return True
+
+    def _fetch(self, poster):
+        """ Returns the image of the poster, or None if it isn't an image or is larger than MAX_POSTER_BYTES """
+        # Streamed, the body is read up to the limit only. A redirect could lead to another host
+        response = self.http_client.get(poster, stream=True, allow_redirects=False)
+        try:
+            content_type = response.headers.get('Content-Type', '')
+            if response.status_code != requests.codes.ok or not content_type.startswith('image/') \
+                    or int(response.headers.get('Content-Length') or 0) > MAX_POSTER_BYTES:
+                print(f"Error downloading the poster {poster}: {response.status_code} {content_type}")
+                return None
+            content = bytearray()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                content.extend(chunk)
+                if len(content) > MAX_POSTER_BYTES:
+                    print(f"Error downloading the poster {poster}: larger than {MAX_POSTER_BYTES} bytes")
+                    return None
+            return bytes(content)
+        finally:
+            response.close()
+
+    def _write_thumbnails(self, poster, content):
+        with Image.open(BytesIO(content)) as image:
+            image = image.convert('RGB')
+            image.thumbnail(self.thumbnail_size)
+            for extension, image_format in THUMBNAIL_FORMATS.items():
+                buffer = BytesIO()
+                image.save(buffer, image_format, quality=self.quality)
+                self._write(self.path(poster, f'thumb.{extension}'), buffer.getvalue())
+
+    @staticmethod
+    def _write(file_path, content):
+        """ Writes a file atomically, a reader never sees it half written """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, file_path)
+
+    def prewarm(self, poster):
+        """ Downloads a poster that isn't on disk yet. Returns False if the download failed """
+        if not self.is_allowed(poster) or os.path.exists(self.path(poster, 'original')):
+            return True
+        with self._key_lock(poster):
+            return os.path.exists(self.path(poster, 'original')) or self.download(poster)
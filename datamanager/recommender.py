@@ -0,0 +1,196 @@
+"""
+Item-item collaborative filtering over the favorite movies of the users (user_movie_association).
+The index keeps in memory the sparse user x movie matrix as sets and the co-occurrence
+counts of every pair of movies saved by the same user. The similarity of two movies is
+the cosine of their user vectors: co-occurrences / sqrt(users of a * users of b).
+With NumPy and SciPy installed a full build computes the co-occurrences as the sparse
+product of the user x movie matrix by its transpose, otherwise with Counters.
+The counts are then kept in dictionaries, not in the sparse matrix: adding or removing
+a favorite updates the counts of the movies of that user only, which a CSR matrix can't
+do in place, so the index never has to be rebuilt by the web requests.
+"""
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict, Counter
+from sqlalchemy import select
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    sparse = None
+from datamanager.data_models import user_movie_association
+
+
+RECOMMENDATIONS_SIZE = 10
+
+
+class RecommendationIndex:
+    """ In-memory co-occurrence index of the favorite movies, safe to share between threads """
+
+    def __init__(self, rebuild_interval=600):
+        # Favorites written by other processes (flask import-movies) are read by a periodic rebuild
+        self.rebuild_interval = rebuild_interval
+        self.built_at = None
+        self.user_movies = defaultdict(set)
+        self.movie_users = Counter()
+        self.co_counts = defaultdict(Counter)
+        self._lock = threading.RLock()
+        # Held by the one thread that rebuilds the index
+        self._build_lock = threading.Lock()
+
+    def build(self, session, batch_size=10000):
+        """ Loads all the favorites from the database """
+        user_movies = defaultdict(set)
+        result = session.execute(
+            select(user_movie_association.c.user_id, user_movie_association.c.movie_id)
+            .execution_options(yield_per=batch_size)
+        )
+        for user_id, movie_id in result:
+            user_movies[user_id].add(movie_id)
+
+        if sparse is not None:
+            movie_users, co_counts = sparse_co_counts(user_movies)
+        else:
+            movie_users, co_counts = python_co_counts(user_movies)
+
+        with self._lock:
+            self.user_movies, self.movie_users, self.co_counts = user_movies, movie_users, co_counts
+            self.built_at = time.monotonic()
+
+    def is_fresh(self):
+        with self._lock:
+            return self.built_at is not None and time.monotonic() - self.built_at < self.rebuild_interval
+
+    def ensure_built(self, session):
+        """
+            Builds the index on first use and again when it is older than rebuild_interval.
+            Only one thread rebuilds: the others wait for the first build, but keep using
+            an expired index while it is rebuilt.
+        """
+        if self.is_fresh():
+            return
+        with self._lock:
+            has_index = self.built_at is not None
+        if not self._build_lock.acquire(blocking=not has_index):
+            return
+        try:
+            # Built by another thread while this one waited
+            if not self.is_fresh():
+                self.build(session)
+        finally:
+            self._build_lock.release()
+
+    def invalidate(self):
+        """ Rebuilds the index on next use, after favorites were written in bulk """
+        with self._lock:
+            self.built_at = None
+
+    def add_favorite(self, user_id, movie_id):
+        """ Counts a new favorite of a user """
+        with self._lock:
+            if self.built_at is None or movie_id in self.user_movies[user_id]:
+                return
+            for other_id in self.user_movies[user_id]:
+                self.co_counts[movie_id][other_id] += 1
+                self.co_counts[other_id][movie_id] += 1
+            self.user_movies[user_id].add(movie_id)
+            self.movie_users[movie_id] += 1
+
+    def remove_favorite(self, user_id, movie_id):
+        """ Uncounts a favorite removed by a user """
+        with self._lock:
+            if self.built_at is None or movie_id not in self.user_movies.get(user_id, ()):
+                return
+            self.user_movies[user_id].discard(movie_id)
+            self.movie_users[movie_id] -= 1
+            for other_id in self.user_movies[user_id]:
+                self._decrement(movie_id, other_id)
+                self._decrement(other_id, movie_id)
+
+    def remove_user(self, user_id):
+        """ Uncounts all the favorites of a deleted user """
+        with self._lock:
+            for movie_id in list(self.user_movies.get(user_id, ())):
+                self.remove_favorite(user_id, movie_id)
+            self.user_movies.pop(user_id, None)
+
+    def _decrement(self, movie_id, other_id):
+        counts = self.co_counts[movie_id]
+        counts[other_id] -= 1
+        if counts[other_id] <= 0:
+            del counts[other_id]
+
+    def similarity(self, movie_id, other_id, co_count):
+        """ Cosine similarity of two movies from their co-occurrence count """
+        return co_count / math.sqrt(self.movie_users[movie_id] * self.movie_users[other_id])
+
+    def similar_movies(self, movie_id, limit=RECOMMENDATIONS_SIZE):
+        """ Users who saved this movie also saved: [(movie_id, similarity)] best first """
+        with self._lock:
+            neighbours = self.co_counts.get(movie_id, {})
+            scores = ((other_id, self.similarity(movie_id, other_id, count))
+                      for other_id, count in neighbours.items())
+            return heapq.nlargest(limit, scores, key=lambda item: (item[1], -item[0]))
+
+    def recommend(self, user_id, limit=RECOMMENDATIONS_SIZE):
+        """
+            Recommended movies for a user: [(movie_id, score)] best first.
+            The score of a movie is the sum of its similarities with the favorites of the user.
+            A user without favorites or without neighbours gets the most saved movies.
+        """
+        with self._lock:
+            saved = self.user_movies.get(user_id, set())
+            scores = defaultdict(float)
+            for movie_id in saved:
+                for other_id, count in self.co_counts.get(movie_id, {}).items():
+                    if other_id not in saved:
+                        scores[other_id] += self.similarity(movie_id, other_id, count)
+            if scores:
+                return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+            popular = heapq.nlargest(limit + len(saved), self.movie_users.items(),
+                                     key=lambda item: (item[1], -item[0]))
+            return [(movie_id, float(users)) for movie_id, users in popular
+                    if users > 0 and movie_id not in saved][:limit]
+
+
+def python_co_counts(user_movies):
+    """ Returns the users of every movie and the co-occurrence counts of the pairs of movies """
+    movie_users = Counter()
+    co_counts = defaultdict(Counter)
+    for movies in user_movies.values():
+        movie_users.update(movies)
+        for movie_id in movies:
+            co_counts[movie_id].update(movies)
+    for movie_id in co_counts:
+        del co_counts[movie_id][movie_id]
+    return movie_users, co_counts
+
+
+def sparse_co_counts(user_movies):
+    """ Like python_co_counts(), from the product of the sparse user x movie matrix by its transpose """
+    movie_users = Counter()
+    co_counts = defaultdict(Counter)
+    pairs = numpy.array([(user_id, movie_id) for user_id, movies in user_movies.items() for movie_id in movies],
+                        dtype=numpy.int64).reshape(-1, 2)
+    if not len(pairs):
+        return movie_users, co_counts
+    user_ids, rows = numpy.unique(pairs[:, 0], return_inverse=True)
+    movie_ids, columns = numpy.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((numpy.ones(len(pairs), dtype=numpy.int32), (rows, columns)),
+                               shape=(len(user_ids), len(movie_ids)))
+
+    movie_users.update(dict(zip(movie_ids.tolist(), numpy.asarray(matrix.sum(axis=0)).ravel().tolist())))
+    co_occurrences = (matrix.T @ matrix).tocsr()
+    co_occurrences.setdiag(0)
+    co_occurrences.eliminate_zeros()
+    # One dictionary per movie row, built from slices of the CSR arrays
+    other_ids = movie_ids[co_occurrences.indices].tolist()
+    counts = co_occurrences.data.tolist()
+    bounds = co_occurrences.indptr.tolist()
+    for row, movie_id in enumerate(movie_ids.tolist()):
+        start, end = bounds[row], bounds[row + 1]
+        if start < end:
+            co_counts[movie_id] = Counter(dict(zip(other_ids[start:end], counts[start:end])))
+    return movie_users, co_counts
@@ -1,29 +1,495 @@
-from flask_sqlalchemy import SQLAlchemy
+"""
+SQLiteDataManager is the data access of the Movi Web App.
+All the queries of the routes of app.py and api.py go through it.
+The SQLite engine is tuned for concurrent readers: WAL journal, synchronous=NORMAL,
+memory mapped I/O, a bigger page cache, a connection pool and statement caches.
+"""
+import re
+from sqlalchemy import event, desc, delete, func, exists, select, text
+from sqlalchemy.orm import joinedload
 from datamanager.data_manager_interface import DataManagerInterface
+from datamanager.data_models import db, User, Movie, Review, Director, MovieStats, Genre, user_movie_association, \
+    movie_genre_association, sqlite_lower, EnrichmentJob
+from datamanager.genres import set_movie_genres
+from datamanager.importer import import_records
+from datamanager.exporter import export_ndjson, export_csv
+from datamanager.migrations import upgrade_database
+from datamanager.jobs import enqueue_movie_enrichment, job_counts
+from datamanager.recommender import RecommendationIndex, RECOMMENDATIONS_SIZE
+
+
+REVIEWS_PAGE_SIZE = 20
+USERS_PAGE_SIZE = 50
+GENRE_MOVIES_PAGE_SIZE = 50
+LEADERBOARD_SIZE = 10
+# Failed enrichment jobs listed by the jobs status
+FAILED_JOBS_SIZE = 20
+
+# Applied to every new SQLite connection of the pool
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # readers don't block on the writer
+    "PRAGMA synchronous=NORMAL",  # no fsync on every commit in WAL mode
+    "PRAGMA mmap_size=268435456",  # 256 MB of memory mapped I/O
+    "PRAGMA cache_size=-65536",  # 64 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=30000",
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Tunes a new SQLite connection """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def fts_match_query(search_text, column=None):
+    """
+        Turns a search text into a FTS5 query where every word has to match as a prefix.
+        'column' restricts the match to a column of the index. Returns None if there is no word.
+    """
+    words = re.findall(r'\w+', search_text or '')
+    if not words:
+        return None
+    query = ' '.join(f'"{word}"*' for word in words)
+    if column:
+        query = f'{column} : ({query})'
+    return query
+
 
 class SQLiteDataManager(DataManagerInterface):
-    def __init__(self, db_file_name):
-        self.db = SQLAlchemy(db_file_name)
+    """ Implements the DataManagerInterface on a SQLite database with the models of data_models.py """
+
+    def __init__(self, db_file_name, pool_size=10, max_overflow=20, recommender_rebuild_interval=600):
+        self.db_file_name = db_file_name
+        self.db = db
+        # Kept up to date by add_favorite, delete_movie and delete_user
+        self.recommender = RecommendationIndex(recommender_rebuild_interval)
+        # Cache of the rendered pages (PageCache), invalidated by the write methods when it is set
+        self.page_cache = None
+        self.engine_options = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': 30,
+            # Compiled SQL of the ORM statements, reused by all the requests
+            'query_cache_size': 1200,
+            'connect_args': {
+                'timeout': 30,
+                'check_same_thread': False,
+                # Prepared statements kept by each sqlite3 connection
+                'cached_statements': 256
+            }
+        }
+
+    def init_app(self, app):
+        """ Binds the database to the Flask app, tunes the engine, creates the missing tables and migrates them """
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.db_file_name
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = self.engine_options
+        self.db.init_app(app)
+        app.extensions['data_manager'] = self
+
+        with app.app_context():
+            event.listen(self.db.engine, 'connect', set_sqlite_pragmas)
+            # A new database gets the tables of the models, the migrations add their indexes and triggers
+            self.db.create_all()
+            # Brings an existing database to the schema version of the models
+            upgrade_database(self.db.engine)
+
+    def invalidate_pages(self, *tags):
+        """ Makes the cached pages that show the tagged users ('user:<id>'), movies ('movie:<id>') or lists stale """
+        if self.page_cache is not None:
+            self.page_cache.invalidate(*tags)
+
+    def movie_page_tags(self, movie_ids, with_users=False):
+        """ Returns the page cache tags of the movies and, with_users, of the users who saved them """
+        movie_ids = list(movie_ids)
+        tags = [f'movie:{movie_id}' for movie_id in movie_ids]
+        if with_users and movie_ids:
+            user_ids = self.db.session.scalars(select(user_movie_association.c.user_id).distinct()
+                                               .where(user_movie_association.c.movie_id.in_(movie_ids)))
+            tags.extend(f'user:{user_id}' for user_id in user_ids)
+        return tags
 
     def get_all_users(self):
         """ Returns a list of all users in the database. """
+        return User.query.all()
+
+    def get_users_page(self, after=None, limit=USERS_PAGE_SIZE, search_name=None):
+        """
+            Returns a page of the users sorted by id, optionally only the users whose name matches the search.
+            'after' is the user id where the page starts (keyset), so every page costs the same.
+            Returns the users of the page and the id to request the next page, or None if it is the last.
+        """
+        query = User.query
+        if search_name:
+            match_query = fts_match_query(search_name)
+            if match_query is None:
+                return [], None
+            query = query.filter(
+                text("user.id IN (SELECT rowid FROM user_fts WHERE user_fts MATCH :match_query)")
+            ).params(match_query=match_query)
+        if after is not None:
+            query = query.filter(User.id > after)
+        # One extra user tells if there is a next page
+        users = query.order_by(User.id).limit(limit + 1).all()
+
+        if len(users) > limit:
+            return users[:limit], users[limit - 1].id
+        return users, None
+
+    def search_users(self, search_name, limit=20):
+        """ Returns the users whose name matches the words of the search as prefixes, best matches first """
+        match_query = fts_match_query(search_name)
+        if match_query is None:
+            return []
+        return self.db.session.execute(text(
+            "SELECT user.id, user.name FROM user_fts JOIN user ON user.id = user_fts.rowid "
+            "WHERE user_fts MATCH :match_query ORDER BY rank LIMIT :limit"
+        ), {'match_query': match_query, 'limit': limit}).all()
 
+    def search_movies(self, search_text, limit=20, column=None):
+        """
+            Returns the movies whose title, genre, description or director name match the words
+            of the search as prefixes, best matches first. 'column' restricts the search to one of them.
+        """
+        match_query = fts_match_query(search_text, column)
+        if match_query is None:
+            return []
+        return self.db.session.execute(text(
+            "SELECT movie.id, movie.title, movie.year, movie.genre, movie_fts.director FROM movie_fts "
+            "JOIN movie ON movie.id = movie_fts.rowid "
+            "WHERE movie_fts MATCH :match_query ORDER BY rank LIMIT :limit"
+        ), {'match_query': match_query, 'limit': limit}).all()
+
+    def find_catalog_movie(self, title):
+        """ Returns the movie of the local catalog with the same title, ignoring case and spaces, or None """
+        title_key = ' '.join(title.split()).casefold()
+        for row in self.search_movies(title, limit=10, column='title'):
+            if ' '.join(row.title.split()).casefold() == title_key:
+                return self.get_movie(row.id)
+        return None
+
+    def get_user(self, user_id):
+        """ Returns a user by id or None if it doesn't exist. """
+        return self.db.session.get(User, user_id)
 
     def get_user_movies(self, user_id):
-        """ Returns a list of all movies of a specific user. """
+        """
+            Returns a list of all movies of a specific user with their directors loaded in the same query.
+            Sort user movies by user_movie_association ID, the last movie added is the first one listed.
+        """
+        movies = (
+            self.db.session.query(Movie)
+            .options(joinedload(Movie.director))
+            .join(user_movie_association, Movie.id == user_movie_association.c.movie_id)
+            .filter(user_movie_association.c.user_id == user_id)
+            .order_by(user_movie_association.c.id.desc())
+            .all()
+        )
+        return movies
 
+    def get_user_movie_rows(self, user_id):
+        """ Returns only the id, title, genre, year and director name of the movies of a user """
+        return (
+            self.db.session.query(Movie.id, Movie.title, Movie.genre, Movie.year, Director.name.label('director'))
+            .join(user_movie_association, Movie.id == user_movie_association.c.movie_id)
+            .outerjoin(Director, Director.id == Movie.director_id)
+            .filter(user_movie_association.c.user_id == user_id)
+            .all()
+        )
 
-    def add_user(self):
+    def add_user(self, name):
         """ Adds a new user to the database. """
+        new_user = User(name=name)
+        self.db.session.add(new_user)
+        self.db.session.commit()  # commits the session to the DB.
+        self.invalidate_pages('users')
+        return new_user
+
+    def delete_user(self, user_id):
+        """
+            Deletes a user with the reviews and the favorite movies list of the user.
+            Returns the deleted user or None if it doesn't exist.
+        """
+        user = self.get_user(user_id)
+        if user is None:
+            return None
+        # The pages of the movies the user reviewed or saved show the reviews and the counts of the user
+        movie_ids = set(self.db.session.scalars(select(Review.movie_id).where(Review.user_id == user.id)))
+        movie_ids.update(self.db.session.scalars(select(user_movie_association.c.movie_id)
+                                                 .where(user_movie_association.c.user_id == user.id)))
+        try:
+            self.db.session.execute(delete(Review).where(Review.user_id == user.id))
+            self.db.session.delete(user)
+            self.db.session.commit()
+        except Exception as e:
+            print(f"Error deleting user_id {user_id}: {e}")
+            self.db.session.rollback()
+            return None
+        self.recommender.remove_user(user.id)
+        self.invalidate_pages('users', f'user:{user.id}', *self.movie_page_tags(movie_ids))
+        return user
+
+    def get_movie(self, movie_id):
+        """ Returns a movie by id or None if it doesn't exist. """
+        return self.db.session.get(Movie, movie_id)
+
+    def get_movie_by_title(self, title):
+        """ Returns the first movie with the title or None """
+        return self.db.session.query(Movie).filter(Movie.title == title).first()
+
+    def user_has_movie_title(self, user_id, title):
+        """ Checks if a movie with the title is in the favorite movies list of the user """
+        return self.db.session.query(exists().where(
+            user_movie_association.c.user_id == user_id,
+            user_movie_association.c.movie_id == Movie.id,
+            Movie.title == title
+        )).scalar()
+
+    def add_director(self, director_name):
+        """ Adds a director if it doesn't exist yet and returns the id of the director. """
+        id_director = Director.get_or_create(director_name)
+        self.db.session.commit()  # commits the session to the DB.
+        return id_director
+
+    def add_movie(self, director_id, data):
+        """
+            Gets the director_id and the data of the new movie.
+            Insert the movie with all information in the table Movies.
+            Queues the AI enrichment of the movie and its director for the background workers.
+            Return the ID of the new movie table record.
+        """
+        add_movie_record = Movie(
+            title=data['title'],
+            genre=data['genre'],
+            year=data['year'],
+            rating=data['rating'],
+            poster=data['poster'],
+            director_id=director_id,
+            description=data['description']
+        )
+        self.db.session.add(add_movie_record)
+        self.db.session.flush()
+        set_movie_genres(self.db.session, {add_movie_record.id: add_movie_record.genre})
+        enqueue_movie_enrichment(self.db.session, [add_movie_record.id])
+        self.db.session.commit()  # commits the session to the DB.
+        return add_movie_record.id
+
+    def add_favorite(self, user_id, movie_id):
+        """ Insert a record in the association table user_movie_association connecting the user with the movie """
+        user = self.get_user(user_id)
+        movie = self.get_movie(movie_id)
+
+        if user and movie:
+            user.movies.append(movie)
+            self.db.session.commit()
+            self.recommender.add_favorite(user.id, movie.id)
+            self.invalidate_pages(f'user:{user.id}', f'movie:{movie.id}')
+            return True
+        return False
+
+    def add_favorite_movies(self, user_id, records):
+        """
+            Adds the movies of the records (bulk import records) to the favorite movies list of the user
+            in one transaction. The existing movies are reused. Returns the import result of every record.
+        """
+        results = import_records(self.db.session, records, chunk_size=max(len(records), 1))
+        movie_ids = [result['movie_id'] for result in results if result.get('favorites_added')]
+        for movie_id in movie_ids:
+            self.recommender.add_favorite(int(user_id), movie_id)
+        if movie_ids:
+            self.invalidate_pages(f'user:{user_id}', *self.movie_page_tags(movie_ids))
+        return results
+
+    def import_movies(self, records):
+        """
+            Imports the movies and favorites of the records (bulk import records) in chunked transactions.
+            The recommendation index is rebuilt and the cached pages are stale after it.
+            Returns the import result of every record.
+        """
+        results = import_records(self.db.session, records)
+        self.recommender.invalidate()
+        self.invalidate_pages('all')
+        return results
+
+    def export_ndjson(self, entities):
+        """ Returns a generator of the NDJSON chunks of the rows of the entities (users, directors, movies...) """
+        return export_ndjson(self.db.session, entities)
+
+    def export_csv(self, entity):
+        """ Returns a generator of the CSV chunks of the rows of one entity, with a header line """
+        return export_csv(self.db.session, entity)
+
+    def update_movie(self, movie, data):
+        """
+            Get a movie and the new data to update.
+            Update the data to the movie and its director and commit the changes
+        """
+        if data.get('description'):
+            movie.description = data['description']
+        if data.get('rating'):
+            movie.rating = data['rating']
+        if data.get('genre'):
+            movie.genre = data['genre']
+            set_movie_genres(self.db.session, {movie.id: movie.genre})
+        # The unknown director (N/A) of a movie isn't a person, it gets no bio
+        director_fields = [field for field in ('bio', 'birth', 'death')
+                           if data.get(field) and not movie.director.is_unknown]
+        for field in director_fields:
+            setattr(movie.director, field, data[field])
+        self.db.session.commit()
+        # The favorite lists show the genre and rating, the info pages of the other movies of the director the bio
+        movie_ids = [movie.id]
+        if director_fields:
+            movie_ids = self.db.session.scalars(select(Movie.id).where(Movie.director_id == movie.director_id))
+        self.invalidate_pages(*self.movie_page_tags(movie_ids, with_users=True))
+
+    def delete_movie(self, user_id, movie_id):
+        """ Deletes a specific movie from the favorite movies list of a user.
+            Returns False if the movie wasn't in the list. """
+        result = self.db.session.execute(delete(user_movie_association).where(
+            user_movie_association.c.user_id == user_id,
+            user_movie_association.c.movie_id == movie_id
+        ))
+        self.db.session.commit()
+        if result.rowcount > 0:
+            self.recommender.remove_favorite(int(user_id), int(movie_id))
+            self.invalidate_pages(f'user:{user_id}', f'movie:{movie_id}')
+        return result.rowcount > 0
+
+    def get_recommendations(self, user_id, limit=RECOMMENDATIONS_SIZE):
+        """ Returns the movies recommended to a user from the favorites of similar users, with their score """
+        self.recommender.ensure_built(self.db.session)
+        return self._scored_movies(self.recommender.recommend(int(user_id), limit))
+
+    def get_similar_movies(self, movie_id, limit=RECOMMENDATIONS_SIZE):
+        """ Returns the movies also saved by the users who saved a movie, with their similarity """
+        self.recommender.ensure_built(self.db.session)
+        return self._scored_movies(self.recommender.similar_movies(int(movie_id), limit))
+
+    def _scored_movies(self, scored_ids):
+        """ Reads the id, title, year and poster of the [(movie_id, score)] in one query, in the same order """
+        if not scored_ids:
+            return []
+        rows = {row.id: row for row in self.db.session.query(Movie.id, Movie.title, Movie.year, Movie.poster)
+                .filter(Movie.id.in_([movie_id for movie_id, _ in scored_ids]))}
+        return [{'id': movie_id, 'title': rows[movie_id].title, 'year': rows[movie_id].year,
+                 'poster': rows[movie_id].poster, 'score': round(score, 4)}
+                for movie_id, score in scored_ids if movie_id in rows]
+
+    def get_top_rated(self, limit=LEADERBOARD_SIZE, min_ratings=1):
+        """ Returns the movies with the best average review rating, read from the movie_stats index """
+        return (
+            self.db.session.query(Movie.id, Movie.title, Movie.year, Movie.poster, MovieStats.rating_avg,
+                                  MovieStats.rated_count, MovieStats.favorite_count)
+            .join(MovieStats, MovieStats.movie_id == Movie.id)
+            .filter(MovieStats.rated_count >= min_ratings)
+            .order_by(MovieStats.rating_avg.desc(), MovieStats.rated_count.desc())
+            .limit(limit)
+            .all()
+        )
+
+    def get_most_favorited(self, limit=LEADERBOARD_SIZE):
+        """ Returns the movies saved by most users, read from the movie_stats index """
+        return (
+            self.db.session.query(Movie.id, Movie.title, Movie.year, Movie.poster, MovieStats.rating_avg,
+                                  MovieStats.rated_count, MovieStats.favorite_count)
+            .join(MovieStats, MovieStats.movie_id == Movie.id)
+            .filter(MovieStats.favorite_count > 0)
+            .order_by(MovieStats.favorite_count.desc())
+            .limit(limit)
+            .all()
+        )
+
+    def get_genres(self):
+        """ Returns the genres with the number of their movies, sorted by name """
+        return (
+            self.db.session.query(Genre.id, Genre.name, func.count(movie_genre_association.c.movie_id).label('movies'))
+            .outerjoin(movie_genre_association, movie_genre_association.c.genre_id == Genre.id)
+            .group_by(Genre.id)
+            .order_by(Genre.name)
+            .all()
+        )
+
+    def get_genre(self, name):
+        """ Returns the genre with the name, ignoring the case, or None """
+        return self.db.session.query(Genre).filter(func.lower(Genre.name) == sqlite_lower(name.strip())).first()
+
+    def get_genre_movies(self, genre_ids, after=None, limit=GENRE_MOVIES_PAGE_SIZE):
+        """
+            Returns a page of the movies that have all the genres, sorted by id.
+            The first genre is read in the (genre_id, movie_id) index from 'after' (keyset),
+            the other genres are primary key lookups of each movie.
+            Returns the movies of the page and the id to request the next page, or None if it is the last.
+        """
+        first_genre = movie_genre_association.alias('first_genre')
+        query = (
+            self.db.session.query(Movie.id, Movie.title, Movie.year, Movie.genre, Movie.poster)
+            .join(first_genre, first_genre.c.movie_id == Movie.id)
+            .filter(first_genre.c.genre_id == genre_ids[0])
+        )
+        for genre_id in genre_ids[1:]:
+            query = query.filter(exists().where(movie_genre_association.c.movie_id == Movie.id,
+                                                movie_genre_association.c.genre_id == genre_id))
+        if after is not None:
+            query = query.filter(first_genre.c.movie_id > after)
+        # One extra movie tells if there is a next page
+        movies = query.order_by(first_genre.c.movie_id).limit(limit + 1).all()
+
+        if len(movies) > limit:
+            return movies[:limit], movies[limit - 1].id
+        return movies, None
 
+    def get_reviews(self, movie_id, before=None, limit=REVIEWS_PAGE_SIZE):
+        """
+            Gets a page of the reviews for a specific movie_id together with the usernames in one joined query.
+            The reviews are sorted from the newest one, 'before' is the review_id where the page starts (keyset).
+            Returns the reviews of the page and the review_id to request the next page, or None if it is the last.
+        """
+        try:
+            query = (
+                self.db.session.query(Review.review_id, Review.user_id, Review.rating, Review.text,
+                                      func.coalesce(User.name, "No user").label('user_name'))
+                .outerjoin(User, User.id == Review.user_id)
+                .filter(Review.movie_id == movie_id)
+            )
+            if before is not None:
+                query = query.filter(Review.review_id < before)
+            # One extra review tells if there is a next page
+            reviews = query.order_by(desc(Review.review_id)).limit(limit + 1).all()
+        except Exception as e:
+            print(f"Error al obtener reseñas: {e}")
+            return [], None
 
-    def add_movie(self):
-        """ Adds a new movie to the database """
+        if len(reviews) > limit:
+            return reviews[:limit], reviews[limit - 1].review_id
+        return reviews, None
 
+    def add_review(self, user_id, movie_id, rating, text):
+        """ Adds the review of a user for a movie. """
+        new_review = Review(
+            user_id=user_id,
+            movie_id=movie_id,
+            rating=rating,
+            text=text
+        )
+        self.db.session.add(new_review)
+        self.db.session.commit()  # commits the session to the DB.
+        self.invalidate_pages(f'movie:{movie_id}')
+        return new_review
 
-    def update_movie(self):
-        """ Updates the details of a specific movie in the database """
+    def get_job_counts(self):
+        """ Returns the number of background enrichment jobs by kind and status: {kind: {status: count}} """
+        return job_counts(self.db.session)
 
+    def get_failed_jobs(self, limit=FAILED_JOBS_SIZE):
+        """ Returns the enrichment jobs that failed for good, the last updated first """
+        return self.db.session.scalars(
+            select(EnrichmentJob).where(EnrichmentJob.status == 'failed')
+            .order_by(EnrichmentJob.updated_at.desc()).limit(limit)
+        ).all()
 
-    def delete_movie(self):
-        """ Deletes a specific movie from the database. """
\ No newline at end of file
+    def get_job(self, job_id):
+        """ Returns an enrichment job by id or None if it doesn't exist. """
+        return self.db.session.get(EnrichmentJob, job_id)
@@ -5,41 +5,50 @@ const form_review = document.getElementById('form_review');
 
 
 
-btn_description.addEventListener('click', async function() {
-            try {
-                const response = await fetch(route, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ prompt: 'description' })
-                });
-                const data = await response.json();
-                document.getElementById('text_description').textContent = data.response;
-            } catch (error) {
-                console.error("Error:", error);
-                document.getElementById('movie_description').textContent = "An error occurred.";
-            }
+// Elements that receive the text streamed for every field
+const stream_targets = {
+  description: 'text_description',
+  bio: 'text_bio',
+  birth: 'birth',
+  death: 'death'
+};
+
+
+// Renders the text generated by Gemini as it arrives (server-sent events)
+function streamPrompt(prompt, fields, button) {
+  fields.forEach(field => {
+    document.getElementById(stream_targets[field]).value = '';
+  });
+  button.disabled = true;
+
+  const source = new EventSource(route + '/stream?prompt=' + prompt);
+  source.onmessage = function(event) {
+    const data = JSON.parse(event.data);
+    document.getElementById(stream_targets[data.field]).value += data.text;
+  };
+  source.addEventListener('done', function() {
+    source.close();
+    button.disabled = false;
+  });
+  source.addEventListener('error', function(event) {
+    // The browser reconnects a closed stream, it is closed to get the text only once
+    source.close();
+    button.disabled = false;
+    if (event.data) {
+      console.error("Error:", JSON.parse(event.data).error);
+      document.getElementById(stream_targets[fields[0]]).value = "An error occurred.";
+    }
+  });
+}
+
+
+btn_description.addEventListener('click', function() {
+  streamPrompt('description', ['description'], btn_description);
 });
 
 
-btn_bio.addEventListener('click', async function() {
-            try {
-                const response = await fetch(route, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ prompt: 'bio' })
-                });
-                const data = await response.json();
-                document.getElementById('text_bio').textContent = data.response;
-                document.getElementById('birth').value = data.birth;
-                document.getElementById('death').value = data.death;
-            } catch (error) {
-                console.error("Error:", error);
-                document.getElementById('movie_description').textContent = "An error occurred.";
-            }
+btn_bio.addEventListener('click', function() {
+  streamPrompt('bio', ['bio', 'birth', 'death'], btn_bio);
 });
 
 
@@ -0,0 +1,43 @@
+""" Fixtures of the tests: a Flask app bound to an empty migrated database in a temporary folder, and the app module """
+import importlib
+
+import pytest
+from flask import Flask
+from datamanager.data_models import db
+from datamanager.migrations import upgrade_database
+
+
+@pytest.fixture
+def app(tmp_path):
+    """ App with the tables of the models and all the migrations, inside its app context """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'sqlite.db')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        upgrade_database(db.engine)
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def session(app):
+    return db.session
+
+
+@pytest.fixture(scope='session')
+def web_app(tmp_path_factory):
+    """
+        The app module, imported once with an empty temporary data folder, without the network
+        and the background workers. The tests seed the rows they need.
+    """
+    data_folder = tmp_path_factory.mktemp('web_data')
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('DATA_FOLDER', str(data_folder))
+        monkeypatch.setenv('API_KEY', 'test')
+        monkeypatch.setenv('API_KEY_GEMINI', 'test')
+        monkeypatch.setenv('ENRICHMENT_WORKERS', '0')
+        web = importlib.import_module('app')
+    assert web.data_folder == str(data_folder), "the app module was imported before the web_app fixture"
+    return web
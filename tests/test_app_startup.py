@@ -0,0 +1,36 @@
+""" Tests that the app creates or migrates its database when it starts """
+import shutil
+import sqlite3
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy import inspect
+from datamanager.data_models import db
+from datamanager.migrations import MIGRATIONS
+from datamanager.sqlite_data_manager import SQLiteDataManager
+
+SHIPPED_DATABASE = Path(__file__).resolve().parent.parent / 'data' / 'sqlite.db'
+
+
+def user_version(db_file):
+    with sqlite3.connect(db_file) as connection:
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def test_app_starts_on_an_empty_data_folder(web_app):
+    db_file = Path(web_app.data_folder) / 'sqlite.db'
+    assert user_version(db_file) == MIGRATIONS[-1][0]
+    with web_app.app.app_context():
+        tables = set(inspect(db.engine).get_table_names())
+    assert set(db.metadata.tables) <= tables
+    assert web_app.app.test_client().get('/users').status_code == 200
+
+
+def test_init_app_migrates_the_shipped_database(tmp_path):
+    db_file = tmp_path / 'sqlite.db'
+    shutil.copyfile(SHIPPED_DATABASE, db_file)
+    app = Flask(__name__)
+    SQLiteDataManager(str(db_file)).init_app(app)
+    with app.app_context():
+        db.engine.dispose()
+    assert user_version(db_file) == MIGRATIONS[-1][0]
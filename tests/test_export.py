@@ -0,0 +1,29 @@
+""" Tests of the bulk export API """
+import csv
+import io
+import json
+
+from datamanager.data_models import db, User
+
+
+def test_export_ndjson_and_csv(web_app):
+    with web_app.app.app_context():
+        user = User(name="Exported, \"quoted\" user")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    client = web_app.app.test_client()
+
+    response = client.get('/api/export', query_string={'entity': 'users'})
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert {'type': 'users', 'id': user_id, 'name': "Exported, \"quoted\" user"} in rows
+
+    response = client.get('/api/export', query_string={'entity': 'users', 'format': 'csv'})
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ['id', 'name']
+    assert [str(user_id), "Exported, \"quoted\" user"] in rows
+
+    assert client.get('/api/export', query_string={'entity': 'users,movies', 'format': 'csv'}).status_code == 400
+    assert client.get('/api/export', query_string={'entity': 'passwords'}).status_code == 400
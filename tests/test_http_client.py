@@ -0,0 +1,139 @@
+""" Tests of the retries and the circuit breaker of the HttpClient against a local stub server """
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import requests
+from datamanager.http_client import HttpClient, CircuitOpenError
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ /ok answers 200, /fail answers 503 and /hang answers after the read timeout of the tests """
+
+    def do_GET(self):
+        self.server.hits[self.path] += 1
+        if self.path == '/hang':
+            time.sleep(1)
+        status = 503 if self.path == '/fail' else 200
+        body = b'{"Response": "True"}'
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up on /hang
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """ Stub server on a free local port. server.url(path) is the URL of a path, server.hits counts the requests """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.hits = Counter()
+    server.url = lambda path: f'http://127.0.0.1:{server.server_port}{path}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(**kwargs):
+    """ Client without backoff waits and with a read timeout shorter than /hang """
+    options = dict(connect_timeout=1, read_timeout=0.2, retries=2, backoff_factor=0,
+                   failure_threshold=10, reset_timeout=0.3)
+    options.update(kwargs)
+    return HttpClient(**options)
+
+
+def host(server):
+    return f'127.0.0.1:{server.server_port}'
+
+
+def get(client, server, path, use_async):
+    """ Sends a GET with call() or with call_async() on the event loop of the client """
+    if use_async:
+        return client.run(client.get_async(server.url(path)))
+    return client.get(server.url(path))
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_success_is_one_attempt(server, use_async):
+    client = make_client()
+    response = get(client, server, '/ok', use_async)
+    assert response.status_code == 200
+    assert server.hits['/ok'] == 1
+    assert client.breaker(host(server)).state == 'closed'
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_server_error_is_retried(server, use_async):
+    client = make_client(retries=2)
+    response = get(client, server, '/fail', use_async)
+    # The answer of the last attempt is returned
+    assert response.status_code == 503
+    assert server.hits['/fail'] == 3
+    breaker = client.breaker(host(server))
+    assert breaker.failures == 3
+    assert breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('use_async, timeout_error', [(False, requests.Timeout), (True, httpx.ReadTimeout)])
+def test_timeout_is_retried_then_raised(server, use_async, timeout_error):
+    client = make_client(retries=1)
+    start = time.perf_counter()
+    with pytest.raises(timeout_error):
+        get(client, server, '/hang', use_async)
+    # Two attempts cut at the read timeout instead of waiting for the server
+    assert time.perf_counter() - start < 1
+    assert server.hits['/hang'] == 2
+    assert client.breaker(host(server)).failures == 2
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_circuit_opens_then_lets_one_trial_call(server, use_async):
+    client = make_client(retries=5, failure_threshold=2, reset_timeout=0.3)
+    breaker = client.breaker(host(server))
+
+    # The retries stop as soon as the circuit opens
+    assert get(client, server, '/fail', use_async).status_code == 503
+    assert server.hits['/fail'] == 2
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        get(client, server, '/ok', use_async)
+    assert server.hits['/ok'] == 0
+
+    time.sleep(0.3)
+    assert breaker.state == 'half-open'
+    # A failed trial call opens the circuit for another period
+    assert get(client, server, '/fail', use_async).status_code == 503
+    assert server.hits['/fail'] == 3
+    assert breaker.state == 'open'
+
+    time.sleep(0.3)
+    assert breaker.state == 'half-open'
+    assert get(client, server, '/ok', use_async).status_code == 200
+    assert server.hits['/ok'] == 1
+    assert breaker.state == 'closed'
+    assert breaker.failures == 0
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_timeouts_open_the_circuit(server, use_async):
+    client = make_client(retries=0, failure_threshold=2)
+    for _ in range(2):
+        with pytest.raises((requests.Timeout, httpx.ReadTimeout)):
+            get(client, server, '/hang', use_async)
+    assert client.breaker(host(server)).state == 'open'
+    with pytest.raises(CircuitOpenError):
+        get(client, server, '/hang', use_async)
+    assert server.hits['/hang'] == 2
@@ -0,0 +1,54 @@
+""" Tests of the bulk import of movies and favorites """
+from sqlalchemy import select
+from datamanager.data_models import Movie, Director, User, MISSING_DIRECTOR
+from datamanager.importer import import_records
+from datamanager.page_cache import create_page_cache
+from datamanager.sqlite_data_manager import SQLiteDataManager
+
+
+def test_blank_director_gets_an_unknown_director(session):
+    session.add(User(name="Alice"))
+    session.commit()
+    results = import_records(session, [
+        {'title': "Blank Director", 'year': '2001', 'director': "  ", 'user_id': 1},
+        {'title': "No Director", 'year': '2002', 'user_id': 1},
+        {'title': "Alien", 'year': '1979', 'director': "Ridley  Scott", 'user_id': 1},
+    ])
+
+    assert [result['status'] for result in results] == ['created', 'created', 'created']
+    movies = {movie.title: movie for movie in session.scalars(select(Movie))}
+    assert movies["Alien"].director.name == "Ridley Scott"
+    assert movies["Blank Director"].director.name == MISSING_DIRECTOR
+    assert movies["No Director"].director.name == MISSING_DIRECTOR
+    # The unknown directors are not shared, a bio written for one isn't shown on the other
+    assert movies["Blank Director"].director_id != movies["No Director"].director_id
+    assert movies["Blank Director"].director.is_unknown
+
+
+def test_directors_are_shared_by_normalized_name(session):
+    import_records(session, [
+        {'title': "Alien", 'year': '1979', 'director': "Ridley Scott"},
+        {'title': "Gladiator", 'year': '2000', 'director': " ridley   SCOTT "},
+    ])
+    assert session.scalars(select(Director.name)).all() == ["Ridley Scott"]
+
+
+def test_invalid_record_doesnt_drop_its_chunk(session):
+    results = import_records(session, [{'title': "  "}, {'title': "Alien", 'director': "  "}])
+    assert results[0]['status'] == 'error'
+    assert results[1]['status'] == 'created'
+
+
+def test_import_movies_makes_the_index_and_the_pages_stale(session):
+    session.add(User(name="Alice"))
+    session.commit()
+    data_manager = SQLiteDataManager('sqlite.db')
+    data_manager.page_cache = create_page_cache()
+    data_manager.recommender.ensure_built(session)
+    data_manager.page_cache.get_or_render('user_movies', (1,), ['user:1'], lambda: "no movies")
+
+    results = data_manager.import_movies([{'title': "Alien", 'year': '1979', 'director': "Ridley Scott",
+                                           'user_id': 1}])
+    assert results[0]['status'] == 'created'
+    assert data_manager.recommender.built_at is None
+    assert data_manager.page_cache.get_or_render('user_movies', (1,), ['user:1'], lambda: "Alien") == "Alien"
@@ -0,0 +1,23 @@
+""" Tests of the queue of the background enrichment jobs """
+from sqlalchemy import select
+from datamanager.data_models import Movie, Director, EnrichmentJob
+from datamanager.jobs import enqueue_movie_enrichment
+
+
+def queued(session, kind):
+    return set(session.scalars(select(EnrichmentJob.target_id).where(EnrichmentJob.kind == kind)))
+
+
+def test_description_is_queued_only_when_missing(session):
+    director = Director(name="Ridley Scott", name_key="ridley scott", bio="English filmmaker.")
+    descriptions = [None, '', ' N/A ', "A crew meets an alien."]
+    movies = [Movie(title=f"Movie {number}", description=description, poster='N/A', director=director)
+              for number, description in enumerate(descriptions)]
+    session.add_all(movies)
+    session.flush()
+
+    enqueue_movie_enrichment(session, [movie.id for movie in movies])
+    session.commit()
+    assert queued(session, 'movie_description') == {movie.id for movie in movies[:3]}
+    assert queued(session, 'poster') == set()
+    assert queued(session, 'director_bio') == set()
@@ -0,0 +1,100 @@
+""" Tests of the SQLite lookup cache of the OMDb and Gemini answers """
+import asyncio
+import time
+
+import pytest
+
+from datamanager.lookup_cache import LookupCache
+
+
+def test_async_lookups_dont_block_the_event_loop(tmp_path, monkeypatch):
+    cache = LookupCache(str(tmp_path / 'cache.db'), namespace='test')
+    cache.set('alien', {'Title': "Alien"})
+    get = cache.get
+
+    def locked_get(key):
+        # A lookup waiting on the lock of another writer
+        time.sleep(0.3)
+        return get(key)
+
+    monkeypatch.setattr(cache, 'get', locked_get)
+
+    async def lookup_and_tick():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        value = await cache.get_async('alien')
+        ticker.cancel()
+        return value, ticks
+
+    value, ticks = asyncio.run(lookup_and_tick())
+    assert value == {'Title': "Alien"}
+    assert ticks >= 10
+
+
+class Clock:
+    """ Replaces time.time() of the cache, so the entries expire without waiting """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('datamanager.lookup_cache.time', clock)
+    return clock
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = LookupCache(str(tmp_path / 'cache.db'), namespace='test', ttl=2)
+    cache.set('alien', {'Title': "Alien"})
+    clock.now += 1.9
+    assert cache.get('alien') == {'Title': "Alien"}
+    clock.now += 0.2
+    assert cache.get('alien') is None
+    # The expired entry is deleted
+    assert cache.stats()['entries'] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_negative_entries_expire_after_the_negative_ttl(tmp_path, clock):
+    cache = LookupCache(str(tmp_path / 'cache.db'), namespace='test', ttl=10, negative_ttl=1)
+    cache.set('alien', {'Title': "Alien"})
+    cache.set('no such movie', {'Response': "False"}, miss=True)
+    clock.now += 0.5
+    assert cache.get('no such movie') == {'Response': "False"}
+    assert cache.negative_hits == 1
+    clock.now += 1
+    assert cache.get('no such movie') is None
+    # The positive entry keeps its own TTL
+    assert cache.get('alien') == {'Title': "Alien"}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = LookupCache(str(tmp_path / 'cache.db'), namespace='test', max_entries=3)
+    other = LookupCache(str(tmp_path / 'cache.db'), namespace='other', max_entries=3)
+    other.set('alien', {'Title': "Alien"})
+    for title in ('alien', 'brazil', 'casablanca'):
+        clock.now += 1
+        cache.set(title, {'Title': title})
+    clock.now += 1
+    # Reading the oldest entry makes 'brazil' the least recently used
+    assert cache.get('alien') is not None
+    clock.now += 1
+    cache.set('dune', {'Title': "dune"})
+
+    assert cache.stats()['entries'] == 3
+    assert cache.get('brazil') is None
+    assert all(cache.get(title) is not None for title in ('alien', 'casablanca', 'dune'))
+    # The bound is per namespace
+    assert other.get('alien') == {'Title': "Alien"}
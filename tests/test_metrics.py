@@ -0,0 +1,49 @@
+""" Tests of the request and SQL query metrics """
+import time
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from datamanager.metrics import Metrics
+
+
+@pytest.fixture
+def metrics_engine(tmp_path):
+    """ Metrics of a new app on an SQLite engine of its own """
+    metrics = Metrics(slow_query_ms=10000)
+    engine = create_engine('sqlite:///' + str(tmp_path / 'metrics.db'))
+    metrics.init_app(Flask(__name__), engine)
+    yield metrics, engine
+    engine.dispose()
+
+
+def query_durations(metrics):
+    histogram = metrics.histograms.get(('moviweb_db_query_seconds', ()))
+    return (histogram.count, histogram.sum) if histogram else (0, 0.0)
+
+
+def test_failed_query_leaves_no_start_time(metrics_engine):
+    metrics, engine = metrics_engine
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing_table"))
+        time.sleep(0.2)
+        connection.execute(text("SELECT 1"))
+        assert 'metrics_query_start' not in connection.info
+
+    count, total = query_durations(metrics)
+    # Only the query that succeeded is timed, from its own start
+    assert count == 1
+    assert total < 0.1
+
+
+def test_metrics_endpoint(metrics_engine):
+    metrics, engine = metrics_engine
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    app = Flask(__name__)
+    metrics.init_app(app, engine)
+    response = app.test_client().get('/metrics')
+    assert response.mimetype == 'text/plain'
+    assert 'moviweb_db_query_seconds_count 1' in response.get_data(as_text=True)
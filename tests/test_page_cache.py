@@ -0,0 +1,71 @@
+""" Tests that the write paths invalidate the cached pages and of the ETags of the API """
+import itertools
+
+import pytest
+from datamanager.data_models import db, User, Movie, Director
+
+# The directors are unique by name, every test gets its own
+directors = itertools.count(1)
+
+
+@pytest.fixture
+def user_and_movies(web_app):
+    """ Id of a new user with one favorite movie and ids of the favorite and of a movie not saved yet """
+    with web_app.app.app_context():
+        movies = []
+        for title in ("Cached Favorite", "Added Favorite"):
+            number = next(directors)
+            movies.append(Movie(title=title, genre="Drama", year="1942", rating=8.5, poster='N/A',
+                                description="A movie.",
+                                director=Director(name=f"Director {number}", name_key=f"page director {number}")))
+        user = User(name="Cached User", movies=movies[:1])
+        db.session.add_all([user] + movies)
+        db.session.commit()
+        return user.id, movies[0].id, movies[1].id
+
+
+def test_adding_a_favorite_changes_the_user_page(web_app, user_and_movies):
+    user_id, _, new_movie_id = user_and_movies
+    client = web_app.app.test_client()
+    first = client.get(f'/users/{user_id}').get_data(as_text=True)
+    hits = web_app.page_cache.hits
+    # Without a write the cached list is served
+    assert client.get(f'/users/{user_id}').get_data(as_text=True) == first
+    assert web_app.page_cache.hits == hits + 1
+    assert "Added Favorite" not in first
+
+    with web_app.app.app_context():
+        assert web_app.data_manager.add_favorite(user_id, new_movie_id)
+    assert "Added Favorite" in client.get(f'/users/{user_id}').get_data(as_text=True)
+
+
+def test_adding_a_review_changes_the_movie_page(web_app, user_and_movies):
+    user_id, movie_id, _ = user_and_movies
+    client = web_app.app.test_client()
+    path = f'/info/movie/{movie_id}/user/{user_id}'
+    assert "A cached review." not in client.get(path).get_data(as_text=True)
+
+    with web_app.app.app_context():
+        web_app.data_manager.add_review(user_id, movie_id, 9, "A cached review.")
+    assert "A cached review." in client.get(path).get_data(as_text=True)
+
+
+def test_api_answers_not_modified_to_the_same_etag(web_app, user_and_movies):
+    user_id, _, new_movie_id = user_and_movies
+    client = web_app.app.test_client()
+    path = f'/api/users/{user_id}/movies'
+    response = client.get(path)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+    # Another list of favorites has another ETag
+    with web_app.app.app_context():
+        web_app.data_manager.add_favorite(user_id, new_movie_id)
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert {movie['title'] for movie in response.get_json()} == {"Added Favorite", "Cached Favorite"}
@@ -0,0 +1,73 @@
+""" Tests of the poster store: allowed hosts and the size limit of the downloads """
+import pytest
+from datamanager.posters import PosterStore, MAX_POSTER_BYTES
+
+OMDB_POSTER = 'https://m.media-amazon.com/images/M/poster.jpg'
+
+
+class StubResponse:
+    def __init__(self, chunks, content_length=None):
+        self.status_code = 200
+        self.headers = {'Content-Type': 'image/jpeg'}
+        if content_length is not None:
+            self.headers['Content-Length'] = str(content_length)
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+class StubHttpClient:
+    """ Records the requested URLs and answers with the given response """
+
+    def __init__(self, response):
+        self.response = response
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append((url, kwargs))
+        return self.response
+
+
+@pytest.mark.parametrize('poster', [
+    'http://169.254.169.254/latest/meta-data/',
+    'http://localhost:5002/api/export',
+    'https://m.media-amazon.com.evil.example/poster.jpg',
+    'file:///etc/passwd',
+    'N/A',
+])
+def test_other_hosts_are_not_downloaded(tmp_path, poster):
+    http_client = StubHttpClient(StubResponse([b'image']))
+    store = PosterStore(str(tmp_path), http_client)
+    assert not store.is_allowed(poster)
+    assert store.get(poster) is None
+    assert http_client.urls == []
+
+
+def test_omdb_poster_is_downloaded_without_redirects(tmp_path):
+    http_client = StubHttpClient(StubResponse([b'image']))
+    store = PosterStore(str(tmp_path), http_client)
+    assert store.download(OMDB_POSTER)
+    assert http_client.urls == [(OMDB_POSTER, {'stream': True, 'allow_redirects': False})]
+    assert open(store.path(OMDB_POSTER, 'original'), 'rb').read() == b'image'
+
+
+def test_large_poster_stops_at_the_limit(tmp_path):
+    def chunks():
+        while True:
+            yield b'x' * 1024 * 1024
+
+    response = StubResponse(chunks())
+    store = PosterStore(str(tmp_path), StubHttpClient(response))
+    assert not store.download(OMDB_POSTER)
+    assert response.closed
+
+
+def test_declared_length_over_the_limit_is_refused(tmp_path):
+    response = StubResponse([b'image'], content_length=MAX_POSTER_BYTES + 1)
+    store = PosterStore(str(tmp_path), StubHttpClient(response))
+    assert not store.download(OMDB_POSTER)
@@ -0,0 +1,74 @@
+""" Tests that the favorite movies page and the movie information page don't make a query per favorite """
+import pytest
+from sqlalchemy import event
+from datamanager.data_models import db, User, Movie, Director, Review, user_movie_association
+from datamanager.genres import set_movie_genres
+
+# Favorite movies of the seeded users, user n saves the movies 1 to FAVORITES[n - 1]
+FAVORITES = (1, 5, 25)
+
+
+@pytest.fixture(scope='module')
+def seeded(web_app):
+    """ Ids of the users with FAVORITES favorite movies and of their movies """
+    with web_app.app.app_context():
+        user_ids, movie_ids = seed(db.session)
+    # The favorites were inserted without the data manager
+    web_app.data_manager.recommender.invalidate()
+    return user_ids, movie_ids
+
+
+def seed(session):
+    # A director per movie, so a lazy load of the directors would be a query per favorite
+    movies = [Movie(title=f"Movie {number}", genre="Drama, Sci-Fi", year="1982", rating=8.1, poster='N/A',
+                    description="A movie.", director=Director(name=f"Director {number}", name_key=f"director {number}"))
+              for number in range(1, max(FAVORITES) + 6)]
+    users = [User(name=f"User {count}") for count in FAVORITES]
+    # Saves every movie, so all the users get recommendations
+    neighbour = User(name="Neighbour")
+    session.add_all(movies + users + [neighbour])
+    session.flush()
+    set_movie_genres(session.connection(), {movie.id: movie.genre for movie in movies})
+    favorites = [(user, count) for user, count in zip(users, FAVORITES)] + [(neighbour, len(movies))]
+    session.execute(user_movie_association.insert(), [{'user_id': user.id, 'movie_id': movie.id}
+                                                      for user, count in favorites for movie in movies[:count]])
+    session.add_all(Review(user_id=user.id, movie_id=movie.id, rating=7, text="Good.")
+                    for user, count in zip(users, FAVORITES) for movie in movies[:count])
+    session.commit()
+    return [user.id for user in users], [movie.id for movie in movies]
+
+
+def count_queries(web, path):
+    """ Requests a page without the page cache and returns the number of SQL statements it executed """
+    web.page_cache.clear()
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with web.app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = web.app.test_client().get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_user_movies_queries_dont_grow_with_the_favorites(web_app, seeded):
+    user_ids, _ = seeded
+    # The first request builds the recommendation index
+    count_queries(web_app, f'/users/{user_ids[0]}')
+    counts = [count_queries(web_app, f'/users/{user_id}') for user_id in user_ids]
+    assert len(set(counts)) == 1, counts
+
+
+def test_info_movie_queries_dont_grow_with_the_favorites(web_app, seeded):
+    user_ids, movie_ids = seeded
+    # The first movie is saved and reviewed by every user, the movie FAVORITES[-1] only by the last user
+    paths = [f'/info/movie/{movie_ids[0]}/user/{user_id}' for user_id in user_ids]
+    paths.append(f'/info/movie/{movie_ids[max(FAVORITES) - 1]}/user/{user_ids[-1]}')
+    counts = [count_queries(web_app, path) for path in paths]
+    assert len(set(counts)) == 1, counts
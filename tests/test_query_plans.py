@@ -0,0 +1,14 @@
+""" Tests that the hot queries of the migrated database are answered from the indexes """
+import pytest
+from datamanager.data_models import db
+from datamanager.migrations import HOT_QUERIES, query_plans
+
+
+@pytest.mark.parametrize('name', HOT_QUERIES)
+def test_hot_query_uses_an_index(app, name):
+    plan = query_plans(db.engine)[name]
+    for step in plan:
+        # A SCAN is only an ordered walk of an index, never of the table
+        assert 'USING INDEX' in step or 'USING COVERING INDEX' in step or 'USING INTEGER PRIMARY KEY' in step, plan
+        assert 'TEMP B-TREE' not in step, plan
+    assert any('USING INDEX' in step or 'USING COVERING INDEX' in step for step in plan), plan
@@ -0,0 +1,133 @@
+""" Tests of the recommendation index: its scores, its incremental updates and its rebuild """
+import math
+import threading
+import time
+
+import pytest
+from sqlalchemy import delete
+from datamanager import recommender
+from datamanager.data_models import User, Movie, Director, user_movie_association
+from datamanager.recommender import RecommendationIndex
+
+
+class SlowIndex(RecommendationIndex):
+    """ Counts the builds, which take some time like on a large database """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.builds = 0
+
+    def build(self, session, batch_size=10000):
+        self.builds += 1
+        time.sleep(0.2)
+        super().build(session, batch_size)
+
+
+def add_favorites(session, favorites, users=3, movies=3):
+    director = Director(name="Ridley Scott")
+    session.add(director)
+    session.add_all(User(name=f"User {user_id}") for user_id in range(1, users + 1))
+    session.add_all(Movie(title=f"Movie {movie_id}", director=director) for movie_id in range(1, movies + 1))
+    session.flush()
+    session.execute(user_movie_association.insert(), [{'user_id': user_id, 'movie_id': movie_id}
+                                                      for user_id, movie_id in favorites])
+    session.commit()
+
+
+def ensure_built_concurrently(app, index, threads=8):
+    """ Calls ensure_built from several threads, each with its own session. Returns the seconds of each call """
+    from datamanager.data_models import db
+    durations = []
+
+    def call():
+        with app.app_context():
+            start = time.perf_counter()
+            index.ensure_built(db.session)
+            durations.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=call) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return durations
+
+
+def test_first_build_runs_once(app, session):
+    add_favorites(session, [(1, 1), (1, 2), (2, 1), (2, 2)])
+    index = SlowIndex()
+    ensure_built_concurrently(app, index)
+    assert index.builds == 1
+    assert index.similar_movies(1) == [(2, 1.0)]
+
+
+def test_expired_index_is_served_while_one_thread_rebuilds(app, session):
+    add_favorites(session, [(1, 1), (1, 2)])
+    index = SlowIndex(rebuild_interval=600)
+    index.ensure_built(session)
+    index.built_at -= 601
+
+    durations = ensure_built_concurrently(app, index)
+    assert index.builds == 2
+    # Only the rebuilding thread waited for the build
+    assert sorted(durations)[-2] < 0.1
+    assert index.is_fresh()
+
+
+# Users 1 to 3 saved overlapping movies, user 4 saved a movie nobody else saved
+FAVORITES = [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3), (3, 2), (3, 3), (4, 4)]
+
+
+@pytest.fixture(params=['python', 'sparse'])
+def build_with(request, monkeypatch):
+    """ Runs the test with the Counter build and with the NumPy/SciPy build """
+    if request.param == 'python':
+        monkeypatch.setattr(recommender, 'sparse', None)
+    elif recommender.sparse is None:
+        pytest.skip("NumPy and SciPy are not installed")
+    return request.param
+
+
+def test_known_scores(session, build_with):
+    add_favorites(session, FAVORITES, users=4, movies=4)
+    index = RecommendationIndex()
+    index.build(session)
+    # Movies 1 and 3 share one of their two users, 2 shares two users with each of them
+    high, low = 2 / math.sqrt(6), 0.5
+
+    assert index.similar_movies(1) == [(2, pytest.approx(high)), (3, pytest.approx(low))]
+    # Equal similarities are ranked by movie id
+    assert index.similar_movies(2) == [(1, pytest.approx(high)), (3, pytest.approx(high))]
+    assert index.similar_movies(4) == []
+    assert index.recommend(1) == [(3, pytest.approx(high + low))]
+    assert index.recommend(3) == [(1, pytest.approx(high + low))]
+    # Every neighbour movie already saved: the most saved movies the user doesn't have
+    assert index.recommend(2) == [(4, 1.0)]
+    assert index.recommend(4) == [(2, 3.0), (1, 2.0), (3, 2.0)]
+    assert index.recommend(99, limit=2) == [(2, 3.0), (1, 2.0)]
+
+
+def test_incremental_updates_match_a_rebuild(session, build_with):
+    add_favorites(session, FAVORITES, users=5, movies=5)
+    index = RecommendationIndex()
+    index.build(session)
+
+    for user_id, movie_id in [(4, 1), (5, 4), (5, 5), (1, 5)]:
+        session.execute(user_movie_association.insert().values(user_id=user_id, movie_id=movie_id))
+        index.add_favorite(user_id, movie_id)
+    session.execute(delete(user_movie_association).where(user_movie_association.c.user_id == 2,
+                                                         user_movie_association.c.movie_id == 2))
+    index.remove_favorite(2, 2)
+    session.execute(delete(user_movie_association).where(user_movie_association.c.user_id == 3))
+    index.remove_user(3)
+    session.commit()
+
+    rebuilt = RecommendationIndex()
+    rebuilt.build(session)
+    assert +index.movie_users == +rebuilt.movie_users
+    assert {movie_id: +counts for movie_id, counts in index.co_counts.items() if +counts} == \
+           {movie_id: +counts for movie_id, counts in rebuilt.co_counts.items() if +counts}
+    for user_id in range(1, 6):
+        assert index.recommend(user_id) == rebuilt.recommend(user_id)
+    for movie_id in range(1, 6):
+        assert index.similar_movies(movie_id) == rebuilt.similar_movies(movie_id)
@@ -0,0 +1,123 @@
+""" Tests of the server-sent event stream of the update page with a stubbed Gemini stream """
+import json
+from types import SimpleNamespace
+
+import pytest
+from datamanager.data_models import db, User, Movie, Director
+
+BIO = {'bio': "Born in \"South Shields\", he directed Alien.", 'birth': '30 November 1937', 'death': ''}
+
+
+@pytest.fixture
+def movie_page(web_app, request):
+    """ URL of the update page of a new movie, with a title of its own so the Gemini cache is empty """
+    with web_app.app.app_context():
+        user = User(name="Streamer")
+        movie = Movie(title=f"Stream {request.node.name}", year='1979',
+                      director=Director(name=f"Director {request.node.name}", name_key=request.node.name.lower()))
+        db.session.add_all([user, movie])
+        db.session.commit()
+        return f'/users/{user.id}/update_movie/{movie.id}', movie.id
+
+
+def stub_stream(monkeypatch, texts, error=None):
+    """ Gemini answers the texts as chunks, then raises 'error'. Returns the list of the streamed prompts """
+    prompts = []
+
+    def chunks():
+        for text in texts:
+            yield SimpleNamespace(text=text)
+        if error is not None:
+            raise error
+
+    def open_stream(prompt, config=None):
+        prompts.append(prompt)
+        stream = chunks()
+        return next(stream, None), stream
+
+    # Imported by the web_app fixture, with its data folder and API key
+    monkeypatch.setattr('datamanager.gemini_ai.open_stream', open_stream)
+    return prompts
+
+
+def read_events(response):
+    """ Parses the text/event-stream body into (event, data) pairs, checking the framing of every event """
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    body = response.get_data(as_text=True)
+    assert body.endswith('\n\n')
+    events = []
+    for block in body[:-2].split('\n\n'):
+        lines = block.split('\n')
+        event = lines[0][len('event: '):] if lines[0].startswith('event: ') else 'message'
+        assert lines[-1].startswith('data: ') and len(lines) == (1 if event == 'message' else 2), block
+        events.append((event, json.loads(lines[-1][len('data: '):])))
+    return events
+
+
+def streamed_fields(events):
+    fields = {}
+    for event, data in events:
+        if event == 'message':
+            fields[data['field']] = fields.get(data['field'], '') + data['text']
+    return fields
+
+
+def test_bio_is_streamed_then_stored(web_app, movie_page, monkeypatch):
+    page, movie_id = movie_page
+    answer = json.dumps(BIO)
+    # Chunks cut inside the field names and inside the escaped quote
+    prompts = stub_stream(monkeypatch, [answer[start:start + 7] for start in range(0, len(answer), 7)])
+    client = web_app.app.test_client()
+
+    events = read_events(client.get(page + '/stream', query_string={'prompt': 'bio'}))
+    assert events[-1] == ('done', {})
+    assert all(event == 'message' and set(data) == {'field', 'text'} for event, data in events[:-1])
+    assert len(events) > 3
+    assert streamed_fields(events) == {field: value for field, value in BIO.items() if value}
+    assert len(prompts) == 1
+
+    # The complete answer is cached: streamed again without a model call
+    assert streamed_fields(read_events(client.get(page + '/stream', query_string={'prompt': 'bio'}))) == \
+           streamed_fields(events)
+    assert len(prompts) == 1
+
+    # The page saves the streamed text like main.js does
+    fields = streamed_fields(events)
+    response = client.post(page, json={'description': '', 'rating': '', 'genre': '', 'bio': fields['bio'],
+                                       'birth': fields['birth'], 'death': ''})
+    assert response.get_json() == {'response': "FINE"}
+    with web_app.app.app_context():
+        director = db.session.get(Movie, movie_id).director
+        assert (director.bio, director.birth) == (BIO['bio'], BIO['birth'])
+
+
+def test_description_is_streamed(web_app, movie_page, monkeypatch):
+    page, _ = movie_page
+    stub_stream(monkeypatch, ["A crew ", "meets an ", "alien."])
+    events = read_events(web_app.app.test_client().get(page + '/stream', query_string={'prompt': 'description'}))
+    assert events == [('message', {'field': 'description', 'text': "A crew "}),
+                      ('message', {'field': 'description', 'text': "meets an "}),
+                      ('message', {'field': 'description', 'text': "alien."}),
+                      ('done', {})]
+
+
+def test_failed_stream_ends_with_an_error_event(web_app, movie_page, monkeypatch):
+    page, _ = movie_page
+    prompts = stub_stream(monkeypatch, ["A crew "], error=RuntimeError("connection reset"))
+    client = web_app.app.test_client()
+    events = read_events(client.get(page + '/stream', query_string={'prompt': 'description'}))
+    assert events == [('message', {'field': 'description', 'text': "A crew "}),
+                      ('error', {'error': "Failed to generate text"})]
+
+    # The partial answer isn't cached, the next stream calls the model again
+    stub_stream(monkeypatch, ["A crew meets an alien."])
+    events = read_events(client.get(page + '/stream', query_string={'prompt': 'description'}))
+    assert streamed_fields(events) == {'description': "A crew meets an alien."}
+    assert len(prompts) == 1
+
+
+def test_unknown_prompt_is_refused(web_app, movie_page):
+    page, _ = movie_page
+    assert web_app.app.test_client().get(page + '/stream', query_string={'prompt': 'plot'}).status_code == 400
@@ -0,0 +1,34 @@
+""" Tests of the users page """
+from datamanager.data_models import db, User
+
+
+def add_user(web_app, name):
+    with web_app.app.app_context():
+        user = User(name=name)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def test_delete_user(web_app):
+    user_id = add_user(web_app, "Deleted User")
+    response = web_app.app.test_client().post('/users', data={'user_id': user_id})
+    assert response.status_code == 200
+    assert f'{user_id} | Deleted User' in response.get_data(as_text=True)
+    with web_app.app.app_context():
+        assert db.session.get(User, user_id) is None
+
+
+def test_failed_delete_shows_an_error(web_app, monkeypatch):
+    user_id = add_user(web_app, "Kept User")
+
+    def failing_commit():
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(db.session, 'commit', failing_commit)
+    response = web_app.app.test_client().post('/users', data={'user_id': user_id})
+    monkeypatch.undo()
+    assert response.status_code == 200
+    assert f"The user {user_id} couldn&#39;t be deleted" in response.get_data(as_text=True)
+    with web_app.app.app_context():
+        assert db.session.get(User, user_id).name == "Kept User"